@@ -139,6 +139,16 @@ class LTLfDFA:
                 self._trap_states.append(node)
         if '\\n' in self._dfa:
           self._dfa.remove_node('\\n')  # for some reason an extra node with a newline is created.
+        self._violable_states = self.compute_violable_states()
+
+    def compute_violable_states(self):
+        """States from which a rejecting trap state, i.e. a violation, can still be reached."""
+        violable = set()
+        for state in self._trap_states:
+            if state in self._dfa and not self.is_accepting(state):
+                violable.add(state)
+                violable.update(nx.ancestors(self._dfa, state))
+        return violable
 
     def step(self, data, return_state=False):
         self._current_state = self._compute_next_state(
@@ -148,14 +158,21 @@ class LTLfDFA:
         else:
             return self.is_accepting(self._current_state)
 
-    def _compute_next_state(self, current_state, data_dict):
+    def transitions(self, current_state, data_dict, ignore=()):
+        """The states reached by the edges whose guard holds for data_dict, skipping edges that use a symbol in ignore."""
         valid_states = []
         for u, v, a in self._dfa.out_edges(current_state, data=True):
+            if any(symbol in ignore for symbol in a['symbols']):
+                continue
             if eval(a['label'], dict(data_dict)):
                 valid_states.append(v)
+        return valid_states
+
+    def _compute_next_state(self, current_state, data_dict):
+        valid_states = self.transitions(current_state, data_dict)
         if len(valid_states) != 1:
             raise ValueError(
-                f"Unable to find state transition from {u} with {data_dict}, aborting.")
+                f"Unable to find state transition from {current_state} with {data_dict}, aborting.")
         return valid_states[0]
 
     def get_init_state(self):
@@ -200,6 +217,9 @@ class LTLfDFA:
     def is_trap_state(self, state):
         return state in self._trap_states
 
+    def can_violate(self, state):
+        return state in self._violable_states
+
     def animate(self, steps, mp4_file, fps=20):
         fig, ax = plt.subplots()
         ax.axis('off')
@@ -230,4 +250,7 @@ class DFAView:
         return self.ltlfdfa.is_trap_state(self.current_state)
 
     def is_accepting(self):
-        return self.ltlfdfa.is_accepting(self.current_state)
\ No newline at end of file
+        return self.ltlfdfa.is_accepting(self.current_state)
+
+    def can_violate(self):
+        return self.ltlfdfa.can_violate(self.current_state)
\ No newline at end of file
@@ -0,0 +1,73 @@
+import json
+from collections import Counter, defaultdict
+from pathlib import Path
+
+
+class MonitorProfiler:
+    """
+    Opt-in counters for where SymbolicMonitor spends its time. The monitor puts the profiler in sg.graph['profiler']
+    while it checks an SG, and ConcreteProperty reports symbol evaluations and cache hits through it.
+    All keys are '<property>.<symbol>' or property names, so the counters stay small and picklable.
+    """
+
+    def __init__(self):
+        # top-level symbol evaluations that were actually computed
+        self.symbol_evaluations = Counter()
+        self.symbol_time_ns = Counter()
+        # per property: frame cache hit/miss, incremental memo hits and static road-network cache hits
+        self.cache = defaultdict(Counter)
+        # calls of each SG primitive / operator while evaluating predicates, across all properties
+        self.primitive_calls = Counter()
+        # per property: instances spawned (blank or by binding expansion) and retired (by reason)
+        self.instances = defaultdict(Counter)
+        self.expansion_time_ns = Counter()
+        self.frames = 0
+        self.check_time_ns = 0
+
+    def symbol(self, property_name, symbol, time_ns):
+        key = f'{property_name}.{symbol}'
+        self.symbol_evaluations[key] += 1
+        self.symbol_time_ns[key] += time_ns
+
+    def cache_event(self, property_name, event):
+        self.cache[property_name][event] += 1
+
+    def primitive(self, name):
+        self.primitive_calls[name] += 1
+
+    def spawned(self, property_name, n, reason):
+        self.instances[property_name][f'spawned_{reason}'] += n
+
+    def retired(self, property_name, reason):
+        self.instances[property_name][f'retired_{reason}'] += 1
+
+    def expansion(self, property_name, time_ns):
+        self.expansion_time_ns[property_name] += time_ns
+
+    def frame(self, time_ns):
+        self.frames += 1
+        self.check_time_ns += time_ns
+
+    def to_dict(self):
+        symbols = {}
+        for key, n in self.symbol_evaluations.most_common():
+            symbols[key] = {'evaluations': n,
+                            'total_ms': self.symbol_time_ns[key] / 1e6,
+                            'mean_us': self.symbol_time_ns[key] / n / 1e3}
+        cache = {}
+        for property_name, events in self.cache.items():
+            lookups = events['hit'] + events['miss']
+            cache[property_name] = {**events, 'hit_rate': events['hit'] / lookups if lookups > 0 else None}
+        return {
+            'frames': self.frames,
+            'check_total_ms': self.check_time_ns / 1e6,
+            'symbols': symbols,
+            'cache': cache,
+            'primitive_calls': dict(self.primitive_calls.most_common()),
+            'instances': {property_name: dict(counts) for property_name, counts in self.instances.items()},
+            'expansion_total_ms': {property_name: t / 1e6 for property_name, t in self.expansion_time_ns.items()},
+        }
+
+    def save(self, save_file: Path):
+        with open(save_file, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
@@ -0,0 +1,122 @@
+import cProfile
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+
+class _FrameProfile:
+    __slots__ = ('profiler', 'frame', 'start')
+
+    def __init__(self, profiler, frame):
+        self.profiler = profiler
+        self.frame = frame
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        self.profiler.start_frame()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.end_frame(self.frame, time.perf_counter_ns() - self.start)
+
+
+class OutlierProfiler:
+    """
+    Profiles every frame cheaply and only keeps the profile of frames that take longer than threshold_ms.
+    modes:
+        sample: a background thread samples the monitor thread's stack every interval_ms. The profile is saved as
+            collapsed stacks ('outer;inner count' per line), which speedscope and flamegraph.pl read. The sampler needs
+            the GIL, so samples are at most as fine as sys.getswitchinterval() (5ms by default).
+        cprofile: runs cProfile for every frame and saves the stats of slow frames as a .prof file (see pstats).
+            Exact, but slows every frame down considerably.
+    Profiles are kept in memory and saved by close() to <save_folder>/<route>_frame_<frame>.<folded|prof>, so
+    writing them does not add to the time of the frames being checked.
+    """
+    MODES = ['sample', 'cprofile']
+
+    def __init__(self, save_folder, route, threshold_ms=500, mode='sample', interval_ms=5):
+        if mode not in OutlierProfiler.MODES:
+            raise ValueError(f'Unknown profiling mode {mode}, must be one of {OutlierProfiler.MODES}')
+        self.save_folder = Path(save_folder)
+        self.route = route
+        self.threshold_ns = threshold_ms * 1e6
+        self.mode = mode
+        self.interval = interval_ms / 1000
+        self.saved = []
+        # (save_file, cProfile.Profile or Counter of sampled stacks) of the slow frames, written by close()
+        self._pending = []
+        self._profile = None
+        self._samples = Counter()
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._stopped = False
+        self._target = None
+        self._thread = None
+        if mode == 'sample':
+            self._thread = threading.Thread(target=self._sample, name=f'OutlierProfiler-{route}', daemon=True)
+            self._thread.start()
+
+    def frame(self, frame):
+        return _FrameProfile(self, frame)
+
+    def start_frame(self):
+        if self.mode == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            with self._lock:
+                self._samples = Counter()
+                self._target = threading.get_ident()
+            self._active.set()
+
+    def end_frame(self, frame, duration_ns):
+        if self.mode == 'cprofile':
+            self._profile.disable()
+        else:
+            self._active.clear()
+        if duration_ns <= self.threshold_ns:
+            return
+        save_file = self.save_folder / f'{self.route}_frame_{frame}.{"prof" if self.mode == "cprofile" else "folded"}'
+        if self.mode == 'cprofile':
+            self._pending.append((save_file, self._profile))
+        else:
+            # start_frame replaces the counter, so this one is no longer updated
+            with self._lock:
+                self._pending.append((save_file, self._samples))
+        self.saved.append({'frame': frame, 'duration_ms': duration_ns / 1e6, 'profile': save_file.name})
+
+    def _sample(self):
+        while not self._stopped:
+            if not self._active.wait(timeout=0.1):
+                continue
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self._target)
+            if frame is None or not self._active.is_set():
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            stack.reverse()
+            with self._lock:
+                self._samples[tuple(stack)] += 1
+
+    def close(self):
+        self._stopped = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if len(self._pending) > 0:
+            self.save_folder.mkdir(parents=True, exist_ok=True)
+        for save_file, profile in self._pending:
+            if self.mode == 'cprofile':
+                profile.dump_stats(str(save_file))
+            else:
+                with open(save_file, 'w') as f:
+                    for stack, n in profile.most_common():
+                        f.write(f'{";".join(stack)} {n}\n')
+        self._pending = []
@@ -0,0 +1,151 @@
+import json
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from SymbolicEntity import UnboundEntityError
+
+VALUE_DTYPE = np.dtype([
+    ('frame', '<i4'),  # index into frames
+    ('symbol', '<i2'),  # index into the property's symbols
+    ('binding', '<i4'),  # row of the property's bindings
+    ('value', 'i1'),  # FALSE, TRUE or UNBOUND
+])
+CANDIDATE_DTYPE = np.dtype([
+    ('frame', '<i4'),
+    ('entity', '<i2'),  # index into the property's symbolic entities
+    ('id', '<i4'),  # index into entity_ids
+])
+FALSE, TRUE, UNBOUND = 0, 1, 2
+
+
+def binding_key(entity_ids):
+    # the same normalization as ConcreteProperty.cache_key, so a trace holds the values the monitor's cache held
+    return tuple(entity_id or None for entity_id in entity_ids)
+
+
+class PredicateTraceRecorder:
+    """
+    Records the value of every atomic predicate (symbol) of the checked properties for every binding of its entities
+    that the monitor stepped, and which entities each symbolic entity could be bound to in every frame. Saved as a
+    PredicateTrace, this is enough to check other formulas over the same predicates without the SGs (recheck_traces.py).
+    """
+    VERSION = 1
+
+    def __init__(self, properties):
+        self.properties = properties
+        self.frames = []
+        self.entity_ids = {}  # JSON encoded id -> index
+        self.values = {prop.name: {} for prop in properties}  # (frame, symbol, binding) -> [value, from_monitor]
+        self.bindings = {prop.name: {} for prop in properties}  # binding key -> index
+        self.candidates = {prop.name: [] for prop in properties}
+        self.symbols = {prop.name: {symbol: i for i, symbol in enumerate(prop.predicates)} for prop in properties}
+        self.ego_id = None
+
+    def _entity_index(self, entity_id):
+        if entity_id is None:
+            return -1
+        return self.entity_ids.setdefault(json.dumps(entity_id), len(self.entity_ids))
+
+    def frame(self, sg):
+        """Called at the start of every frame, before any property is stepped."""
+        frame = len(self.frames)
+        self.frames.append(sg.graph['frame'])
+        for prop in self.properties:
+            for i, symbolic_entity in enumerate(prop.symbolic_entities):
+                for node in sg.nodes:
+                    if symbolic_entity.is_valid(node) and not node.is_phantom():
+                        self.candidates[prop.name].append((frame, i, self._entity_index(node.get_id())))
+
+    def record(self, property_name, symbol, entity_ids, value, from_monitor=True):
+        """
+        The value of a symbol for the given ids of its entities (None if unbound) in the current frame. Values the
+        monitor itself used win over values only evaluated for the trace, in case they differ (see binding_key).
+        """
+        key = binding_key(entity_ids)
+        bindings = self.bindings[property_name]
+        if key not in bindings:
+            bindings[key] = len(bindings)
+        if isinstance(value, UnboundEntityError):
+            value = UNBOUND
+        else:
+            value = TRUE if value else FALSE
+        values = self.values[property_name]
+        index = (len(self.frames) - 1, self.symbols[property_name][symbol], bindings[key])
+        if index not in values or (from_monitor and not values[index][1]):
+            values[index] = [value, from_monitor]
+
+    def save(self, path):
+        arrays = {'frames': np.array(self.frames, dtype=str)}
+        meta = {'version': PredicateTraceRecorder.VERSION, 'ego_id': self.ego_id, 'properties': []}
+        for i, prop in enumerate(self.properties):
+            meta['properties'].append({
+                'name': prop.name,
+                'formula': getattr(prop, 'formula', None),
+                'symbols': list(prop.predicates),
+                'symbol_entities': {symbol: [entity.name for entity in entities]
+                                    for symbol, entities in prop.symbol_to_entities.items()},
+                'entities': [entity.name for entity in prop.symbolic_entities],
+            })
+            values = self.values[prop.name]
+            records = np.zeros(len(values), dtype=VALUE_DTYPE)
+            if len(values) > 0:
+                records['frame'], records['symbol'], records['binding'] = np.array(list(values), dtype=np.int64).T
+                records['value'] = [value for value, _ in values.values()]
+            arrays[f'values_{i}'] = records
+            bindings = self.bindings[prop.name]
+            width = max((len(key) for key in bindings), default=0)
+            table = np.full((len(bindings), width), -1, dtype=np.int32)
+            for key, row in bindings.items():
+                table[row, :len(key)] = [self._entity_index(entity_id) for entity_id in key]
+            arrays[f'bindings_{i}'] = table
+            arrays[f'candidates_{i}'] = np.array(self.candidates[prop.name], dtype=CANDIDATE_DTYPE)
+        arrays['entity_ids'] = np.array(sorted(self.entity_ids, key=self.entity_ids.get), dtype=str)
+        arrays['meta'] = np.array(json.dumps(meta))
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(path, **arrays)
+
+
+class PredicateTrace:
+    """A route's predicate trace as written by PredicateTraceRecorder, stored as <route folder>/predicate_trace.npz."""
+    FILE_NAME = 'predicate_trace.npz'
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with np.load(self.path) as data:
+            self.meta = json.loads(str(data['meta']))
+            self.frames = data['frames'].tolist()
+            self.entity_ids = [json.loads(entity_id) for entity_id in data['entity_ids'].tolist()]
+            self.properties = {}
+            for i, prop in enumerate(self.meta['properties']):
+                bindings = [tuple(self.entity_ids[index] if index >= 0 else None for index in row)
+                            for row in data[f'bindings_{i}'].tolist()]
+                values = {}
+                for frame, symbol, binding, value in data[f'values_{i}'].tolist():
+                    values[(frame, prop['symbols'][symbol], bindings[binding])] = value
+                candidates = defaultdict(list)
+                for frame, entity, entity_id in data[f'candidates_{i}'].tolist():
+                    candidates[(frame, prop['entities'][entity])].append(self.entity_ids[entity_id])
+                self.properties[prop['name']] = dict(prop, values=values, candidates=candidates)
+
+    @staticmethod
+    def find(results_root) -> List["PredicateTrace"]:
+        return [PredicateTrace(path) for path in sorted(Path(results_root).glob(f'*/{PredicateTrace.FILE_NAME}'))]
+
+    @property
+    def route(self):
+        return self.path.parent.name
+
+    def value(self, property_name, frame: int, symbol, entity_ids) -> Optional[int]:
+        """FALSE, TRUE or UNBOUND, or None if the value was not recorded."""
+        return self.properties[property_name]['values'].get((frame, symbol, binding_key(entity_ids)))
+
+    def candidates(self, property_name, frame: int, entity) -> List:
+        """Ids of the entities the symbolic entity could be bound to in the frame."""
+        return self.properties[property_name]['candidates'].get((frame, entity), [])
+
+    def symbol_entities(self, property_name) -> Dict[str, List[str]]:
+        return self.properties[property_name]['symbol_entities']
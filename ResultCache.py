@@ -0,0 +1,75 @@
+import gzip
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Optional
+
+from SymbolicProperty import SymbolicProperty, KEEP_ALL_HISTORY
+
+
+class ResultCache:
+    """
+    Content-addressed cache of the result of checking one property on one route: its violations (as stored by
+    ViolationStore.rows) and its iterations per frame. An entry is keyed by the hash of the route's files, the
+    canonical hash of the property (see SymbolicProperty.canonical_hash) and the monitor options that change results,
+    so editing one property only invalidates the entries of that property. Entries are gzipped JSON files under
+    <cache_dir>/objects; since a key always maps to the same content, several checkers can share a cache.
+    Bump VERSION when the monitor itself changes what it finds.
+    """
+    VERSION = 1
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        self.n_hits = 0
+        self.n_misses = 0
+
+    @staticmethod
+    def route_hash(route_dir: Path) -> str:
+        """Hash of the names and contents of the route's SGs and ego log."""
+        h = hashlib.sha256()
+        files = sorted((route_dir / 'rsv').glob('*.pkl'))
+        if (route_dir / 'ego_logs.json').exists():
+            files.append(route_dir / 'ego_logs.json')
+        for path in files:
+            h.update(path.name.encode())
+            h.update(path.stat().st_size.to_bytes(8, 'little'))
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+        return h.hexdigest()
+
+    @staticmethod
+    def key(route_hash: str, prop: SymbolicProperty, monitor_options: dict) -> str:
+        retention = monitor_options.get('history_retention') or KEEP_ALL_HISTORY
+        options = {
+            # the retained history is part of each violation
+            'history': retention.mode,
+            'history_window': retention.window,
+            'history_spill_dir': str(retention.spill_dir) if retention.spill_dir is not None else None,
+            # retiring instances can drop violations and changes the iterations
+            'gc_absent_frames': monitor_options.get('gc_absent_frames'),
+            'gc_unviolable': monitor_options.get('gc_unviolable', False),
+        }
+        data = [ResultCache.VERSION, route_hash, prop.canonical_hash(), options]
+        return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key) -> Path:
+        return self.cache_dir / 'objects' / key[:2] / f'{key}.json.gz'
+
+    def get(self, key) -> Optional[dict]:
+        path = self._path(key)
+        if not path.exists():
+            self.n_misses += 1
+            return None
+        self.n_hits += 1
+        with gzip.open(path, 'rt') as f:
+            return json.load(f)
+
+    def put(self, key, entry: dict):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with gzip.open(tmp, 'wt') as f:
+            json.dump(entry, f)
+        os.replace(tmp, path)
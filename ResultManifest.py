@@ -0,0 +1,63 @@
+import json
+import os
+from pathlib import Path
+
+
+class ResultManifest:
+    """
+    Remembers what was parsed out of each result file under a results root, kept in <results root>/results_manifest.json.
+    A file is only parsed again if its mtime or size changed; entries of files that were not looked up since the
+    manifest was loaded (e.g. deleted routes) are dropped on save.
+    Parsed values have to be JSON serializable.
+    """
+    FILE_NAME = 'results_manifest.json'
+    VERSION = 1
+
+    def __init__(self, results_root):
+        self.root = Path(results_root)
+        self.path = self.root / ResultManifest.FILE_NAME
+        self.entries = {}
+        if self.path.exists():
+            try:
+                data = json.loads(self.path.read_text())
+                if data.get('version') == ResultManifest.VERSION:
+                    self.entries = data['entries']
+            except ValueError:
+                print(f'Ignoring unreadable manifest {self.path}')
+        self.seen = set()
+        self.n_parsed = 0
+        self.changed = False
+
+    def get(self, path: Path, parse, extra_paths=()):
+        """
+        The parsed contents of path, calling parse(path) only if the file changed since it was last parsed.
+        The files in extra_paths (which may not exist) also invalidate the entry when they change, e.g. a SQLite WAL.
+        """
+        key = str(Path(path).relative_to(self.root))
+        fingerprint = []
+        for p in [path, *extra_paths]:
+            try:
+                stat = os.stat(p)
+                fingerprint.append([stat.st_mtime_ns, stat.st_size])
+            except FileNotFoundError:
+                fingerprint.append(None)
+        self.seen.add(key)
+        entry = self.entries.get(key)
+        if entry is not None and entry['fingerprint'] == fingerprint:
+            return entry['value']
+        value = parse(path)
+        self.entries[key] = {'fingerprint': fingerprint, 'value': value}
+        self.n_parsed += 1
+        self.changed = True
+        return value
+
+    def save(self):
+        stale = [key for key in self.entries if key not in self.seen]
+        for key in stale:
+            del self.entries[key]
+        if not self.changed and len(stale) == 0:
+            return
+        tmp = self.path.with_suffix('.tmp')
+        tmp.write_text(json.dumps({'version': ResultManifest.VERSION, 'entries': self.entries}))
+        os.replace(tmp, self.path)
+        self.changed = False
@@ -0,0 +1,168 @@
+import json
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, Optional
+
+
+class Lease:
+    """
+    A task taken from a RouteQueue. While it is used as a context manager, a thread touches the lease file every
+    heartbeat_interval seconds; if the lease was requeued in the meantime (e.g. because heartbeats stalled),
+    the touch fails and lost is set. Leaving the context with an exception puts the task back into the queue.
+    The lease file is named after the task file plus a token of this lease, so a lease that was lost can never touch
+    or complete the lease another worker took on the same task afterwards.
+    """
+
+    def __init__(self, queue: "RouteQueue", file_name: str, token: str, task: dict):
+        self.queue = queue
+        self.file_name = file_name
+        self.leased_name = f'{file_name}.{token}'
+        self.task = task
+        self.path = queue.leased / self.leased_name
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def renew(self) -> bool:
+        """Touches the lease file, returns whether the lease is still held."""
+        if self.lost:
+            return False
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            self.lost = True
+        return not self.lost
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.queue.heartbeat_interval):
+            if not self.renew():
+                print(f'Lost the lease of {self.file_name}')
+                return
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+        if exc_type is not None and not self.lost:
+            self.queue.requeue(self.leased_name, reason=repr(exc_val))
+        return False
+
+    def complete(self) -> bool:
+        """Marks the task as done if this lease still holds it, returns False if the lease was lost before."""
+        try:
+            os.rename(self.path, self.queue.done / self.file_name)
+        except FileNotFoundError:
+            self.lost = True
+            return False
+        return True
+
+
+class RouteQueue:
+    """
+    Work queue of route checks in a shared directory, so several machines can check the routes of one sweep without
+    any service running. Every task is a JSON file that moves between the pending/, leased/, done/ and failed/
+    subfolders with os.rename, which is atomic, so only one worker gets each task. Tasks are leased in file name order;
+    a leased task's file gets a per-lease token appended to its name.
+    Leases are kept alive by touching the file; a lease not touched for lease_timeout seconds is moved back to pending
+    by whoever notices first (the machines' clocks have to roughly agree), and a task that was requeued max_attempts
+    times goes to failed/.
+    """
+    STATES = ['pending', 'leased', 'done', 'failed']
+
+    def __init__(self, queue_dir, lease_timeout=300, heartbeat_interval=None, max_attempts=3):
+        self.queue_dir = Path(queue_dir)
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = heartbeat_interval if heartbeat_interval is not None else lease_timeout / 4
+        self.max_attempts = max_attempts
+        for state in RouteQueue.STATES + ['tmp']:
+            (self.queue_dir / state).mkdir(parents=True, exist_ok=True)
+
+    @property
+    def pending(self):
+        return self.queue_dir / 'pending'
+
+    @property
+    def leased(self):
+        return self.queue_dir / 'leased'
+
+    @property
+    def done(self):
+        return self.queue_dir / 'done'
+
+    @property
+    def failed(self):
+        return self.queue_dir / 'failed'
+
+    def _write(self, directory: Path, file_name, task):
+        tmp = self.queue_dir / 'tmp' / f'{file_name}.{os.getpid()}'
+        tmp.write_text(json.dumps(task))
+        os.rename(tmp, directory / file_name)
+
+    def enqueue(self, task_id: str, task: dict, priority=0) -> bool:
+        """Adds a task unless a task with this id is already in the queue (in any state). Lower priority goes first."""
+        if any(True for state in RouteQueue.STATES for _ in (self.queue_dir / state).glob(f'*-{task_id}.json*')):
+            return False
+        self._write(self.pending, f'{priority:06d}-{task_id}.json', dict(task, attempts=0))
+        return True
+
+    def lease(self) -> Optional[Lease]:
+        """Takes the first pending task, or returns None if there is none."""
+        for file_name in sorted(os.listdir(self.pending)):
+            token = uuid.uuid4().hex
+            leased = self.leased / f'{file_name}.{token}'
+            try:
+                os.rename(self.pending / file_name, leased)
+            except FileNotFoundError:
+                # another worker was faster
+                continue
+            os.utime(leased)
+            return Lease(self, file_name, token, json.loads(leased.read_text()))
+        return None
+
+    def requeue(self, leased_name, reason=None) -> bool:
+        """
+        Moves a leased task (by the name of its lease file) back to pending, or to failed after max_attempts.
+        Returns False if it is no longer leased.
+        """
+        claimed = self.queue_dir / 'tmp' / leased_name
+        # the task's file name, without the lease token
+        file_name = leased_name.rsplit('.', 1)[0]
+        try:
+            os.rename(self.leased / leased_name, claimed)
+        except FileNotFoundError:
+            return False
+        task = json.loads(claimed.read_text())
+        task['attempts'] += 1
+        if reason is not None:
+            task.setdefault('errors', []).append(reason)
+        self._write(self.failed if task['attempts'] >= self.max_attempts else self.pending, file_name, task)
+        claimed.unlink()
+        return True
+
+    def requeue_stale(self):
+        """Requeues every lease that has not been renewed for lease_timeout seconds, returns their task file names."""
+        stale = []
+        now = time.time()
+        for leased_name in os.listdir(self.leased):
+            try:
+                if now - os.stat(self.leased / leased_name).st_mtime < self.lease_timeout:
+                    continue
+            except FileNotFoundError:
+                continue
+            if self.requeue(leased_name, reason='lease expired'):
+                stale.append(leased_name.rsplit('.', 1)[0])
+        return stale
+
+    def counts(self) -> Dict[str, int]:
+        return {state: len(os.listdir(self.queue_dir / state)) for state in RouteQueue.STATES}
+
+    def is_finished(self) -> bool:
+        counts = self.counts()
+        return counts['pending'] == 0 and counts['leased'] == 0
@@ -27,14 +27,20 @@ def parse_node_set(node_set: node_set_type, sg: nx.DiGraph,
         assert node_set in ["Ego", "G"], f"Invalid node_set string: {node_set}\
             . It must be either 'Ego' or 'G'."
         new_node_set = set()
+        read_set = sg.graph.get('read_set')
         if node_set == "Ego":
             for node in sg.nodes:
                 if node.name == "ego":
                     new_node_set.add(node)
                     break
+            if read_set is not None:
+                read_set.update([(node.get_id(), 'name') for node in new_node_set] if len(new_node_set) > 0
+                                else [utils.NODES_CHANGED])
         elif node_set == "G":
             for node in sg.nodes:
                 new_node_set.add(node)
+            if read_set is not None:
+                read_set.add(utils.NODES_CHANGED)
         return new_node_set
     elif isinstance(node_set, SymbolicEntity):
         return entity_mapping[node_set].get_node(sg)
@@ -71,6 +77,9 @@ def filterByAttr(
         string."
     assert isinstance(filter, str) or callable(filter), f"Invalid filter: \
         {filter}. It must be either a string or a function."
+    read_set = sg.graph.get('read_set')
+    if read_set is not None:
+        read_set.update([(node.get_id(), attr) for node in node_set])
     new_node_set = set()
     for node in node_set:
         if attr != "name" and attr != "base_class":
@@ -107,6 +116,9 @@ def relSet(node_set: node_set_type, rel: str, sg: nx.DiGraph,
     assert edge_type in ["incoming", "outgoing"], f"Invalid edge_type: \
         {edge_type}. It must be either 'incoming' or 'outgoing'. Default: \
         outgoing."
+    read_set = sg.graph.get('read_set')
+    if read_set is not None:
+        read_set.update([node.get_id() for node in node_set])
     new_node_set = set()
     if edge_type == "outgoing":
         get_edges = partial(sg.out_edges, data="label")
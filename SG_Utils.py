@@ -1,5 +1,7 @@
 import pickle
 import os
+import re
+import sys
 import warnings
 from collections import defaultdict
 
@@ -9,11 +11,43 @@ from tqdm import tqdm
 
 ID_ATTR = 'entity_id'
 
+ROAD_CLASSES = {'lane', 'road', 'junction'}
+# (base class, relationship, edge_type) -> base classes reached by following that relationship.
+# These only ever connect road elements to each other, unlike e.g. incoming isIn edges of a lane, which come from the
+# vehicles in it, so anything computed through them depends only on the map.
+STATIC_RELATIONS = {
+    ('lane', 'isIn', 'outgoing'): {'road'},
+    ('road', 'isIn', 'outgoing'): {'junction'},
+    ('road', 'isIn', 'incoming'): {'lane'},
+    ('junction', 'isIn', 'incoming'): {'road'},
+}
+for _rel in ['toLeftOf', 'toRightOf', 'opposes', 'laneChange']:
+    for _edge_type in ['incoming', 'outgoing']:
+        STATIC_RELATIONS[('lane', _rel, _edge_type)] = {'lane'}
+
+def _intern_key(key):
+    return sys.intern(key) if type(key) == str else key
+
+
 class Node:
+    # SGs hold thousands of nodes per frame, so nodes are slotted and their names and attribute keys are interned.
+    # Nodes are shared between frames by NodeInterner, don't modify a node once its SG was passed to a
+    # MissingNodeTracker; create a changed copy instead.
+    __slots__ = ('name', 'base_class', 'attr')
+
     def __init__(self, name, base_class=None, attr=None):
-        self.name = name
-        self.base_class = base_class
-        self.attr = {} if attr is None else dict(attr)
+        self.name = _intern_key(name)
+        self.base_class = _intern_key(base_class)
+        self.attr = {} if attr is None else {_intern_key(key): value for key, value in attr.items()}
+
+    def __getstate__(self):
+        return {'name': self.name, 'base_class': self.base_class, 'attr': self.attr}
+
+    def __setstate__(self, state):
+        # the recorded SGs were pickled from a plain (non-slotted) Node, so the state is its __dict__
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **state[1]}
+        self.__init__(state.get('name'), state.get('base_class'), state.get('attr'))
 
     def __repr__(self):
         return str(self.name)  # name should always be a string anyway, but just to be safe
@@ -93,40 +127,179 @@ def load_sg(sg_file):
     return sg
 
 
-def add_missing(sgs):
-    node_map = defaultdict(list)
-    # node_sets = []
-    # for sg in sgs:
-    #     node_set = set()
-    #     for node in sg.nodes:
-    #         node_set.add(node.get_id())
-    #         node_map[node.get_id()].append(node)
-    #     node_sets.append(node_set)
-    # node_sets = [set([node.get_id() for node in sg.nodes]) for sg in sgs]
-    # union = set.union(*node_sets)
-    union = set()
-    # make sure that all SGs that come later have isolated nodes for any entity that has been seen in the past.
-    static_relationships = defaultdict(set)
-    # for sg in tqdm(sgs, disabled=not print):
-    for sg in sgs:
+def atof(text):
+    try:
+        retval = float(text)
+    except ValueError:
+        retval = text
+    return retval
+
+
+def natural_keys(text):
+    '''
+    alist.sort(key=natural_keys) sorts in human order
+    http://nedbatchelder.com/blog/200712/human_sorting.html
+    (See Toothy's implementation in the comments)
+    float regex comes from https://stackoverflow.com/a/12643073/190597
+    '''
+    return [atof(c) for c in re.split(r'[+-]?([0-9]+(?:[.][0-9]*)?|[.][0-9]+)',
+                                      text)]
+
+
+def route_sg_names(dir_to_check):
+    """File names of a route's SGs (<route>/rsv/*.pkl) in frame order."""
+    return sorted([p for p in os.listdir(dir_to_check / 'rsv') if p.endswith(".pkl")], key=natural_keys)
+
+
+# tokens in a frame delta / read set besides entity ids
+NODES_CHANGED = '__nodes__'  # an entity appeared or disappeared
+STATIC_CHANGED = '__static__'  # the road network grew, see MissingNodeTracker.static_version
+
+
+def values_differ(value1, value2):
+    if value1 is value2:
+        return False
+    try:
+        return bool(value1 != value2)
+    except ValueError:
+        # e.g. array valued attributes that cannot be compared as a whole
+        return True
+
+
+def changed_attrs(attr1, attr2):
+    if attr1 is attr2:
+        return []
+    return [key for key in attr1.keys() | attr2.keys()
+            if key not in attr1 or key not in attr2 or values_differ(attr1[key], attr2[key])]
+
+
+class SceneGraphDiffer:
+    """
+    Computes the delta between consecutive SGs. It holds the ids of the entities that appeared, disappeared or whose
+    edges changed, (id, attribute) pairs for changed attributes (including 'name' and 'base_class'), and
+    NODES_CHANGED / STATIC_CHANGED if the set of entities or the road network changed.
+    Predicates record what they read in the same form (see the read_set in SG_Primitives), so a predicate whose read
+    set does not intersect the delta has the same value as in the previous frame.
+    """
+    def __init__(self):
+        self.prev_nodes = None
+        self.prev_edges = None
+        self.prev_static_version = None
+
+    def diff(self, sg):
+        """Returns the delta from the previous SG passed to diff, or None if there is no previous SG."""
+        nodes = {node.get_id(): node for node in sg.nodes}
+        edges = {(u.get_id(), label, v.get_id()) for u, v, label in sg.edges(data='label')}
+        static_version = sg.graph.get('static_version')
+        delta = None
+        if self.prev_nodes is not None:
+            delta = set()
+            appeared_or_gone = nodes.keys() ^ self.prev_nodes.keys()
+            if len(appeared_or_gone) > 0:
+                delta.add(NODES_CHANGED)
+                delta.update(appeared_or_gone)
+            for node_id, node in nodes.items():
+                prev = self.prev_nodes.get(node_id)
+                if prev is None or prev is node:
+                    continue
+                for attr in ['name', 'base_class']:
+                    if getattr(prev, attr) != getattr(node, attr):
+                        delta.add((node_id, attr))
+                delta.update([(node_id, key) for key in changed_attrs(prev.attr, node.attr)])
+            for uid, _, vid in edges ^ self.prev_edges:
+                delta.add(uid)
+                delta.add(vid)
+            if static_version != self.prev_static_version:
+                delta.add(STATIC_CHANGED)
+        self.prev_nodes = nodes
+        self.prev_edges = edges
+        self.prev_static_version = static_version
+        return delta
+
+
+def inject_ego_log(sg, ego_log):
+    """Overwrite the ego's speed with the value recorded in the ego log, which is more accurate than the SG's."""
+    ego_node = [node for node in sg.nodes if node.name == 'ego'][0]
+    ego_node.attr['carla_speed'] = ego_log['state']['velocity']['value']
+
+
+class NodeInterner:
+    """
+    Shares Node objects between the SGs of one route: a node whose name, class and attributes are the same as the node
+    with its id in the previous SG is replaced by that earlier object, so unchanged entities (the whole road network,
+    parked vehicles, ...) are only stored once and SceneGraphDiffer can skip them by identity.
+    """
+    def __init__(self):
+        self.nodes = {}
+
+    def intern(self, sg):
+        mapping = {}
+        for node in sg.nodes:
+            node_id = node.get_id()
+            prev = self.nodes.get(node_id)
+            if prev is node:
+                continue
+            if prev is not None and prev.name == node.name and prev.base_class == node.base_class \
+                    and len(changed_attrs(prev.attr, node.attr)) == 0:
+                mapping[node] = prev
+            else:
+                self.nodes[node_id] = node
+        if len(mapping) == 0:
+            return
+        # rebuild in place rather than with nx.relabel_nodes to keep the node order, which decides binding order
+        nodes = [(mapping.get(node, node), data) for node, data in sg.nodes(data=True)]
+        edges = [(mapping.get(u, u), mapping.get(v, v), data) for u, v, data in sg.edges(data=True)]
+        graph_attr = dict(sg.graph)
+        sg.clear()
+        sg.graph.update(graph_attr)
+        sg.add_nodes_from(nodes)
+        sg.add_edges_from(edges)
+
+
+class MissingNodeTracker:
+    """
+    Incremental form of add_missing: call add with each SG in order and it will receive isolated PHANTOM nodes for any
+    entity that was seen in an earlier SG, along with the static road relationships of those entities.
+    """
+    def __init__(self):
+        self.interner = NodeInterner()
+        # latest node seen for every id, and the PHANTOM copy made from it
+        self.node_map = {}
+        self.phantoms = {}
+        self.union = set()
+        self.static_relationships = defaultdict(set)
+        # bumped whenever a new road relationship is seen, so results computed from the road network can be reused
+        # for as long as the version stays the same
+        self.static_version = 0
+
+    def add(self, sg):
+        self.interner.intern(sg)
+        node_map = self.node_map
+        static_relationships = self.static_relationships
         node_set = set()
         for node in sg.nodes:
-            node_map[node.get_id()].append(node)
+            node_map[node.get_id()] = node
             node_set.add(node.get_id())
         for (u, v, d) in sg.edges(data=True):
             if u.is_road() and v.is_road():
                 uid = u.get_id()
                 vid = v.get_id()
+                if (uid, vid, d['label']) not in static_relationships[uid]:
+                    self.static_version += 1
                 static_relationships[uid].add((uid, vid, d['label']))
                 static_relationships[vid].add((uid, vid, d['label']))
-        need_to_add = union.difference(node_set)
+        sg.graph['static_version'] = self.static_version
+        need_to_add = self.union.difference(node_set)
         new_node_map = {}
         edges_to_add = set()
         for node_id in need_to_add:
-            node = node_map[node_id][-1]
-            new_node = Node(node.name, node.base_class, node.attr)
-            # mark that this node doesn't actually exist
-            new_node.attr['PHANTOM'] = True
+            node = node_map[node_id]
+            source, new_node = self.phantoms.get(node_id, (None, None))
+            if source is not node:
+                new_node = Node(node.name, node.base_class, node.attr)
+                # mark that this node doesn't actually exist
+                new_node.attr['PHANTOM'] = True
+                self.phantoms[node_id] = (node, new_node)
             new_node_map[node_id] = new_node
             sg.add_node(new_node)
             edges_to_add.update(static_relationships[node_id])
@@ -135,8 +308,14 @@ def add_missing(sgs):
         #     if u.get_id() in need_to_add or v.get_id() in need_to_add:
         for (uid, vid, data) in edges_to_add:
             # either get the new copy or the copy that is in the current graph
-            u = new_node_map[uid] if uid in new_node_map else node_map[uid][-1]
-            v = new_node_map[vid] if vid in new_node_map else node_map[vid][-1]
+            u = new_node_map[uid] if uid in new_node_map else node_map[uid]
+            v = new_node_map[vid] if vid in new_node_map else node_map[vid]
             sg.add_edge(u, v, label=data)
-        union.update(node_set)
+        self.union.update(node_set)
 
+
+def add_missing(sgs):
+    # make sure that all SGs that come later have isolated nodes for any entity that has been seen in the past.
+    tracker = MissingNodeTracker()
+    for sg in sgs:
+        tracker.add(sg)
@@ -34,6 +34,8 @@ class ConcreteEntity(Entity):
         self.entity_id = entity_id
 
     def get_node(self, sg) -> Union[set, "UnboundEntityError"]:
+        if 'read_set' in sg.graph:
+            sg.graph['read_set'].add(self.entity_id)
         # TODO find way to cache this
         for node in sg.nodes:
             # some entities store their unique ID as their name
@@ -58,3 +60,7 @@ class UnboundEntityError(Exception):
         self.entities = list(set(entities))
         super().__init__(f'No entities bound for {[entity.name for entity in self.entities]}')
 
+    def __reduce__(self):
+        # the default would call __init__ with the message
+        return UnboundEntityError, (self.entities,)
+
@@ -1,6 +1,9 @@
+import asyncio
+import io
 import os
-from collections import defaultdict
-from typing import List, Dict
+import zlib
+from collections import defaultdict, Counter
+from typing import List, Dict, Optional
 
 import pandas as pd
 import pickle
@@ -8,10 +11,17 @@ import SG_Primitives as P
 import SG_Utils as utils
 import Property
 from SymbolicEntity import SymbolicEntity, ConcreteEntity
-from SymbolicProperty import ConcreteProperty, SymbolicProperty, UnboundEntityError
+from ViolationWriter import ViolationWriter
+from MonitorProfiler import MonitorProfiler
+from Tracer import NULL_TRACER
+from OutlierProfiler import OutlierProfiler
+from SymbolicProperty import ConcreteProperty, SymbolicProperty, UnboundEntityError, HistoryRetention, \
+    serialize_data, serialize_names, KEEP_ALL_HISTORY
+from ViolationStore import ViolationStore
+from PredicateTrace import PredicateTrace, PredicateTraceRecorder
 from symbolic_properties_ego_only import all_symbolic_properties as ego_all_symbolic_properties
 from symbolic_properties import all_symbolic_properties
-from time import time
+from time import time, time_ns
 from PIL import Image
 from functools import partial
 from pathlib import Path
@@ -21,7 +31,7 @@ import json
 class SymbolicViolation:
     def __init__(self, property_name: str, violation_time, initial_frame,
                  entity_mapping: Dict[SymbolicEntity, ConcreteEntity],
-                 data_history, name_history, frames, ego_id):
+                 data_history, name_history, frames, ego_id, spilled=None, step=None):
         self.property_name = property_name
         self.violation_time = violation_time
         self.entity_mapping = entity_mapping
@@ -30,41 +40,89 @@ class SymbolicViolation:
         self.name_history = name_history
         self.frames = frames
         self.ego_id = ego_id
+        self.spilled = spilled if spilled is not None else []
+        self.step = step
 
-    def to_json(self, save_file):
-        data = {
+    def to_dict(self):
+        return {
             'entity_mapping': {symbolic_entity.name: concrete_entity.entity_id if concrete_entity is not None else None
                                for symbolic_entity, concrete_entity in self.entity_mapping.items()},
             'violation_time': self.violation_time,
             'initial_frame': self.initial_frame,
             'ego_id': self.ego_id,
-            'name_history': [(frame, {symbolic_entity.name: name
-                                      for symbolic_entity, name in names.items()})
+            'name_history': [(frame, serialize_names(names))
                              for frame, names in self.name_history.items()],
-            'data_history': [(frame, {k: v if type(v) != UnboundEntityError else None for k, v in hist.items()})
-                             for frame, hist in self.data_history.items()]
+            'data_history': [(frame, serialize_data(hist))
+                             for frame, hist in self.data_history.items()],
+            # history evicted from memory by the HistoryRetention policy, see read_spilled_history
+            'spilled_history': [(str(spill_file), n_lines) for spill_file, n_lines in self.spilled]
         }
+
+    def to_json(self, save_file):
         with open(save_file, 'w') as f:
-            json.dump(data, f)
+            json.dump(self.to_dict(), f)
 
-class SymbolicMonitor:
-    def __new__(cls, *args, **kwargs):
-        if (len(args) > 0 or len(kwargs) > 0) and hasattr(cls,
-                                                          'monitor_instance'):
-            del cls.monitor_instance
 
-        if not hasattr(cls, 'monitor_instance'):
-            cls.monitor_instance = super(SymbolicMonitor, cls).__new__(cls)
-            cls.monitor_instance.initialize(*args, **kwargs)
-        return cls.monitor_instance
+class FrameVerdict:
+    """The outcome of feeding a single scene graph to the monitor."""
+    def __init__(self, frame, step, latency_ns, violations: List[SymbolicViolation], live_instances):
+        self.frame = frame
+        self.step = step
+        # time from receiving the SG to producing the verdict, including phantom and ego log handling
+        self.latency_ns = latency_ns
+        self.violations = violations
+        self.live_instances = live_instances
 
-    def initialize(self, log_path, route_path, ego_only=False, phi=-1):
-        properties = ego_all_symbolic_properties if ego_only else all_symbolic_properties
-        if phi >= 0:  # if phi >=0, it is an index
-            properties = [properties[phi]]
+    def is_violation(self):
+        return len(self.violations) > 0
+
+    def __repr__(self):
+        return f'FrameVerdict(frame={self.frame}, violations={len(self.violations)}, latency={self.latency_ns / 1e6:.2f}ms)'
+
+
+async def _as_async_iterable(frames):
+    if hasattr(frames, '__aiter__'):
+        async for frame in frames:
+            yield frame
+    else:
+        for frame in frames:
+            yield frame
+
+
+class _CheckpointPickler(pickle.Pickler):
+    """Pickles objects in shared (by identity) as their key, see SymbolicMonitor.shared_objects."""
+    def __init__(self, file, shared):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.shared_keys = {id(obj): key for key, obj in shared.items()}
+
+    def persistent_id(self, obj):
+        return self.shared_keys.get(id(obj))
+
+
+class _CheckpointUnpickler(pickle.Unpickler):
+    def __init__(self, file, shared):
+        super().__init__(file)
+        self.shared = shared
+
+    def persistent_load(self, key):
+        return self.shared[key]
+
+
+class SymbolicMonitor:
+    CHECKPOINT_VERSION = 3
+
+    def __init__(self, log_path, route_path, ego_only=False, phi=-1, history_retention: HistoryRetention = None,
+                 incremental=False, gc_absent_frames=None, gc_unviolable=False, profile=False,
+                 tracer=None, outlier_threshold_ms=None, outlier_mode='sample',
+                 properties: Optional[List[SymbolicProperty]] = None, predicate_trace=False, clear_results=True):
+        # properties, if given, replaces the ones selected by ego_only and phi
+        # clear_results=False keeps the rows an earlier check of this route left in the violation store
+        if properties is None:
+            properties = SymbolicMonitor.select_properties(ego_only, phi)
         self.symbolic_properties: List[SymbolicProperty] = properties
         self.concrete_properties: List[ConcreteProperty] = []
         self.previous_concrete = []
+        self.history_retention = history_retention
         self.timestep = 0
 
         self.violations = defaultdict(list)
@@ -77,6 +135,44 @@ class SymbolicMonitor:
         self.route_path = self.log_path / route_path
         self.route_path.mkdir(parents=True, exist_ok=True)
         self.iterations_per_frame = {}
+        # spans for a trace viewer, see Tracer; the caller owns the tracer and closes it
+        self.tracer = tracer if tracer is not None else NULL_TRACER
+        # this check replaces the route's earlier violations of these properties, e.g. those of a previous run
+        if clear_results and ViolationStore.exists(self.log_path):
+            store = ViolationStore(self.log_path)
+            store.clear(self.route_path.name, [prop.name for prop in self.symbolic_properties])
+            store.close()
+        self.violation_writer = ViolationWriter(self.log_path, self.route_path.name, tracer=self.tracer)
+        # phantom node state for SGs that are fed one at a time
+        self.missing_tracker = utils.MissingNodeTracker()
+        # values of predicate subtrees that only depend on the road network, valid while the network is unchanged
+        self.static_cache = {}
+        self.static_version = None
+        # predicate values of the previous frame, reused when nothing they read changed (see SceneGraphDiffer)
+        self.incremental = incremental
+        self.differ = utils.SceneGraphDiffer()
+        self.predicate_memo = {}
+        # instance lifecycle: retire instances bound to an entity that has not really been observed (i.e. only as a
+        # PHANTOM) for more than gc_absent_frames frames, and/or instances whose DFA can no longer reach a violation
+        self.gc_absent_frames = gc_absent_frames
+        self.gc_unviolable = gc_unviolable
+        self.last_seen = {}
+        self.gc_stats = defaultdict(Counter)
+        self.profiler = MonitorProfiler() if profile else None
+        # keeps a full profile of the frames that take longer than outlier_threshold_ms
+        self.outlier_profiler = None
+        if outlier_threshold_ms is not None:
+            self.outlier_profiler = OutlierProfiler(self.log_path / 'outlier_profiles', self.route_path.name,
+                                                    threshold_ms=outlier_threshold_ms, mode=outlier_mode)
+        # value of every predicate per binding and frame, for checking other formulas without the SGs
+        self.predicate_trace = PredicateTraceRecorder(self.symbolic_properties) if predicate_trace else None
+
+    @staticmethod
+    def select_properties(ego_only=False, phi=-1) -> List[SymbolicProperty]:
+        properties = ego_all_symbolic_properties if ego_only else all_symbolic_properties
+        if phi >= 0:  # if phi >=0, it is an index
+            properties = [properties[phi]]
+        return properties
 
     # def hard_reset(self):
     #     """
@@ -89,7 +185,39 @@ class SymbolicMonitor:
     #     self.previous_concrete = []
     #     self.violations.clear()
 
-    def check(self, sg, save_usage_information=False):
+    def check(self, sg, save_usage_information=False) -> List[SymbolicViolation]:
+        """
+        Steps every live property instance over the SG and returns the violations found in this frame.
+        The SG must already have its frame name, cache and phantom nodes set up, see feed for SGs arriving online.
+        """
+        with self.tracer.span('check', frame=sg.graph['frame']):
+            if self.outlier_profiler is None:
+                return self.__check(sg)
+            with self.outlier_profiler.frame(sg.graph['frame']):
+                return self.__check(sg)
+
+    def __check(self, sg) -> List[SymbolicViolation]:
+        check_start = time_ns()
+        new_violations = []
+        if self.profiler is not None:
+            sg.graph['profiler'] = self.profiler
+        if self.predicate_trace is not None:
+            self.predicate_trace.frame(sg)
+            sg.graph['predicate_trace'] = self.predicate_trace
+        if 'static_version' in sg.graph:
+            if sg.graph['static_version'] != self.static_version:
+                self.static_cache = {}
+                self.static_version = sg.graph['static_version']
+            sg.graph['static_cache'] = self.static_cache
+        if self.incremental:
+            sg.graph['delta'] = self.differ.diff(sg)
+            sg.graph['previous_memo'] = self.predicate_memo
+            self.predicate_memo = {}
+            sg.graph['memo'] = self.predicate_memo
+        if self.gc_absent_frames is not None:
+            for node in sg.nodes:
+                if not node.is_phantom():
+                    self.last_seen[node.get_id()] = self.timestep
         if self.ego_id is None:
             for node in sg.nodes:
                 if 'ego' == node.name:
@@ -101,7 +229,12 @@ class SymbolicMonitor:
         # for concrete_prop in self.concrete_properties:
         #     additional_concrete = concrete_prop.additional_concrete(sg)
         # self.concrete_properties.extend(additional_concrete)
-        self.concrete_properties.extend([symbolic_prop.make_blank(sg) for symbolic_prop in self.symbolic_properties])
+        self.concrete_properties.extend([symbolic_prop.make_blank(sg, retention=self.history_retention,
+                                                                 spill_sink=self.violation_writer)
+                                         for symbolic_prop in self.symbolic_properties])
+        if self.profiler is not None:
+            for symbolic_prop in self.symbolic_properties:
+                self.profiler.spawned(symbolic_prop.name, 1, 'blank')
         to_keep = []
         to_check = self.concrete_properties
         iterations = defaultdict(int)
@@ -112,9 +245,13 @@ class SymbolicMonitor:
             concrete_prop.undef = []
             prev_state = concrete_prop.get_current_state()
             try:
-                concrete_prop.step(sg)
+                with self.tracer.span('step', property=concrete_prop.name, frame=sg.graph['frame']):
+                    concrete_prop.step(sg)
                 if concrete_prop.is_trap():
                     self.previous_concrete.append(concrete_prop)
+                    if self.profiler is not None:
+                        self.profiler.retired(concrete_prop.name,
+                                              'satisfied' if concrete_prop.is_accepting() else 'violated')
                     if not concrete_prop.is_accepting():
                         violation = SymbolicViolation(concrete_prop.name,
                                                       sg.graph['frame'],
@@ -123,25 +260,187 @@ class SymbolicMonitor:
                                                       concrete_prop.data_history,
                                                       concrete_prop.name_history,
                                                       concrete_prop.frames,
-                                                      self.ego_id)
-                        save_dir = self.route_path / concrete_prop.name / 'violations/'
-                        save_dir.mkdir(parents=True, exist_ok=True)
-                        save_file = save_dir / f'{violation.violation_time}.json'
-                        violation.to_json(save_file)
+                                                      self.ego_id,
+                                                      concrete_prop.spilled,
+                                                      self.timestep)
+                        # written on a background thread to keep file I/O out of the frame time
+                        self.violation_writer.put(violation)
                         self.violations[concrete_prop.name].append(violation)
+                        new_violations.append(violation)
                 else:
-                    to_keep.append(concrete_prop)
+                    retire_reason = self.retire_reason(concrete_prop)
+                    if retire_reason is None:
+                        to_keep.append(concrete_prop)
+                    else:
+                        self.gc_stats[concrete_prop.name][retire_reason] += 1
+                        if self.profiler is not None:
+                            self.profiler.retired(concrete_prop.name, retire_reason)
                 # handle undefs that were encountered
                 if len(concrete_prop.undef) > 0:
                     concrete_prop.undef = list(set(concrete_prop.undef))  # remove dupes
-                    extensions = concrete_prop.additional_concrete_specific(sg, concrete_prop.undef, include_none=False, current_state=prev_state)
-                    to_check.extend(extensions)
+                    to_check.extend(self.expand(concrete_prop, sg, concrete_prop.undef, prev_state))
             except UnboundEntityError as e:
-                extensions = concrete_prop.additional_concrete_specific(sg, e.entities, include_none=False, current_state=prev_state)
-                to_check.extend(extensions)
+                to_check.extend(self.expand(concrete_prop, sg, e.entities, prev_state))
         self.concrete_properties = to_keep
+        # the SG may be kept by the caller, don't let it hold on to the memos
+        for key in ['delta', 'memo', 'previous_memo', 'profiler', 'predicate_trace']:
+            sg.graph.pop(key, None)
         self.iterations_per_frame[sg.graph['frame']] = iterations
         self.timestep += 1
+        if self.profiler is not None:
+            self.profiler.frame(time_ns() - check_start)
+        return new_violations
+
+    def expand(self, concrete_prop: ConcreteProperty, sg, entities, prev_state) -> List[ConcreteProperty]:
+        """Binds the given unbound entities of an instance to every matching entity in the SG."""
+        start = time_ns()
+        with self.tracer.span('expand', property=concrete_prop.name, frame=sg.graph['frame']):
+            extensions = concrete_prop.additional_concrete_specific(sg, entities, include_none=False,
+                                                                    current_state=prev_state)
+        if self.profiler is None:
+            return extensions
+        self.profiler.expansion(concrete_prop.name, time_ns() - start)
+        self.profiler.spawned(concrete_prop.name, len(extensions), 'expansion')
+        return extensions
+
+    def retire_reason(self, concrete_prop: ConcreteProperty) -> Optional[str]:
+        """
+        Returns why a live (non-trapped) instance can be dropped, or None if it must keep stepping.
+        Extensions of the instance are created from its state before the step, so they are not affected.
+        """
+        if self.gc_unviolable and not concrete_prop.dfa_view.can_violate():
+            return 'unviolable'
+        if self.gc_absent_frames is not None:
+            for concrete_entity in concrete_prop.entity_mapping.values():
+                if concrete_entity is None:
+                    continue
+                last_seen = self.last_seen.get(concrete_entity.entity_id, self.timestep)
+                if self.timestep - last_seen > self.gc_absent_frames:
+                    # dropped without a verdict, as if the route ended here: a rejecting state is not a trap, so it
+                    # is not a violation (yet), and the instance could still have trapped on a later frame
+                    return 'absent_accepting' if concrete_prop.is_accepting() else 'absent_rejecting'
+        return None
+
+    def feed(self, sg, ego_log=None) -> FrameVerdict:
+        """
+        Checks a single SG as it is produced, e.g. by a running simulator.
+        The SG is prepared the same way as in the offline checker: it gets a frame name (the step number unless one is
+        already set) and a fresh cache, the ego's speed is taken from ego_log if given, and phantom nodes are added for
+        entities that were seen in earlier frames but are missing from this one.
+        """
+        start = time_ns()
+        if 'frame' not in sg.graph:
+            sg.graph['frame'] = str(self.timestep)
+        sg.graph['cache'] = {}
+        if ego_log is not None:
+            with self.tracer.span('ego_log', frame=sg.graph['frame']):
+                utils.inject_ego_log(sg, ego_log)
+        with self.tracer.span('add_missing', frame=sg.graph['frame']):
+            self.missing_tracker.add(sg)
+        violations = self.check(sg)
+        return FrameVerdict(sg.graph['frame'], self.timestep - 1, time_ns() - start, violations,
+                            len(self.concrete_properties))
+
+    async def stream(self, frames):
+        """
+        Feeds SGs from a sync or async iterable and yields a FrameVerdict as soon as each one has been checked.
+        Items may be SGs or (SG, ego log record) tuples. Frames are checked in the default executor so that the event
+        loop, e.g. the one receiving frames from the simulator, is not blocked while properties are evaluated.
+        """
+        loop = asyncio.get_running_loop()
+        async for frame in _as_async_iterable(frames):
+            sg, ego_log = frame if isinstance(frame, tuple) else (frame, None)
+            yield await loop.run_in_executor(None, self.feed, sg, ego_log)
+
+    def shared_objects(self):
+        """
+        Objects that belong to the symbolic properties rather than to this run (DFAs, predicates, symbolic entities)
+        or to the monitor's configuration. Checkpoints refer to them by key, which keeps them small and lets them hold
+        predicates that cannot be pickled, e.g. lambdas.
+        """
+        shared = {('retention', 'all'): KEEP_ALL_HISTORY}
+        if self.history_retention is not None:
+            shared[('retention', 'monitor')] = self.history_retention
+        # evicted history is written with the violations, off the frame loop
+        shared[('spill_sink',)] = self.violation_writer
+        for prop in self.symbolic_properties:
+            shared[('property', prop.name)] = prop
+            shared[('dfa', prop.name)] = prop.ltldfa
+            shared[('predicates', prop.name)] = prop.predicates
+            shared[('symbol_to_entities', prop.name)] = prop.symbol_to_entities
+            shared[('static_subtrees', prop.name)] = prop.static_subtrees
+            for entity in prop.symbolic_entities:
+                shared[('entity', prop.name, entity.name)] = entity
+        return shared
+
+    def save_checkpoint(self, path, **extra):
+        """
+        Writes everything needed to continue this run with load_checkpoint: the live instances (DFA states, bindings
+        and retained history), the violations so far, the phantom node state, counters and the given extra values.
+        Caches (static, incremental memo) are not saved, they are rebuilt on the next frame.
+        Violations and spilled history still queued are written first, so the checkpoint never points at history that
+        is not on disk.
+        """
+        self.violation_writer.flush()
+        state = {
+            'version': SymbolicMonitor.CHECKPOINT_VERSION,
+            'properties': [prop.name for prop in self.symbolic_properties],
+            'timestep': self.timestep,
+            'ego_id': self.ego_id,
+            'concrete_properties': self.concrete_properties,
+            'violations': dict(self.violations),
+            'iterations_per_frame': self.iterations_per_frame,
+            'missing_tracker': self.missing_tracker,
+            'last_seen': self.last_seen,
+            'gc_stats': self.gc_stats,
+            'profiler': self.profiler,
+            'predicate_trace': self.predicate_trace,
+            'extra': extra,
+        }
+        buffer = io.BytesIO()
+        _CheckpointPickler(buffer, self.shared_objects()).dump(state)
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + '.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(zlib.compress(buffer.getvalue(), 1))
+        os.replace(tmp, path)
+
+    def load_checkpoint(self, path) -> dict:
+        """
+        Continues from a checkpoint written by save_checkpoint of a monitor with the same properties and returns the
+        extra values saved with it. The route's violations of these properties were cleared when this monitor was
+        created, the ones found before the checkpoint are stored again and the later ones will be found again.
+        """
+        with open(path, 'rb') as f:
+            data = zlib.decompress(f.read())
+        state = _CheckpointUnpickler(io.BytesIO(data), self.shared_objects()).load()
+        if state['version'] != SymbolicMonitor.CHECKPOINT_VERSION:
+            raise ValueError(f'{path} has checkpoint version {state["version"]}, '
+                             f'expected {SymbolicMonitor.CHECKPOINT_VERSION}')
+        properties = [prop.name for prop in self.symbolic_properties]
+        if state['properties'] != properties:
+            raise ValueError(f'{path} was written by a monitor of {state["properties"]}, not {properties}')
+        self.timestep = state['timestep']
+        self.ego_id = state['ego_id']
+        self.concrete_properties = state['concrete_properties']
+        self.violations = defaultdict(list, state['violations'])
+        self.iterations_per_frame = state['iterations_per_frame']
+        self.missing_tracker = state['missing_tracker']
+        self.last_seen = state['last_seen']
+        self.gc_stats = state['gc_stats']
+        if self.profiler is not None and state['profiler'] is not None:
+            self.profiler = state['profiler']
+        if self.predicate_trace is not None and state.get('predicate_trace') is not None:
+            self.predicate_trace = state['predicate_trace']
+        self.static_cache = {}
+        self.static_version = None
+        self.differ = utils.SceneGraphDiffer()
+        self.predicate_memo = {}
+        for violations in self.violations.values():
+            for violation in violations:
+                self.violation_writer.put(violation)
+        return state['extra']
 
     def save_final_output(self):
         # for symbolic_prop in self.symbolic_properties:
@@ -149,9 +448,19 @@ class SymbolicMonitor:
         self.route_path.mkdir(parents=True, exist_ok=True)
         with open(save_file, 'w') as f:
             json.dump(self.iterations_per_frame, f)
-        for prop_name, violations in self.violations.items():
-            save_dir = self.route_path/prop_name/'violations/'
-            save_dir.mkdir(parents=True, exist_ok=True)
-            for violation in violations:
-                save_file = save_dir/f'{violation.violation_time}.json'
-                violation.to_json(save_file)
+        if self.gc_absent_frames is not None or self.gc_unviolable:
+            with open(self.route_path/'gc_stats.json', 'w') as f:
+                json.dump({'gc_absent_frames': self.gc_absent_frames,
+                           'gc_unviolable': self.gc_unviolable,
+                           'retired': self.gc_stats}, f, indent=2)
+        if self.profiler is not None:
+            self.profiler.save(self.route_path/'profile.json')
+        if self.predicate_trace is not None:
+            self.predicate_trace.ego_id = self.ego_id
+            self.predicate_trace.save(self.route_path/PredicateTrace.FILE_NAME)
+        if self.outlier_profiler is not None:
+            self.outlier_profiler.close()
+            with open(self.route_path/'outlier_profiles.json', 'w') as f:
+                json.dump(self.outlier_profiler.saved, f, indent=2)
+        # violations and spilled history were already queued as they were found, wait for them to be written
+        self.violation_writer.close()
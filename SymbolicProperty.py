@@ -1,5 +1,11 @@
 import copy
+import hashlib
 import itertools
+import json
+import time
+import types
+import uuid
+from pathlib import Path
 from typing import Dict, List, Union, Tuple, Any, Optional
 
 import sympy
@@ -12,6 +18,7 @@ import networkx as nx
 
 from Property import predicate_type, predicate_type_dict
 from SymbolicEntity import SymbolicEntity, ConcreteEntity, ID_ATTR, UnboundEntityError
+import SG_Utils as utils
 
 
 def valid_mapping(node_mapping_list):
@@ -57,6 +64,183 @@ def get_symbolic_entities(predicate):
     return symbolic_entities
 
 
+def uses_defined(predicate):
+    """Whether the predicate checks if a symbolic entity is bound, which depends on when the monitor binds it."""
+    if not isinstance(predicate, partial):
+        return False
+    if predicate.func.__name__ == 'defined':
+        return True
+    return any(uses_defined(arg) for arg in predicate.args)
+
+
+STATIC_SET_OPS = ['union', 'intersection', 'difference', 'symmetric_difference']
+STATIC_SCALAR_OPS = ['size', 'lt', 'gt', 'le', 'ge', 'eq', 'ne', 'logic_or', 'logic_and', 'logic_implies',
+                     'logic_xor', 'logic_not', 'boolean_equals', 'defined']
+
+
+def static_classes(arg):
+    """
+    Determines whether a predicate argument only depends on the road network, which does not change during a route.
+    :return: the base classes of the nodes it can evaluate to if it is a static set, 'scalar' if it is a static value,
+        or None if it depends on the parts of the SG that change from frame to frame.
+    """
+    if isinstance(arg, SymbolicEntity):
+        if type(arg.base_filter) == list and set(arg.base_filter) <= utils.ROAD_CLASSES:
+            return frozenset(arg.base_filter)
+        return None
+    if isinstance(arg, (str, set)):
+        # "G" and "Ego" refer to the whole graph or the ego vehicle
+        return None
+    if not isinstance(arg, partial):
+        return 'scalar'
+    func_name = arg.func.__name__
+    if func_name == 'relSet':
+        if len(arg.args) != 2:
+            return None
+        classes = static_classes(arg.args[0])
+        if not isinstance(classes, frozenset):
+            return None
+        edge_type = arg.keywords.get('edge_type', 'outgoing')
+        reachable = set()
+        for base_class in classes:
+            if (base_class, arg.args[1], edge_type) not in utils.STATIC_RELATIONS:
+                return None
+            reachable.update(utils.STATIC_RELATIONS[(base_class, arg.args[1], edge_type)])
+        return frozenset(reachable)
+    if len(arg.keywords) > 0:
+        return None
+    arg_classes = [static_classes(a) for a in arg.args]
+    if any(c is None for c in arg_classes):
+        return None
+    if func_name in STATIC_SET_OPS:
+        if any(not isinstance(c, frozenset) for c in arg_classes):
+            return None
+        return frozenset().union(*arg_classes)
+    if func_name in STATIC_SCALAR_OPS:
+        return 'scalar'
+    if func_name == 'ite' and all(c == 'scalar' for c in arg_classes[1:]):
+        return 'scalar'
+    # filterByAttr reads attributes, which may change
+    return None
+
+
+def find_static_subtrees(predicate, found=None):
+    """
+    Finds the largest subtrees of the predicate that evaluate to a value (not a set of nodes, since those are
+    different objects in every frame) using only the road network.
+    :return: dict from each such subtree to the symbolic entities it depends on
+    """
+    if found is None:
+        found = {}
+    if not isinstance(predicate, partial):
+        return found
+    if predicate.func.__name__ != 'defined' and static_classes(predicate) == 'scalar':
+        found[predicate] = sorted(list(get_symbolic_entities(predicate)), key=lambda x: x.name)
+        return found
+    for arg in predicate.args:
+        find_static_subtrees(arg, found)
+    return found
+
+
+def canonical_form(obj):
+    """
+    A JSON serializable description of a predicate (or any part of one) that only changes when what it computes may
+    change: partials are described by their function and arguments, functions (including lambdas) by their name, their
+    bytecode and the constants they read from their module, and symbolic entities by their name and base filter.
+    Functions called by the functions in the tree are only described by name.
+    """
+    if isinstance(obj, partial):
+        return ['partial', canonical_form(obj.func), [canonical_form(arg) for arg in obj.args],
+                sorted([key, canonical_form(value)] for key, value in obj.keywords.items())]
+    if isinstance(obj, SymbolicEntity):
+        return ['entity', obj.name, canonical_form(obj.base_filter)]
+    if isinstance(obj, types.FunctionType):
+        code = obj.__code__
+        # e.g. a threshold like STOPPED_SPEED, which is not part of the bytecode
+        constants = sorted([name, canonical_form(obj.__globals__[name])] for name in code.co_names
+                           if isinstance(obj.__globals__.get(name), (bool, int, float, str, tuple, list, frozenset)))
+        closure = [canonical_form(cell.cell_contents) for cell in obj.__closure__ or []]
+        return ['function', obj.__module__, obj.__qualname__, canonical_form(code), constants, closure,
+                canonical_form(obj.__defaults__)]
+    if isinstance(obj, types.CodeType):
+        return ['code', obj.co_code.hex(), [canonical_form(const) for const in obj.co_consts], list(obj.co_names)]
+    if isinstance(obj, (types.BuiltinFunctionType, type)):
+        return ['builtin', obj.__module__, obj.__qualname__]
+    if isinstance(obj, (list, tuple)):
+        return [type(obj).__name__, [canonical_form(item) for item in obj]]
+    if isinstance(obj, (set, frozenset)):
+        return ['set', sorted((canonical_form(item) for item in obj), key=json.dumps)]
+    if isinstance(obj, dict):
+        return ['dict', sorted(([canonical_form(key), canonical_form(value)] for key, value in obj.items()),
+                               key=json.dumps)]
+    if obj is None or isinstance(obj, (bool, int, str)):
+        return obj
+    if isinstance(obj, float):
+        return ['float', repr(obj)]
+    if isinstance(obj, bytes):
+        return ['bytes', obj.hex()]
+    return [type(obj).__qualname__, repr(obj)]
+
+
+def serialize_data(data_dict):
+    return {k: v if type(v) != UnboundEntityError else None for k, v in data_dict.items()}
+
+
+def serialize_names(name_dict):
+    return {symbolic_entity.name: name for symbolic_entity, name in name_dict.items()}
+
+
+def read_spilled_history(spilled):
+    """Reads back the history evicted by HistoryRetention, oldest first.
+    :param spilled: list of [spill_file, n_lines] segments as stored in ConcreteProperty.spilled
+    :return: list of (frame, data, names) tuples
+    """
+    history = []
+    for spill_file, n_lines in spilled:
+        with open(spill_file) as f:
+            for _, line in zip(range(n_lines), f):
+                entry = json.loads(line)
+                history.append((entry['frame'], entry['data'], entry['names']))
+    return history
+
+
+def write_spill(spill_file, evicted):
+    """Appends (frame, data, names) tuples evicted from a property's history to its spill file."""
+    spill_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(spill_file, 'a') as f:
+        for frame, data_dict, name_dict in evicted:
+            f.write(json.dumps({'frame': frame,
+                                'data': serialize_data(data_dict),
+                                'names': serialize_names(name_dict)}) + '\n')
+
+
+class HistoryRetention:
+    """
+    Controls how much per-frame history a ConcreteProperty keeps in memory.
+    'all' keeps every frame since the property was created, 'window' keeps the last `window` frames and
+    'state_change' keeps the frames since the last DFA state change.
+    If spill_dir is set, evicted frames are appended to a JSON lines file under spill_dir so they can still be
+    retrieved with read_spilled_history. The policy is only configuration and can be shared by several monitors;
+    each ConcreteProperty writes its spill files through its own spill_sink.
+    """
+    MODES = ['all', 'window', 'state_change']
+
+    def __init__(self, mode='all', window=None, spill_dir=None):
+        if mode not in HistoryRetention.MODES:
+            raise ValueError(f'Unknown history retention mode {mode}, must be one of {HistoryRetention.MODES}')
+        if mode == 'window' and (window is None or window < 1):
+            raise ValueError('The window retention mode requires a window of at least 1 frame')
+        self.mode = mode
+        self.window = window
+        self.spill_dir = Path(spill_dir) if spill_dir is not None else None
+
+    def new_spill_file(self, property_name) -> Path:
+        return self.spill_dir / property_name / f'{uuid.uuid4().hex}.jsonl'
+
+
+KEEP_ALL_HISTORY = HistoryRetention()
+
+
 class SymbolicProperty:
     def __init__(self,
                  property_name: str,
@@ -64,6 +248,7 @@ class SymbolicProperty:
                  predicates: predicate_type,
                  symbolic_entities: List[SymbolicEntity]):
         self.name = property_name
+        self.formula = property_string
         self.ltldfa = LTLfDFA(property_string)
         needed_symbols = set(self.ltldfa.symbols)
         self.predicates = {pred[0]: pred[1] for pred in predicates}
@@ -78,16 +263,31 @@ class SymbolicProperty:
         for symbol, predicate in self.predicates.items():
             entity_list = sorted(list(get_symbolic_entities(predicate)), key=lambda x: x.name)
             self.symbol_to_entities[symbol] = entity_list
+        # parts of the predicates that only depend on the road network are evaluated once per route
+        self.static_subtrees = {}
+        for predicate in self.predicates.values():
+            find_static_subtrees(predicate, self.static_subtrees)
 
-    def make_blank(self, sg) -> "ConcreteProperty":
+    def canonical_hash(self) -> str:
+        """Changes whenever the name, formula, predicates or symbolic entities of the property change."""
+        form = [self.name, self.formula,
+                [[symbol, canonical_form(predicate)] for symbol, predicate in sorted(self.predicates.items())],
+                [canonical_form(entity) for entity in self.symbolic_entities]]
+        return hashlib.sha256(json.dumps(form).encode()).hexdigest()
+
+    def make_blank(self, sg, retention: HistoryRetention = None, spill_sink=None) -> "ConcreteProperty":
         return ConcreteProperty(self.name,
                                 self.ltldfa,
                                 self.predicates,
                                 sg.graph['frame'],
                                 {symbolic_entity: None for symbolic_entity in self.symbolic_entities},
-                                self.symbol_to_entities)
+                                self.symbol_to_entities,
+                                retention=retention,
+                                static_subtrees=self.static_subtrees,
+                                spill_sink=spill_sink)
 
-    def make_concrete(self, sg: nx.DiGraph) -> List["ConcreteProperty"]:
+    def make_concrete(self, sg: nx.DiGraph, retention: HistoryRetention = None,
+                      spill_sink=None) -> List["ConcreteProperty"]:
         # possible_mappings: List[List[ConcreteEntity]] = []
         # for symbolic_entity in self.symbolic_entities:
         #     possible = [node.get_id() for node in sg.nodes if symbolic_entity.is_valid(node)]
@@ -102,23 +302,34 @@ class SymbolicProperty:
             return []
         return [ConcreteProperty(self.name, self.ltldfa,
                                  self.predicates, sg.graph['frame'],
-                                 possible_mapping, self.symbol_to_entities)
+                                 possible_mapping, self.symbol_to_entities,
+                                 retention=retention, static_subtrees=self.static_subtrees,
+                                 spill_sink=spill_sink)
                 for possible_mapping in possible_mappings]
 
 
 class ConcreteProperty:
     def __init__(self, name, ltlfdfa: LTLfDFA, predicates: predicate_type_dict, frame,
                  entity_mapping: Dict[SymbolicEntity, Union[ConcreteEntity, None]],
-                 symbol_to_sym, current_state=None):
+                 symbol_to_sym, current_state=None, retention: HistoryRetention = None, static_subtrees=None,
+                 spill_sink=None):
         self.name = name
         self.dfa_view = DFAView(ltlfdfa, current_state=current_state)
         self.predicates = predicates
         self.initial_frame = frame
         self.symbol_to_sym = symbol_to_sym
         self.entity_mapping = entity_mapping
+        self.static_subtrees = static_subtrees if static_subtrees is not None else {}
         self.data_history = {}
         self.name_history = {}
         self.frames = []
+        self.retention = retention if retention is not None else KEEP_ALL_HISTORY
+        # object with a put_spill(spill_file, evicted) method, e.g. the monitor's ViolationWriter, that writes the
+        # evicted history off the frame loop; if None the history is written right away
+        self.spill_sink = spill_sink
+        # [spill_file, n_lines] segments holding the history evicted from memory, oldest first
+        self.spilled = []
+        self._spill_file = None
         self.undef = []
         self.cache_key = {}
         for symbol, entity_list in self.symbol_to_sym.items():
@@ -139,6 +350,8 @@ class ConcreteProperty:
         if func_chain is None:
             func_chain = ''
         func_chain += '.' + predicate.func.__name__
+        if 'profiler' in sg.graph:
+            sg.graph['profiler'].primitive(predicate.func.__name__)
         if predicate.func.__name__ in ['defined']:
             # WLOG you can only check if a single symbolic variable is defined
             if len(predicate.args) != 1:
@@ -148,6 +361,13 @@ class ConcreteProperty:
             if not defined:
                 self.undef.append(var)
             return defined
+        static_key = self.__static_key(predicate, sg)
+        if static_key is not None and static_key in sg.graph['static_cache']:
+            if 'read_set' in sg.graph:
+                sg.graph['read_set'].add(utils.STATIC_CHANGED)
+            if 'profiler' in sg.graph:
+                sg.graph['profiler'].cache_event(self.name, 'static_hit')
+            return sg.graph['static_cache'][static_key]
         param_list = []
         # local_undef = []
         for arg in predicate.args:
@@ -169,9 +389,52 @@ class ConcreteProperty:
         # if len(local_undef) > 0:
         #     return UnboundEntityError(local_undef)
         if predicate.func.__name__ in ['filterByAttr', 'relSet']:
-            return predicate.func(*param_list, sg, self.entity_mapping, **predicate.keywords)
+            res = predicate.func(*param_list, sg, self.entity_mapping, **predicate.keywords)
         else:
-            return predicate.func(*param_list, **predicate.keywords)
+            res = predicate.func(*param_list, **predicate.keywords)
+        if static_key is not None and type(res) != UnboundEntityError:
+            sg.graph['static_cache'][static_key] = res
+        return res
+
+    def __static_key(self, predicate, sg):
+        if predicate not in self.static_subtrees or 'static_cache' not in sg.graph:
+            return None
+        entity_ids = []
+        for symbolic_entity in self.static_subtrees[predicate]:
+            concrete_entity = self.entity_mapping[symbolic_entity]
+            if concrete_entity is None:
+                # let the normal evaluation report the unbound entity
+                return None
+            entity_ids.append(concrete_entity.entity_id)
+        return predicate, tuple(entity_ids)
+
+    def __evaluate_symbol(self, sg, symbol):
+        if 'memo' not in sg.graph:
+            return self.__evaluate_predicate(self.predicates[symbol], sg, func_chain=symbol)
+        # incremental mode: reuse last frame's value if nothing the predicate read has changed since
+        key = self.cache_key[symbol]
+        delta = sg.graph['delta']
+        previous = sg.graph['previous_memo'].get(key)
+        if previous is not None and delta is not None and previous[1].isdisjoint(delta):
+            sg.graph['memo'][key] = previous
+            self.undef.extend(previous[2])
+            if 'profiler' in sg.graph:
+                sg.graph['profiler'].cache_event(self.name, 'memo_hit')
+            return previous[0]
+        n_undef = len(self.undef)
+        sg.graph['read_set'] = set()
+        try:
+            res = self.__evaluate_predicate(self.predicates[symbol], sg, func_chain=symbol)
+        finally:
+            read_set = sg.graph.pop('read_set')
+        # node sets are tied to this frame's nodes, so only plain values are carried over
+        if isinstance(res, (bool, int, float, UnboundEntityError)):
+            sg.graph['memo'][key] = (res, read_set, self.undef[n_undef:])
+        return res
+
+    def evaluate_symbol(self, sg, symbol):
+        """The value of a symbol in the SG for this instance's bindings, without the SG's cache or stepping the DFA."""
+        return self.__evaluate_symbol(sg, symbol)
 
     def check_cache(self, sg, symbol):
         key = self.cache_key[symbol]
@@ -190,11 +453,20 @@ class ConcreteProperty:
             cache_miss = [symbol for symbol in a['symbols'] if symbol not in data_dict]
             for symbol in cache_miss:
                 sg_cache_check = self.check_cache(sg, symbol)
+                profiler = sg.graph.get('profiler')
                 if sg_cache_check is None:
-                    res = self.__evaluate_predicate(self.predicates[symbol], sg, func_chain=symbol)
+                    if profiler is not None:
+                        start = time.perf_counter_ns()
+                        res = self.__evaluate_symbol(sg, symbol)
+                        profiler.symbol(self.name, symbol, time.perf_counter_ns() - start)
+                        profiler.cache_event(self.name, 'miss')
+                    else:
+                        res = self.__evaluate_symbol(sg, symbol)
                     self.update_cache(sg, symbol, res)
                 else:
                     res = sg_cache_check
+                    if profiler is not None:
+                        profiler.cache_event(self.name, 'hit')
                 # res = self.__evaluate_predicate(self.predicates[symbol], sg, func_chain=symbol)
                 if type(res) == UnboundEntityError:
                     cur_unbound = True
@@ -207,6 +479,8 @@ class ConcreteProperty:
             #     # it may be that we have one viable edge even if we can't evaluate the unbound edges.
             #     # if so we will continue anyway
             #     unbound_entities.extend(e.entities)
+        if 'predicate_trace' in sg.graph:
+            self.__record_trace(sg, sg.graph['predicate_trace'], data_dict)
         if len(valid_states) != 1:
             if len(unbound_entities) > 0:
                 raise UnboundEntityError(list(unbound_entities))
@@ -219,7 +493,62 @@ class ConcreteProperty:
         self.name_history[sg.graph['frame']] = ({symbolic_entity: concrete_entity.get_node_name(sg) if concrete_entity is not None else None
                                   for symbolic_entity, concrete_entity in self.entity_mapping.items()})
         self.frames.append(sg.graph['frame'])
+        state_changed = valid_states[0] != self.dfa_view.current_state
         self.dfa_view.current_state = valid_states[0]
+        self.__trim_history(state_changed)
+
+    def __record_trace(self, sg, recorder, data_dict):
+        """
+        Records the value of every symbol of the property, see PredicateTraceRecorder. Symbols this step did not need
+        are evaluated without caching them and without binding their entities, so recording does not change what the
+        monitor does.
+        """
+        n_undef = len(self.undef)
+        for symbol in self.predicates:
+            value = data_dict.get(symbol)
+            from_monitor = symbol in data_dict
+            if not from_monitor:
+                value = self.check_cache(sg, symbol)
+                from_monitor = value is not None
+                if value is None:
+                    value = self.__evaluate_symbol(sg, symbol)
+            entity_ids = [self.entity_mapping[symbolic_entity].entity_id
+                          if self.entity_mapping[symbolic_entity] is not None else None
+                          for symbolic_entity in self.symbol_to_sym[symbol]]
+            recorder.record(self.name, symbol, entity_ids, value, from_monitor=from_monitor)
+        del self.undef[n_undef:]
+
+    def __trim_history(self, state_changed):
+        if self.retention.mode == 'window':
+            n_evict = len(self.frames) - self.retention.window
+        elif self.retention.mode == 'state_change' and state_changed:
+            # keep only the frame that caused the state change
+            n_evict = len(self.frames) - 1
+        else:
+            return
+        if n_evict <= 0:
+            return
+        evicted = []
+        for frame in self.frames[:n_evict]:
+            # the same frame can appear twice if this property was extended mid-frame
+            if frame in self.data_history:
+                evicted.append((frame, self.data_history.pop(frame), self.name_history.pop(frame)))
+        del self.frames[:n_evict]
+        if self.retention.spill_dir is not None and len(evicted) > 0:
+            self.__spill(evicted)
+
+    def __spill(self, evicted):
+        if len(self.spilled) == 0 or self.spilled[-1][0] != self._spill_file:
+            self._spill_file = self.retention.new_spill_file(self.name)
+            self.spilled.append([self._spill_file, 0])
+        if self.spill_sink is not None:
+            self.spill_sink.put_spill(self._spill_file, evicted)
+        else:
+            write_spill(self._spill_file, evicted)
+        self.spilled[-1][1] += len(evicted)
+
+    def load_spilled_history(self):
+        return read_spilled_history(self.spilled)
 
     def additional_concrete(self, sg):
         needs_binding = [symbolic_entity for symbolic_entity, concrete_entity in self.entity_mapping.items() if concrete_entity is None]
@@ -244,10 +573,14 @@ class ConcreteProperty:
         new_conc = ConcreteProperty(self.name, self.dfa_view.ltlfdfa,
                                     self.predicates, self.initial_frame,
                                     new_mapping, self.symbol_to_sym,
-                                    current_state)
+                                    current_state, retention=self.retention,
+                                    static_subtrees=self.static_subtrees,
+                                    spill_sink=self.spill_sink)
         new_conc.data_history = dict(self.data_history)
         new_conc.name_history = dict(self.name_history)
         new_conc.frames = list(self.frames)
+        # the copy shares the history spilled so far, but spills anything newer into its own file
+        new_conc.spilled = [list(segment) for segment in self.spilled]
         return new_conc
 
 
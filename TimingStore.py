@@ -0,0 +1,147 @@
+import fcntl
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Set, Tuple
+
+import numpy as np
+
+# one row per checked frame
+RECORD_DTYPE = np.dtype([
+    ('dataset', '<i4'),  # index into names['dataset'], e.g. tcp, lav, scenarios
+    ('route', '<i4'),  # index into names['route']
+    ('ego_only', 'u1'),
+    ('phi', '<i2'),
+    ('run', '<i2'),
+    ('frame', '<i4'),  # position of the frame in the route
+    ('time_ns', '<i8'),
+])
+
+
+class TimingStore:
+    """
+    Columnar store for per-frame check times, replacing one <route>_frame_times_*.json file per route, phi and run.
+    Rows are fixed-size binary records (RECORD_DTYPE) appended to <root>/frame_times.bin, so reading a whole study is
+    a single np.fromfile (or np.memmap for datasets larger than memory). Strings are kept in the frame_times_names.json
+    sidecar and referenced by index. Appends hold an exclusive flock, so parallel checkers can share a store.
+    Checking the same (dataset, route, ego_only, phi, run) again appends it again; read only returns the last append of
+    every check, so a re-run replaces the earlier frame times as the per-route JSON files were overwritten.
+    """
+    KEY_COLUMNS = ['dataset', 'route', 'ego_only', 'phi', 'run']
+    FILE_NAME = 'frame_times.bin'
+    NAMES_FILE = 'frame_times_names.json'
+    LOCK_FILE = 'frame_times.lock'
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.path = self.root / TimingStore.FILE_NAME
+        self.names_path = self.root / TimingStore.NAMES_FILE
+
+    @staticmethod
+    def exists(root) -> bool:
+        return (Path(root) / TimingStore.FILE_NAME).exists()
+
+    @staticmethod
+    def find(roots) -> List["TimingStore"]:
+        """All stores in or below the given folders."""
+        return [TimingStore(path.parent) for root in roots for path in sorted(Path(root).glob(f'**/{TimingStore.FILE_NAME}'))]
+
+    def read_names(self) -> Dict[str, List[str]]:
+        if not self.names_path.exists():
+            return {'dataset': [], 'route': []}
+        return json.loads(self.names_path.read_text())
+
+    def append(self, dataset: str, route: str, ego_only: bool, phi: int, run: int, frame_times_ns):
+        frame_times_ns = np.asarray(frame_times_ns, dtype=np.int64)
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / TimingStore.LOCK_FILE, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            names = self.read_names()
+            indices = {}
+            for column, name in [('dataset', dataset), ('route', route)]:
+                if name not in names[column]:
+                    names[column].append(name)
+                indices[column] = names[column].index(name)
+            # the names are written first, so every index in the records can always be resolved
+            tmp = self.names_path.with_suffix('.tmp')
+            tmp.write_text(json.dumps(names))
+            os.replace(tmp, self.names_path)
+            records = np.zeros(len(frame_times_ns), dtype=RECORD_DTYPE)
+            records['dataset'] = indices['dataset']
+            records['route'] = indices['route']
+            records['ego_only'] = ego_only
+            records['phi'] = phi
+            records['run'] = run
+            records['frame'] = np.arange(len(frame_times_ns))
+            records['time_ns'] = frame_times_ns
+            with open(self.path, 'ab') as f:
+                f.write(records.tobytes())
+
+    def completed_runs(self) -> Set[Tuple[str, bool, int, int]]:
+        """(route, ego_only, phi, run) of every check with frame times in the store."""
+        records = self.read()
+        if len(records) == 0:
+            return set()
+        routes = self.read_names()['route']
+        keys = np.unique(np.stack([records['route'], records['ego_only'], records['phi'], records['run']], axis=1),
+                         axis=0)
+        return {(routes[route], bool(ego_only), phi, run) for route, ego_only, phi, run in keys.tolist()}
+
+    def merge(self, other: "TimingStore"):
+        """Appends all records of another store, e.g. one a worker wrote on its own machine."""
+        records = other.read()
+        other_names = other.read_names()
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / TimingStore.LOCK_FILE, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            names = self.read_names()
+            for column in ['dataset', 'route']:
+                for name in other_names[column]:
+                    if name not in names[column]:
+                        names[column].append(name)
+                mapping = np.array([names[column].index(name) for name in other_names[column]], dtype=np.int32)
+                if len(records) > 0:
+                    records[column] = mapping[records[column]]
+            tmp = self.names_path.with_suffix('.tmp')
+            tmp.write_text(json.dumps(names))
+            os.replace(tmp, self.names_path)
+            with open(self.path, 'ab') as f:
+                f.write(records.tobytes())
+
+    def read(self, mmap=False, latest=True) -> np.ndarray:
+        """
+        The records of every check; with mmap they are paged in on access instead of being read into memory.
+        :param latest: only keep the last append of a check that was appended more than once, if there is any such
+            check the records are copied into memory even with mmap
+        """
+        if not self.path.exists():
+            return np.zeros(0, dtype=RECORD_DTYPE)
+        # a concurrent append may have written part of a record, ignore it
+        n_records = self.path.stat().st_size // RECORD_DTYPE.itemsize
+        if mmap:
+            records = np.memmap(self.path, dtype=RECORD_DTYPE, mode='r', shape=(n_records,))
+        else:
+            records = np.fromfile(self.path, dtype=RECORD_DTYPE, count=n_records)
+        if not latest or n_records == 0:
+            return records
+        keep = TimingStore.latest_appends(records)
+        return records if keep.all() else records[keep]
+
+    @staticmethod
+    def latest_appends(records) -> np.ndarray:
+        """Mask of the records that belong to the last append of their check."""
+        keys = np.stack([np.asarray(records[column], dtype=np.int64) for column in TimingStore.KEY_COLUMNS], axis=1)
+        _, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        # every append writes its frames from 0 in one piece, so the last one starts at the last frame 0 of its check
+        positions = np.arange(len(records))
+        last_start = np.zeros(inverse.max() + 1, dtype=np.int64)
+        starts = np.flatnonzero(np.asarray(records['frame']) == 0)
+        np.maximum.at(last_start, inverse[starts], starts)
+        return positions >= last_start[inverse]
+
+    def ingest_json(self, timing_file: Path, dataset=None):
+        """Appends a legacy <route>_frame_times_*.json file, the dataset defaults to the name of its folder."""
+        data = json.loads(Path(timing_file).read_text())
+        self.append(dataset if dataset is not None else Path(timing_file).parent.name, data['folder'],
+                    data['ego_only'], data['phi'], data['run'], data['frame_times'])
@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+from pathlib import Path
+from time import perf_counter_ns
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.complete(self.name, self.start, perf_counter_ns(), self.args)
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class NullTracer:
+    """Stands in for a Tracer when tracing is off, so instrumented code never has to check."""
+    enabled = False
+    _span = _NullSpan()
+
+    def span(self, name, **args):
+        return self._span
+
+    def complete(self, name, start_ns, end_ns, args=None):
+        pass
+
+    def close(self):
+        pass
+
+
+NULL_TRACER = NullTracer()
+
+
+class Tracer:
+    """
+    Records spans as Chrome trace events ('X' complete events), which chrome://tracing and ui.perfetto.dev can open.
+    Events are buffered and appended to the trace file every flush_every events, so memory stays bounded on long
+    routes; the file is a JSON array that is only terminated on close(), which trace viewers accept either way.
+    Spans shorter than min_duration_us are dropped to keep the per-instance spans of busy frames cheap to store.
+    Safe to use from several threads, e.g. the ViolationWriter thread.
+    """
+    enabled = True
+
+    def __init__(self, trace_file, min_duration_us=0, flush_every=10000, **default_args):
+        self.trace_file = Path(trace_file)
+        self.trace_file.parent.mkdir(parents=True, exist_ok=True)
+        self.min_duration_ns = min_duration_us * 1000
+        self.flush_every = flush_every
+        self.default_args = default_args
+        self.pid = os.getpid()
+        self._events = []
+        self._threads = set()
+        self._lock = threading.Lock()
+        self._file = open(self.trace_file, 'w')
+        self._file.write('[\n')
+        self._first = True
+
+    def span(self, name, **args):
+        return _Span(self, name, args)
+
+    def complete(self, name, start_ns, end_ns, args=None):
+        if end_ns - start_ns < self.min_duration_ns:
+            return
+        tid = threading.get_ident()
+        event = {'name': name, 'ph': 'X', 'ts': start_ns / 1000, 'dur': (end_ns - start_ns) / 1000,
+                 'pid': self.pid, 'tid': tid, 'args': {**self.default_args, **(args or {})}}
+        with self._lock:
+            if tid not in self._threads:
+                # name the thread in the viewer, e.g. to tell the violation writer apart from the monitor
+                self._threads.add(tid)
+                self._events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                                     'args': {'name': threading.current_thread().name}})
+            self._events.append(event)
+            if len(self._events) >= self.flush_every:
+                self._flush()
+
+    def _flush(self):
+        if self._file is None:
+            return
+        for event in self._events:
+            if not self._first:
+                self._file.write(',\n')
+            self._file.write(json.dumps(event))
+            self._first = False
+        self._events = []
+        self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self._flush()
+            self._file.write('\n]\n')
+            self._file.close()
+            self._file = None
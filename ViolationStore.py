@@ -0,0 +1,188 @@
+import json
+import sqlite3
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS violations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    route TEXT NOT NULL,
+    property TEXT NOT NULL,
+    frame TEXT NOT NULL,
+    step INTEGER,
+    initial_frame TEXT,
+    ego_id TEXT,
+    bindings TEXT NOT NULL,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS violations_route_property ON violations (route, property, frame);
+CREATE INDEX IF NOT EXISTS violations_property ON violations (property, route);
+CREATE TABLE IF NOT EXISTS violation_bindings (
+    violation_id INTEGER NOT NULL REFERENCES violations (id),
+    entity TEXT NOT NULL,
+    entity_id TEXT,
+    is_ego INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS violation_bindings_entity ON violation_bindings (entity, is_ego, violation_id);
+CREATE INDEX IF NOT EXISTS violation_bindings_violation ON violation_bindings (violation_id);
+"""
+
+
+class ViolationStore:
+    """
+    Store for all of the violations found under one results root, kept in <results root>/violations.sqlite.
+    Every violation is a new row, so several violations of the same property in the same frame are all kept. A check of
+    a route first clears that route's violations of the properties it checks, so checking a route again (another run or
+    phi) replaces its violations instead of adding them twice.
+    Each writer should use its own ViolationStore; SQLite's WAL mode lets several processes append concurrently.
+    """
+    FILE_NAME = 'violations.sqlite'
+
+    def __init__(self, results_root, timeout=60):
+        self.path = Path(results_root) / ViolationStore.FILE_NAME
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), timeout=timeout)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(SCHEMA)
+
+    @staticmethod
+    def exists(results_root) -> bool:
+        return (Path(results_root) / ViolationStore.FILE_NAME).exists()
+
+    def add(self, route: str, violations: List["SymbolicViolation"]):
+        """Appends the violations found on the given route in a single transaction."""
+        self.add_rows(route, ViolationStore.rows(violations))
+
+    @staticmethod
+    def rows(violations: List["SymbolicViolation"]) -> List[dict]:
+        """The violations as they are stored, JSON serializable so they can be kept elsewhere, e.g. in a ResultCache."""
+        rows = []
+        for violation in violations:
+            data = violation.to_dict()
+            rows.append({
+                'property': violation.property_name, 'frame': str(violation.violation_time), 'step': violation.step,
+                'initial_frame': str(violation.initial_frame), 'ego_id': json.dumps(violation.ego_id),
+                'bindings': json.dumps(data['entity_mapping']), 'payload': json.dumps(data),
+                'entities': [[entity, json.dumps(entity_id), int(entity_id == violation.ego_id)]
+                             for entity, entity_id in data['entity_mapping'].items()],
+            })
+        return rows
+
+    def add_rows(self, route: str, rows: List[dict]):
+        """Appends violations in the form returned by rows in a single transaction."""
+        with self._conn:
+            for row in rows:
+                cursor = self._conn.execute(
+                    'INSERT INTO violations (route, property, frame, step, initial_frame, ego_id, bindings, payload) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (route, row['property'], row['frame'], row['step'], row['initial_frame'], row['ego_id'],
+                     row['bindings'], row['payload']))
+                self._conn.executemany(
+                    'INSERT INTO violation_bindings (violation_id, entity, entity_id, is_ego) VALUES (?, ?, ?, ?)',
+                    [(cursor.lastrowid, *entity) for entity in row['entities']])
+
+    def query(self, route: Optional[str] = None, property_name: Optional[str] = None, frame: Optional[str] = None,
+              entity: Optional[str] = None, ego: Optional[bool] = None, payload=False) -> List[dict]:
+        """
+        Returns the stored violations matching all of the given filters, in the order they were added.
+        :param entity: only return violations where this symbolic entity is bound
+        :param ego: together with entity, only return violations where that entity is (or is not) the ego vehicle
+        :param payload: also return the full violation as written by SymbolicViolation.to_dict
+        """
+        if ego is not None and entity is None:
+            raise ValueError('Filtering on ego requires the entity that should (not) be the ego')
+        sql = 'SELECT v.id, v.route, v.property, v.frame, v.step, v.initial_frame, v.ego_id, v.bindings, v.payload ' \
+              'FROM violations v'
+        conditions = []
+        params = []
+        if entity is not None:
+            sql += ' JOIN violation_bindings b ON b.violation_id = v.id'
+            conditions.append('b.entity = ?')
+            params.append(entity)
+            if ego is not None:
+                conditions.append('b.is_ego = ?')
+                params.append(int(ego))
+        for column, value in [('v.route', route), ('v.property', property_name), ('v.frame', frame)]:
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                params.append(str(value))
+        if len(conditions) > 0:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY v.id'
+        rows = []
+        for row_id, route, prop, frame, step, initial_frame, ego_id, bindings, data in self._conn.execute(sql, params):
+            row = {'id': row_id, 'route': route, 'property': prop, 'frame': frame, 'step': step,
+                   'initial_frame': initial_frame, 'ego_id': json.loads(ego_id), 'bindings': json.loads(bindings)}
+            if payload:
+                row['payload'] = json.loads(data)
+            rows.append(row)
+        return rows
+
+    def ego_counts(self) -> Dict[Tuple[str, str, str], Dict[str, int]]:
+        """
+        Counts violations per route, property and symbolic entity, split by whether that entity was the ego vehicle.
+        :return: {(route, property, entity): {'ego': n, 'other': n}}
+        """
+        counts = {}
+        for route, prop, entity, is_ego, n in self._conn.execute(
+                'SELECT v.route, v.property, b.entity, b.is_ego, COUNT(*) '
+                'FROM violations v JOIN violation_bindings b ON b.violation_id = v.id '
+                'GROUP BY v.route, v.property, b.entity, b.is_ego'):
+            key = (route, prop, entity)
+            if key not in counts:
+                counts[key] = {'ego': 0, 'other': 0}
+            counts[key]['ego' if is_ego else 'other'] += n
+        return counts
+
+    def _delete(self, route: str):
+        self._conn.execute('DELETE FROM violation_bindings WHERE violation_id IN '
+                           '(SELECT id FROM violations WHERE route = ?)', (route,))
+        self._conn.execute('DELETE FROM violations WHERE route = ?', (route,))
+
+    def clear(self, route: str, properties: List[str]) -> int:
+        """Deletes the violations of the given properties on a route, so that checking it again replaces them."""
+        if len(properties) == 0:
+            return 0
+        placeholders = ', '.join('?' * len(properties))
+        condition = f'route = ? AND property IN ({placeholders})'
+        params = [route, *properties]
+        with self._conn:
+            self._conn.execute('DELETE FROM violation_bindings WHERE violation_id IN '
+                               f'(SELECT id FROM violations WHERE {condition})', params)
+            return self._conn.execute(f'DELETE FROM violations WHERE {condition}', params).rowcount
+
+    def merge(self, other_root, routes: List[str]):
+        """
+        Replaces the violations of the given routes with the ones in the store under other_root, in one transaction.
+        Routes the other store has no violations for end up with none, so merging the same results twice is harmless.
+        """
+        rows = []
+        bindings = []
+        if ViolationStore.exists(other_root):
+            other = ViolationStore(other_root)
+            placeholders = ', '.join('?' * len(routes))
+            rows = other._conn.execute(
+                'SELECT id, route, property, frame, step, initial_frame, ego_id, bindings, payload FROM violations '
+                f'WHERE route IN ({placeholders}) ORDER BY id', routes).fetchall()
+            bindings = other._conn.execute(
+                'SELECT b.violation_id, b.entity, b.entity_id, b.is_ego FROM violation_bindings b '
+                f'JOIN violations v ON b.violation_id = v.id WHERE v.route IN ({placeholders})', routes).fetchall()
+            other.close()
+        with self._conn:
+            for route in routes:
+                self._delete(route)
+            ids = {}
+            for row in rows:
+                cursor = self._conn.execute(
+                    'INSERT INTO violations (route, property, frame, step, initial_frame, ego_id, bindings, payload) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', row[1:])
+                ids[row[0]] = cursor.lastrowid
+            self._conn.executemany(
+                'INSERT INTO violation_bindings (violation_id, entity, entity_id, is_ego) VALUES (?, ?, ?, ?)',
+                [(ids[violation_id], *rest) for violation_id, *rest in bindings])
+
+    def routes(self) -> List[str]:
+        return [route for route, in self._conn.execute('SELECT DISTINCT route FROM violations ORDER BY route')]
+
+    def close(self):
+        self._conn.close()
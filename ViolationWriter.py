@@ -0,0 +1,97 @@
+import atexit
+import queue
+import threading
+from pathlib import Path
+
+from SymbolicProperty import write_spill
+from Tracer import NULL_TRACER
+from ViolationStore import ViolationStore
+
+_STOP = object()
+_SPILL = object()
+
+
+class ViolationWriter:
+    """
+    Writes SymbolicViolations from a background thread so that file I/O stays out of the per-frame monitoring loop.
+    Violations are taken from a queue and appended to the results root's ViolationStore in batches, one transaction
+    per batch. It also appends the history evicted by a HistoryRetention with a spill_dir to its spill files, before
+    the violations of the same batch, so a stored violation never points at history that is not written yet.
+    close() blocks until everything that was queued has been written; it is also registered with atexit so nothing is
+    lost if the caller forgets to close the writer.
+    """
+
+    def __init__(self, results_root: Path, route: str, batch_size=64, tracer=NULL_TRACER):
+        self.results_root = Path(results_root)
+        self.route = route
+        self.batch_size = batch_size
+        self.tracer = tracer
+        self.n_written = 0
+        self._queue = queue.Queue()
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=f'ViolationWriter-{route}', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, violation):
+        if self._closed:
+            raise ValueError('Cannot write violations after the writer has been closed')
+        self._queue.put(violation)
+
+    def put_spill(self, spill_file, evicted):
+        if self._closed:
+            raise ValueError('Cannot write spilled history after the writer has been closed')
+        self._queue.put((_SPILL, spill_file, evicted))
+
+    def _run(self):
+        # the store is opened here since SQLite connections belong to the thread that created them
+        store = None
+        done = False
+        while not done:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            done = any(item is _STOP for item in batch)
+            spills = [item for item in batch if isinstance(item, tuple) and item[0] is _SPILL]
+            violations = [item for item in batch if item is not _STOP and not isinstance(item, tuple)]
+            try:
+                if len(spills) > 0:
+                    with self.tracer.span('write_spills', n=len(spills)):
+                        for _, spill_file, evicted in spills:
+                            write_spill(spill_file, evicted)
+                if len(violations) > 0:
+                    if store is None:
+                        store = ViolationStore(self.results_root)
+                    with self.tracer.span('write_violations', n=len(violations)):
+                        store.add(self.route, violations)
+                    self.n_written += len(violations)
+            except Exception as e:
+                # keep draining the queue so flush() does not hang; the error is re-raised on close()
+                self._error = e
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+        if store is not None:
+            store.close()
+
+    def flush(self):
+        """Blocks until every violation queued so far has been written."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._queue.put(_STOP)
+            self._thread.join()
+            atexit.unregister(self.close)
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
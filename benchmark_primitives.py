@@ -0,0 +1,192 @@
+"""
+Micro-benchmarks for the building blocks of property evaluation: the SG primitives, set operations, DFA stepping and
+binding enumeration. Every benchmark runs on a fixed, generated fixture, so results of two commits can be compared
+operation by operation.
+
+    python benchmark_primitives.py -o primitives_new.json
+    python benchmark_primitives.py -o primitives_new.json --compare primitives_old.json
+"""
+import argparse
+import fnmatch
+import json
+import subprocess
+import sys
+import timeit
+from functools import partial
+from pathlib import Path
+
+import networkx as nx
+
+import SG_Primitives as P
+from SG_Utils import Node
+from SymbolicEntity import SymbolicEntity, UnboundEntityError
+from SymbolicProperty import get_concrete_entities
+
+RESULTS_VERSION = 1
+SIZES = [1, 10, 100, 1000]
+NOISE_LABELS = ['isIn', 'toLeftOf', 'visible', 'atDRearOf']
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def make_vehicle(i, speed=None):
+    return Node(f'car_{i}', 'car', {'entity_id': i, 'carla_speed': float(i % 20) if speed is None else speed,
+                                    'carla_type_id': 'vehicle.ford.ambulance' if i % 10 == 0 else 'vehicle.audi.a2'})
+
+
+def fan_out_sg(fan_out):
+    """A hub with fan_out 'near' neighbours and as many edges with other labels in both directions."""
+    sg = nx.MultiDiGraph()
+    hub = make_vehicle(-1)
+    for i in range(fan_out):
+        sg.add_edge(hub, make_vehicle(i), label='near')
+        sg.add_edge(hub, make_vehicle(fan_out + i), label=NOISE_LABELS[i % len(NOISE_LABELS)])
+        sg.add_edge(make_vehicle(2 * fan_out + i), hub, label=NOISE_LABELS[i % len(NOISE_LABELS)])
+    return sg, hub
+
+
+def relset_benchmarks():
+    for fan_out in SIZES:
+        sg, hub = fan_out_sg(fan_out)
+        yield f'relSet/outgoing/fan_out={fan_out}', partial(P.relSet, {hub}, 'near', sg, {})
+        yield f'relSet/incoming/fan_out={fan_out}', partial(P.relSet, {hub}, 'isIn', sg, {}, edge_type='incoming')
+    # many sources, e.g. relSet of all lanes of a road
+    for n in SIZES:
+        sg = nx.MultiDiGraph()
+        sources = {make_vehicle(i) for i in range(n)}
+        target = Node('Lane 0', 'lane', {'entity_id': 'Lane 0'})
+        for source in sources:
+            sg.add_edge(source, target, label='isIn')
+        yield f'relSet/sources={n}', partial(P.relSet, sources, 'isIn', sg, {})
+
+
+def filter_benchmarks():
+    for n in SIZES:
+        sg = nx.MultiDiGraph()
+        nodes = {make_vehicle(i) for i in range(n)}
+        sg.add_nodes_from(nodes)
+        yield f'filterByAttr/regex_name/n={n}', partial(P.filterByAttr, nodes, 'name', 'car_1*', sg, {})
+        yield f'filterByAttr/callable_speed/n={n}', partial(P.filterByAttr, nodes, 'carla_speed',
+                                                            lambda a: a is not None and P.gt(a, 0.1), sg, {})
+        yield f'filterByAttr/callable_type/n={n}', partial(P.filterByAttr, nodes, 'carla_type_id',
+                                                           lambda x: x is not None and 'ambulance' in x, sg, {})
+        yield f'filterByAttr/G_stop_sign/n={n}', partial(P.filterByAttr, 'G', 'name', 'stop_sign*', sg, {})
+
+
+def set_benchmarks():
+    for n in SIZES:
+        s1 = {make_vehicle(i) for i in range(n)}
+        # half of s2 overlaps s1
+        s2 = set(list(s1)[:n // 2]) | {make_vehicle(n + i) for i in range(n - n // 2)}
+        for op in ['union', 'intersection', 'difference', 'symmetric_difference']:
+            yield f'{op}/n={n}', partial(getattr(P, op), s1, s2)
+        yield f'size/n={n}', partial(P.size, s1)
+        yield f'validate_sets/n={n}', partial(P.validate_sets, s1, s2)
+        yield f'validate_sets/unbound/n={n}', partial(P.validate_sets, s1, UnboundEntityError([]))
+
+
+def dfa_benchmarks():
+    try:
+        from LTLfDFA import LTLfDFA
+        # the shape of the 816/921 following properties: a trigger followed by a bounded obligation
+        dfa = LTLfDFA('(~(a & b) & X(a & b)) -> X(~ $[4][a & b])')
+    except Exception as e:  # building a DFA needs MONA
+        print(f'Skipping DFA benchmarks, could not build a DFA: {e!r}', file=sys.stderr)
+        return
+    data_dict = {'a': True, 'b': False}
+
+    def step():
+        dfa.reset()
+        dfa.step(data_dict)
+
+    yield 'LTLfDFA/step', step
+    for n in SIZES:
+        data = {'a': [(i, i % 3 == 0) for i in range(n)], 'b': [(i, i % 2 == 0) for i in range(n)]}
+        yield f'LTLfDFA/from_init/steps={n}', partial(dfa.from_init, data)
+
+
+def binding_benchmarks():
+    vehicle1 = SymbolicEntity('vehicle_1', ['car', 'ego'])
+    vehicle2 = SymbolicEntity('vehicle_2', ['car', 'ego'])
+    for n in [5, 20, 50]:
+        sg = nx.MultiDiGraph()
+        sg.add_nodes_from([make_vehicle(i) for i in range(n)])
+        sg.add_nodes_from([Node(f'Lane {i}', 'lane', {'entity_id': f'Lane {i}'}) for i in range(2 * n)])
+        yield f'get_concrete_entities/1_entity/candidates={n}', \
+            partial(get_concrete_entities, sg, [vehicle1])
+        yield f'get_concrete_entities/2_entities/candidates={n}', \
+            partial(get_concrete_entities, sg, [vehicle1, vehicle2], include_none=True)
+
+
+BENCHMARKS = [relset_benchmarks, filter_benchmarks, set_benchmarks, dfa_benchmarks, binding_benchmarks]
+
+
+def measure(func, repeat=5):
+    """Best and median time per call in ns, each timing running enough calls to take at least 0.2 seconds."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = sorted(t / number * 1e9 for t in timer.repeat(repeat=repeat, number=number))
+    return {'best_ns': times[0], 'median_ns': times[len(times) // 2], 'calls': number}
+
+
+def run(pattern, repeat):
+    results = {}
+    for benchmarks in BENCHMARKS:
+        for name, func in benchmarks():
+            if pattern is not None and not fnmatch.fnmatch(name, pattern):
+                continue
+            results[name] = measure(func, repeat=repeat)
+            print(f'{name:<55} {results[name]["best_ns"]:>14,.0f} ns')
+    return results
+
+
+def compare(old, new, threshold):
+    """Prints the speedup of every benchmark in both results; returns the names that got slower than threshold %."""
+    slower = []
+    print(f'{"benchmark":<55} {"old ns":>14} {"new ns":>14} {"change":>8}')
+    for name in new['results']:
+        if name not in old['results']:
+            continue
+        old_ns = old['results'][name]['best_ns']
+        new_ns = new['results'][name]['best_ns']
+        change = (new_ns - old_ns) / old_ns * 100
+        flag = ''
+        if change > threshold:
+            slower.append(name)
+            flag = ' SLOWER'
+        print(f'{name:<55} {old_ns:>14,.0f} {new_ns:>14,.0f} {change:>+7.1f}%{flag}')
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Primitive benchmarks')
+    parser.add_argument('-o', '--output', type=Path, default=None, help='Write the results to this file')
+    parser.add_argument('--compare', type=Path, default=None, help='Results of an earlier run to compare against')
+    parser.add_argument('-k', '--filter', default=None, help='Only run benchmarks whose name matches this glob')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Percent slowdown reported as a regression by --compare')
+    args = parser.parse_args()
+    results = {'version': RESULTS_VERSION, 'commit': git_commit(), 'python': sys.version.split()[0],
+               'results': run(args.filter, args.repeat)}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare is not None:
+        old = json.loads(args.compare.read_text())
+        if old.get('version') != RESULTS_VERSION:
+            raise ValueError(f'{args.compare} has results version {old.get("version")}, expected {RESULTS_VERSION}')
+        slower = compare(old, results, args.threshold)
+        if len(slower) > 0:
+            print(f'{len(slower)} benchmarks slower by more than {args.threshold}%')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""
+Replays a fixed set of recorded routes through SymbolicMonitor and compares the per-frame timings against a baseline.
+
+    python benchmark_replay.py record -f ./study_data/tcp/run1/ --routes RouteScenario_0 RouteScenario_3 -b baseline.json
+    python benchmark_replay.py compare -f ./study_data/tcp/run1/ -b baseline.json
+
+record stores every frame time of every route in a baseline file. compare replays the routes listed in the baseline
+(or reads --candidate, a file written by record) and reports percentile deltas per route and over all frames, with
+bootstrap confidence intervals. It exits with status 1 if p95 or max frame time regressed by more than the thresholds.
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+import SG_Utils as utils
+from check_symbolic_properties import load_route
+from SymbolicMonitor import SymbolicMonitor
+
+BASELINE_VERSION = 1
+PERCENTILES = [50, 90, 95, 99]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def replay_route(route_dir: Path, repeats=1, ego_only=False, phi=-1):
+    """Returns the time (ms) to check each frame of the route, the median over repeats for every frame."""
+    sgs = load_route(route_dir)
+    utils.add_missing(sgs)
+    runs = []
+    for _ in range(repeats):
+        with tempfile.TemporaryDirectory() as log_path:
+            m = SymbolicMonitor(log_path, route_dir.name, ego_only=ego_only, phi=phi)
+            frame_times = []
+            for sg in sgs:
+                sg.graph['cache'] = {}
+                start = time.perf_counter_ns()
+                m.check(sg)
+                frame_times.append((time.perf_counter_ns() - start) / 1e6)
+            m.save_final_output()
+        runs.append(frame_times)
+    return np.median(np.array(runs), axis=0).tolist()
+
+
+def record(folder: Path, routes, repeats, ego_only, phi):
+    if routes is None:
+        routes = sorted(d.name for d in folder.iterdir() if (d / 'rsv').is_dir())
+    results = {}
+    for route in routes:
+        print(f'Replaying {route}')
+        results[route] = replay_route(folder / route, repeats, ego_only, phi)
+    return {
+        'version': BASELINE_VERSION,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'machine': platform.node(),
+        'config': {'ego_only': ego_only, 'phi': phi, 'repeats': repeats},
+        'routes': results,
+    }
+
+
+def load_baseline(path: Path):
+    baseline = json.loads(path.read_text())
+    if baseline.get('version') != BASELINE_VERSION:
+        raise ValueError(f'{path} has baseline version {baseline.get("version")}, expected {BASELINE_VERSION}; '
+                         f'record a new baseline')
+    return baseline
+
+
+def summarize(times):
+    times = np.asarray(times)
+    summary = {f'p{p}': float(np.percentile(times, p)) for p in PERCENTILES}
+    summary['max'] = float(times.max())
+    summary['mean'] = float(times.mean())
+    return summary
+
+
+def bootstrap_delta(baseline, candidate, percentile, n_resamples=2000, confidence=0.95, seed=0):
+    """Confidence interval of percentile(candidate) - percentile(baseline), resampling the frames of each."""
+    rng = np.random.default_rng(seed)
+    baseline = np.asarray(baseline)
+    candidate = np.asarray(candidate)
+    baseline_samples = rng.choice(baseline, size=(n_resamples, len(baseline)), replace=True)
+    candidate_samples = rng.choice(candidate, size=(n_resamples, len(candidate)), replace=True)
+    deltas = np.percentile(candidate_samples, percentile, axis=1) - np.percentile(baseline_samples, percentile, axis=1)
+    alpha = (1 - confidence) / 2
+    return float(np.quantile(deltas, alpha)), float(np.quantile(deltas, 1 - alpha))
+
+
+def compare(baseline, candidate, p95_threshold, max_threshold, n_resamples):
+    """Prints the comparison and returns the list of regressions (empty if there are none)."""
+    routes = [route for route in baseline['routes'] if route in candidate['routes']]
+    missing = [route for route in baseline['routes'] if route not in candidate['routes']]
+    if len(missing) > 0:
+        print(f'Routes missing from the candidate: {missing}')
+    rows = [(route, baseline['routes'][route], candidate['routes'][route]) for route in routes]
+    rows.append(('ALL', [t for route in routes for t in baseline['routes'][route]],
+                 [t for route in routes for t in candidate['routes'][route]]))
+    regressions = []
+    header = f'{"route":<40} {"stat":>5} {"baseline":>10} {"candidate":>10} {"delta %":>8}  95% CI of delta (ms)'
+    print(header)
+    print('-' * len(header))
+    for route, base_times, cand_times in rows:
+        base = summarize(base_times)
+        cand = summarize(cand_times)
+        for stat in [f'p{p}' for p in PERCENTILES] + ['max']:
+            delta = (cand[stat] - base[stat]) / base[stat] * 100 if base[stat] > 0 else 0.0
+            ci = ''
+            if stat != 'max':
+                low, high = bootstrap_delta(base_times, cand_times, int(stat[1:]), n_resamples=n_resamples)
+                ci = f'[{low:+.2f}, {high:+.2f}]'
+            print(f'{route:<40} {stat:>5} {base[stat]:>10.2f} {cand[stat]:>10.2f} {delta:>+8.1f}  {ci}')
+            if route != 'ALL':
+                continue
+            # p95 only counts as a regression if the whole confidence interval is above zero, the max is a single
+            # frame so there is nothing to resample
+            if stat == 'p95' and delta > p95_threshold and low > 0:
+                regressions.append(f'p95 frame time regressed by {delta:.1f}% (threshold {p95_threshold}%)')
+            if stat == 'max' and delta > max_threshold:
+                regressions.append(f'max frame time regressed by {delta:.1f}% (threshold {max_threshold}%)')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Replay benchmark')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    record_parser = subparsers.add_parser('record', help='Replay routes and write their frame times to a file')
+    record_parser.add_argument('-o', '--output', type=Path, help='Defaults to the baseline file')
+    compare_parser = subparsers.add_parser('compare', help='Compare a run against the baseline')
+    compare_parser.add_argument('--candidate', type=Path, default=None,
+                                help='Compare this recorded file instead of replaying the routes now')
+    compare_parser.add_argument('--p95_threshold', type=float, default=10.0,
+                                help='Allowed p95 frame time increase, in percent')
+    compare_parser.add_argument('--max_threshold', type=float, default=25.0,
+                                help='Allowed max frame time increase, in percent')
+    compare_parser.add_argument('--resamples', type=int, default=2000)
+    for sub in [record_parser, compare_parser]:
+        sub.add_argument('-f', '--folder', type=Path, help='Folder holding the route folders')
+        sub.add_argument('-b', '--baseline', type=Path, default='benchmark_baseline.json')
+        sub.add_argument('--repeats', type=int, default=3)
+    record_parser.add_argument('--routes', nargs='+', default=None, help='Route folder names, all routes by default')
+    record_parser.add_argument('--ego_only', action='store_true')
+    record_parser.add_argument('--phi', type=int, default=-1)
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        result = record(args.folder, args.routes, args.repeats, args.ego_only, args.phi)
+        output = args.output if args.output is not None else args.baseline
+        with open(output, 'w') as f:
+            json.dump(result, f)
+        print(f'Wrote {sum(len(t) for t in result["routes"].values())} frame times to {output}')
+        return
+    baseline = load_baseline(args.baseline)
+    if args.candidate is not None:
+        candidate = load_baseline(args.candidate)
+    else:
+        config = baseline['config']
+        candidate = record(args.folder, list(baseline['routes']), args.repeats, config['ego_only'], config['phi'])
+    print(f'baseline: {baseline["commit"]} ({baseline["created"]}), candidate: {candidate["commit"]}')
+    regressions = compare(baseline, candidate, args.p95_threshold, args.max_threshold, args.resamples)
+    if len(regressions) > 0:
+        for regression in regressions:
+            print(f'REGRESSION: {regression}')
+        sys.exit(1)
+    print('No regressions')
+
+
+if __name__ == '__main__':
+    main()
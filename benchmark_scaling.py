@@ -0,0 +1,130 @@
+"""
+Measures how the cost of each property scales with the size of the scene, using SGs from synthetic_sg.py.
+For every scene configuration and every property in all_symbolic_properties, the frames are checked by a monitor
+that only has that property, and the per-frame latency, live instance count and (with --memory) the peak memory
+allocated while checking are recorded.
+Usage: python benchmark_scaling.py --vehicles 5 10 20 40 --frames 100 -o scaling_results/
+"""
+import argparse
+import json
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+import SG_Utils as utils
+from SymbolicMonitor import SymbolicMonitor
+from symbolic_properties import all_symbolic_properties
+from synthetic_sg import SyntheticScene
+
+
+def run_property(phi, sgs, memory=False):
+    with tempfile.TemporaryDirectory() as log_path:
+        m = SymbolicMonitor(log_path, 'synthetic', phi=phi)
+        frame_times = []
+        live_instances = []
+        if memory:
+            tracemalloc.start()
+        for sg in sgs:
+            sg.graph['cache'] = {}
+            start = time.perf_counter_ns()
+            m.check(sg)
+            frame_times.append(time.perf_counter_ns() - start)
+            live_instances.append(len(m.concrete_properties))
+        peak_memory = None
+        if memory:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        m.save_final_output()
+    frame_times = np.array(frame_times) / 1e6
+    return {
+        'mean_ms': float(frame_times.mean()),
+        'p50_ms': float(np.percentile(frame_times, 50)),
+        'p95_ms': float(np.percentile(frame_times, 95)),
+        'max_ms': float(frame_times.max()),
+        'mean_instances': float(np.mean(live_instances)),
+        'max_instances': int(np.max(live_instances)),
+        'violations': sum(len(v) for v in m.violations.values()),
+        'peak_memory_mb': peak_memory / 2 ** 20 if peak_memory is not None else None,
+    }
+
+
+def make_sgs(config, n_frames, seed):
+    scene = SyntheticScene(n_vehicles=config['vehicles'], n_lanes=config['lanes'], n_roads=config['roads'],
+                           n_bicycles=config['bicycles'], n_emergency=config['emergency'], seed=seed)
+    sgs = list(scene.frames(n_frames))
+    utils.add_missing(sgs)
+    return sgs
+
+
+def plot_curves(results, sweep_key, save_folder: Path):
+    metrics = [('p95_ms', 'p95 frame time (ms)'), ('max_instances', 'Max live instances')]
+    if any(r['peak_memory_mb'] is not None for r in results):
+        metrics.append(('peak_memory_mb', 'Peak memory (MB)'))
+    fig, axes = plt.subplots(1, len(metrics), figsize=(6 * len(metrics), 5))
+    for ax, (metric, label) in zip(np.atleast_1d(axes), metrics):
+        for property_name in sorted({r['property'] for r in results}):
+            points = sorted((r['config'][sweep_key], r[metric]) for r in results if r['property'] == property_name)
+            ax.plot([x for x, _ in points], [y for _, y in points], marker='o', label=property_name)
+        ax.set_xlabel(sweep_key)
+        ax.set_ylabel(label)
+    np.atleast_1d(axes)[0].legend(fontsize=6)
+    fig.tight_layout()
+    for ending in ['svg', 'pdf']:
+        fig.savefig(save_folder / f'scaling_{sweep_key}.{ending}')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Scaling benchmark')
+    parser.add_argument('-o', '--save_folder', type=Path, default='scaling_results/')
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--vehicles', type=int, nargs='+', default=[10])
+    parser.add_argument('--lanes', type=int, nargs='+', default=[2])
+    parser.add_argument('--roads', type=int, nargs='+', default=[4])
+    parser.add_argument('--bicycles', type=int, nargs='+', default=[0])
+    parser.add_argument('--emergency', type=int, nargs='+', default=[0])
+    parser.add_argument('--phi', type=int, nargs='+', default=None,
+                        help='Indices of the properties to benchmark, all of them by default')
+    parser.add_argument('--memory', action='store_true',
+                        help='Also measure peak memory with tracemalloc (in a separate, slower pass)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    args.save_folder.mkdir(parents=True, exist_ok=True)
+
+    sweeps = {'vehicles': args.vehicles, 'lanes': args.lanes, 'roads': args.roads, 'bicycles': args.bicycles,
+              'emergency': args.emergency}
+    base = {key: values[0] for key, values in sweeps.items()}
+    # vary one dimension at a time around the first value of every other one
+    configs = [dict(base)]
+    for key, values in sweeps.items():
+        configs.extend([{**base, key: value} for value in values[1:]])
+    phis = args.phi if args.phi is not None else list(range(len(all_symbolic_properties)))
+
+    results = []
+    for config in configs:
+        sgs = make_sgs(config, args.frames, args.seed)
+        n_nodes = np.mean([len(sg.nodes) for sg in sgs])
+        n_edges = np.mean([len(sg.edges) for sg in sgs])
+        for phi in phis:
+            property_name = all_symbolic_properties[phi].name
+            result = run_property(phi, sgs)
+            if args.memory:
+                result['peak_memory_mb'] = run_property(phi, sgs, memory=True)['peak_memory_mb']
+            result.update({'config': config, 'property': property_name, 'phi': phi,
+                           'mean_nodes': float(n_nodes), 'mean_edges': float(n_edges)})
+            results.append(result)
+            print(f"{config} | {property_name} | p95 {result['p95_ms']:.2f}ms | max {result['max_ms']:.2f}ms | "
+                  f"max instances {result['max_instances']}")
+    with open(args.save_folder / 'scaling.json', 'w') as f:
+        json.dump({'frames': args.frames, 'seed': args.seed, 'results': results}, f, indent=2)
+    for key, values in sweeps.items():
+        if len(values) > 1:
+            plot_curves([r for r in results if all(r['config'][k] == base[k] for k in sweeps if k != key)],
+                        key, args.save_folder)
+
+
+if __name__ == '__main__':
+    main()
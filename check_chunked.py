@@ -0,0 +1,265 @@
+"""
+Checks long routes with several processes per route by splitting them into chunks of consecutive frames.
+Every chunk is checked independently: for each binding of a property's symbolic entities, its DFA is run from every
+(non-trap) state over the chunk, which gives the state each state leads to at the end of the chunk or the frame where
+it traps, and the instances spawned inside the chunk are run from the initial state. Composing the chunks in order then
+gives exactly the verdicts of running every instance through the whole route. Predicates are evaluated lazily and
+memoized per binding, so the speculative runs mostly reuse the values of the ones before them.
+
+This is not the same semantics as SymbolicMonitor:
+1) Bindings are eager. An instance is spawned in every frame for every binding of all of its symbolic entities to
+   distinct entities present (not as phantoms) in that frame. The monitor spawns unbound instances and binds an entity
+   only once a predicate needs it, to the entities present in that later frame, and can leave entities unbound.
+   Properties that need all of their entities from their first frame get the same verdicts. Properties whose
+   predicates use defined() depend on the unbound entities, so they are skipped (and keep their earlier violations)
+   and must be checked with check_symbolic_properties.py.
+2) Instance GC (--gc_absent_frames, --gc_unviolable) does not apply.
+3) Violations are stored without their data and name history, and no stats.json or frame times are written.
+Since eager bindings grow with the product of the candidate entities, routes with more than --max_bindings bindings
+are skipped (and keep their earlier violations) rather than checked.
+Usage: python check_chunked.py -f ./study_data/tcp/run1/ -s ./results_chunked/tcp/ --n_workers 16
+"""
+import argparse
+import itertools
+import time
+from collections import defaultdict
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+
+import SG_Utils as utils
+from check_symbolic_properties import load_route
+from SymbolicEntity import ConcreteEntity
+from SymbolicMonitor import SymbolicMonitor, SymbolicViolation
+from SymbolicProperty import ConcreteProperty, valid_mapping, uses_defined
+from ViolationStore import ViolationStore
+
+# the route being checked, set before the worker pool is forked so the SGs are not sent to every worker
+_ROUTE = {}
+
+
+class TooManyBindingsError(ValueError):
+    pass
+
+
+def route_bindings(sgs, prop, max_bindings=None):
+    """
+    Every binding of the property's symbolic entities to distinct entities that are all present in at least one frame.
+    Bindings are collected frame by frame, so only combinations of entities that are present together are enumerated.
+    :param max_bindings: raise a TooManyBindingsError as soon as there are more bindings than this
+    :return: the bindings (tuples of entity ids in the order of prop.symbolic_entities) and, for each, a mask of the
+        frames where an instance is spawned for it
+    """
+    masks = {}
+    for i, sg in enumerate(sgs):
+        candidates = [[node.get_id() for node in sg.nodes if symbolic_entity.is_valid(node) and not node.is_phantom()]
+                      for symbolic_entity in prop.symbolic_entities]
+        for ids in itertools.product(*candidates):
+            if not valid_mapping(ids):
+                continue
+            if ids not in masks:
+                if max_bindings is not None and len(masks) >= max_bindings:
+                    raise TooManyBindingsError(f'{prop.name} has more than {max_bindings} bindings')
+                masks[ids] = np.zeros(len(sgs), dtype=bool)
+            masks[ids][i] = True
+    bindings = list(masks)
+    return bindings, np.array([masks[ids] for ids in bindings], dtype=bool).reshape(len(bindings), len(sgs))
+
+
+class BindingRun:
+    """Runs one binding's DFA over frames of the route, evaluating every symbol at most once per frame."""
+    def __init__(self, prop, binding, sgs):
+        self.dfa = prop.ltldfa
+        self.sgs = sgs
+        self.concrete = ConcreteProperty(prop.name, prop.ltldfa, prop.predicates, None,
+                                         {symbolic_entity: ConcreteEntity(symbolic_entity, entity_id)
+                                          for symbolic_entity, entity_id in zip(prop.symbolic_entities, binding)},
+                                         prop.symbol_to_entities, static_subtrees=prop.static_subtrees)
+        self.values = {}
+        self.n_evaluated = 0
+
+    def step(self, state, frame):
+        data = {}
+        for _, _, a in self.dfa._dfa.out_edges(state, data=True):
+            for symbol in a['symbols']:
+                if (frame, symbol) not in self.values:
+                    self.values[(frame, symbol)] = self.concrete.evaluate_symbol(self.sgs[frame], symbol)
+                    self.n_evaluated += 1
+                data[symbol] = self.values[(frame, symbol)]
+        return self.dfa._compute_next_state(state, data)
+
+    def run(self, live, start, end, spawn=None):
+        """
+        Steps the instances in live ({state: [initial frames]}) over frames [start, end), adding the instances spawned
+        in the frames where spawn is set.
+        :return: the (initial frame, frame, state) of every instance that trapped and the live instances at the end
+        """
+        trapped = []
+        for frame in range(start, end):
+            if spawn is not None and spawn[frame - start]:
+                live.setdefault(self.dfa.get_init_state(), []).append(frame)
+            stepped = {}
+            for state, initial_frames in live.items():
+                next_state = self.step(state, frame)
+                if self.dfa.is_trap_state(next_state):
+                    trapped.extend((initial_frame, frame, next_state) for initial_frame in initial_frames)
+                else:
+                    stepped.setdefault(next_state, []).extend(initial_frames)
+            live = stepped
+        return trapped, live
+
+
+def check_chunk(chunk):
+    """
+    Runs every binding over the chunk's frames.
+    :return: per property and binding, where each live state at the start of the chunk ends up ({state: ('trap', frame,
+        state) or ('live', state)}), and the trapped and live instances spawned in the chunk
+    """
+    start, end = chunk
+    sgs = _ROUTE['sgs']
+    results = {}
+    n_evaluated = 0
+    for prop in _ROUTE['properties']:
+        bindings, masks = _ROUTE['bindings'][prop.name]
+        non_trap = [state for state in prop.ltldfa._dfa.nodes
+                    if state != 'init' and not prop.ltldfa.is_trap_state(state)]
+        prop_results = []
+        for binding, mask in zip(bindings, masks):
+            if not mask[:end].any():
+                # no instance of this binding exists yet
+                prop_results.append(({}, [], {}))
+                continue
+            run = BindingRun(prop, binding, sgs)
+            transitions = {}
+            if mask[:start].any():
+                for state in non_trap:
+                    trapped, live = run.run({state: [None]}, start, end)
+                    transitions[state] = ('trap', trapped[0][1], trapped[0][2]) if len(trapped) > 0 \
+                        else ('live', next(iter(live)))
+            trapped, live = run.run({}, start, end, spawn=mask[start:end])
+            prop_results.append((transitions, trapped, live))
+            n_evaluated += run.n_evaluated
+        results[prop.name] = prop_results
+    return start, results, n_evaluated
+
+
+def compose(prop, chunk_results):
+    """The (initial frame, frame, state) of every instance that trapped, from the results of the chunks in order."""
+    bindings, _ = _ROUTE['bindings'][prop.name]
+    trapped = []
+    for b, binding in enumerate(bindings):
+        live = {}
+        for results in chunk_results:
+            transitions, chunk_trapped, chunk_live = results[prop.name][b]
+            next_live = defaultdict(list)
+            for state, initial_frames in live.items():
+                outcome = transitions[state]
+                if outcome[0] == 'trap':
+                    trapped.extend((binding, initial_frame, outcome[1], outcome[2]) for initial_frame in initial_frames)
+                else:
+                    next_live[outcome[1]].extend(initial_frames)
+            trapped.extend((binding, *instance) for instance in chunk_trapped)
+            for state, initial_frames in chunk_live.items():
+                next_live[state].extend(initial_frames)
+            live = next_live
+    return trapped
+
+
+def check_route_chunked(route_dir: Path, save_folder: Path, n_workers, chunk_size=None, ego_only=False, phi=-1,
+                        max_bindings=None):
+    """
+    Checks a route and replaces its violations of the checked properties in save_folder's ViolationStore.
+    Properties that use defined() are not checked, see the module docstring.
+    :param max_bindings: raise a TooManyBindingsError instead of checking a route whose properties have more bindings
+        than this in total, since every binding is run over every frame it is present in
+    """
+    start = time.time()
+    sgs = load_route(route_dir)
+    utils.add_missing(sgs)
+    properties = []
+    for prop in SymbolicMonitor.select_properties(ego_only, phi):
+        if any(uses_defined(predicate) for predicate in prop.predicates.values()):
+            print(f"Skipping {prop.name}: it uses defined(), check it with check_symbolic_properties.py instead")
+        else:
+            properties.append(prop)
+    bindings = {}
+    try:
+        for prop in properties:
+            remaining = max_bindings - sum(len(b) for b, _ in bindings.values()) if max_bindings is not None else None
+            bindings[prop.name] = route_bindings(sgs, prop, max_bindings=remaining)
+    except TooManyBindingsError as e:
+        utils.load_sg.cache_clear()
+        raise TooManyBindingsError(f'{route_dir.name} has more than {max_bindings} bindings, '
+                                   f'check it with check_symbolic_properties.py instead') from e
+    n_bindings = sum(len(b) for b, _ in bindings.values())
+    print(f"{route_dir.name}: {n_bindings} bindings of {len(properties)} properties over {len(sgs)} SGs")
+    _ROUTE['sgs'] = sgs
+    _ROUTE['properties'] = properties
+    _ROUTE['bindings'] = bindings
+    load_end = time.time()
+    if chunk_size is None:
+        chunk_size = max(1, -(-len(sgs) // n_workers))
+    chunks = [(i, min(i + chunk_size, len(sgs))) for i in range(0, len(sgs), chunk_size)]
+    with Pool(n_workers) as p:
+        chunk_results = sorted(p.imap_unordered(check_chunk, chunks), key=lambda result: result[0])
+    check_end = time.time()
+
+    # as in SymbolicMonitor, the id of the first ego node
+    ego_id = next((node.attr[utils.ID_ATTR] for sg in sgs for node in sg.nodes if node.name == 'ego'), None)
+    violations = []
+    for prop in properties:
+        for binding, initial_frame, frame, state in compose(prop, [results for _, results, _ in chunk_results]):
+            if prop.ltldfa.is_accepting(state):
+                continue
+            violations.append(SymbolicViolation(
+                prop.name, sgs[frame].graph['frame'], sgs[initial_frame].graph['frame'],
+                {symbolic_entity: ConcreteEntity(symbolic_entity, entity_id)
+                 for symbolic_entity, entity_id in zip(prop.symbolic_entities, binding)},
+                {}, {}, [], ego_id, step=frame))
+    violations.sort(key=lambda violation: violation.step)
+    store = ViolationStore(save_folder)
+    # as with the monitor, checking a route again replaces its violations
+    store.clear(route_dir.name, [prop.name for prop in properties])
+    store.add(route_dir.name, violations)
+    store.close()
+    n_evaluated = sum(n for _, _, n in chunk_results)
+    print(f"{route_dir.name} | {len(sgs)} SGs in {len(chunks)} chunks | {n_bindings} bindings | "
+          f"{n_evaluated} predicate evaluations | {len(violations)} violations | load {load_end - start:.2f}s | "
+          f"check {check_end - load_end:.2f}s | compose {time.time() - check_end:.2f}s")
+    _ROUTE.clear()
+    utils.load_sg.cache_clear()
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Chunked checker')
+    parser.add_argument('-f', '--folder_to_check', type=Path, required=True)
+    parser.add_argument('-s', '--save_folder', type=Path, default='default/')
+    parser.add_argument('--n_workers', type=int, default=8)
+    parser.add_argument('--chunk_size', type=int, default=None,
+                        help='Frames per chunk, by default the route is split into one chunk per worker')
+    parser.add_argument('--ego_only', action='store_true')
+    parser.add_argument('--phi', type=int, default=-1)
+    parser.add_argument('--no_iter', action='store_true', help='folder_to_check is a single route')
+    parser.add_argument('--max_bindings', type=int, default=100000,
+                        help='Skip routes whose properties have more bindings than this in total, -1 for no limit')
+    args = parser.parse_args()
+
+    dirs = [args.folder_to_check] if args.no_iter else \
+        [d for d in sorted(args.folder_to_check.iterdir()) if (d / 'rsv').is_dir()]
+    skipped = []
+    for route_dir in dirs:
+        try:
+            check_route_chunked(route_dir, args.save_folder, args.n_workers, chunk_size=args.chunk_size,
+                                ego_only=args.ego_only, phi=args.phi,
+                                max_bindings=args.max_bindings if args.max_bindings >= 0 else None)
+        except TooManyBindingsError as e:
+            print(f"Skipping {e}")
+            skipped.append(route_dir.name)
+    if len(skipped) > 0:
+        print(f"Skipped {len(skipped)} routes with too many bindings: {', '.join(skipped)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,101 +1,356 @@
 import argparse
 import json
 import os
-import re
+import shutil
+import tempfile
 import time
+from functools import partial
 from multiprocessing import Pool
 
 from tqdm import tqdm
 import SG_Utils as utils
+from SG_Utils import route_sg_names
 from SymbolicMonitor import SymbolicMonitor
+from SymbolicProperty import HistoryRetention
+from Tracer import Tracer, NULL_TRACER
+from OutlierProfiler import OutlierProfiler
+from TimingStore import TimingStore
+from ViolationStore import ViolationStore
+from RouteQueue import RouteQueue
+from ResultCache import ResultCache
+import route_scheduling
 from pathlib import Path
 
 
-def atof(text):
-    try:
-        retval = float(text)
-    except ValueError:
-        retval = text
-    return retval
-
-
-def natural_keys(text):
-    '''
-    alist.sort(key=natural_keys) sorts in human order
-    http://nedbatchelder.com/blog/200712/human_sorting.html
-    (See Toothy's implementation in the comments)
-    float regex comes from https://stackoverflow.com/a/12643073/190597
-    '''
-    return [atof(c) for c in re.split(r'[+-]?([0-9]+(?:[.][0-9]*)?|[.][0-9]+)',
-                                      text)]
-
-
-def check_directory_single_thread(dir_to_check, save_folder, threaded=False, ego_only=False, phi=-1, run=0):
-    m = SymbolicMonitor(log_path=save_folder, route_path=dir_to_check.name)
-    m.initialize(m.log_path, m.route_path, ego_only=ego_only, phi=phi)
+def load_route(dir_to_check, progress=False, tracer=NULL_TRACER):
+    """Loads a route's SGs in frame order, with frame names, empty caches and the ego log applied (no phantoms)."""
     rsv_folder = dir_to_check/'rsv'
-    sg_name_list = [p for p in os.listdir(rsv_folder) if p.endswith(".pkl")]
-    sg_name_list = sorted(sg_name_list, key=natural_keys)
-    print(f"{str(dir_to_check)}: Checking {len(sg_name_list)} files")
-    start = time.time()
-    sgs = []
     ego_logs_path = dir_to_check/'ego_logs.json'
     ego_logs = None
     if ego_logs_path.exists():
         ego_logs = json.loads(ego_logs_path.read_text())['records']
-    for sg_name in tqdm(sg_name_list, disable=threaded):
-        sg = utils.load_sg(str(rsv_folder / sg_name))
+    sgs = []
+    for sg_name in tqdm(route_sg_names(dir_to_check), disable=not progress):
+        frame = sg_name.replace('.pkl', '')
+        with tracer.span('load', frame=frame):
+            sg = utils.load_sg(str(rsv_folder / sg_name))
         sg.graph['name'] = sg_name
-        sg.graph['frame'] = sg_name.replace('.pkl', '')
+        sg.graph['frame'] = frame
         sg.graph['cache'] = {}
         if ego_logs is not None:
-            cur_log = ego_logs[int(sg.graph['frame'])]
-            ego_node = [node for node in sg.nodes if node.name == 'ego'][0]
-            ego_node.attr['carla_speed'] = cur_log['state']['velocity']['value']
+            with tracer.span('ego_log', frame=frame):
+                utils.inject_ego_log(sg, ego_logs[int(sg.graph['frame'])])
         sgs.append(sg)
-    load_sg_end = time.time()
-    print(f"Took {load_sg_end - start:.2f} seconds to load SGs")
-    utils.add_missing(sgs)
-    print(f"Took {time.time() - load_sg_end:.2f} seconds to add missing SGs")
+    return sgs
+
+
+def checkpoint_path(save_folder, route, ego_only, phi, run):
+    return save_folder / 'checkpoints' / f'{route}_{"ego" if ego_only else "all"}_phi_{phi}_run_{run}.ckpt'
+
+
+def check_sgs(m: SymbolicMonitor, sgs, progress=False, checkpoint=None, checkpoint_every=None, resume=False):
+    """
+    Checks the SGs of a route in order with a fresh cache for every frame, returns the time of each check in ns.
+    With checkpoint_every, the monitor state is saved to checkpoint every that many frames; with resume, checking
+    continues from the checkpoint if there is one.
+    """
     frame_times = []
-    for sg in tqdm(sgs, disable=threaded):
+    if resume and checkpoint is not None and checkpoint.exists():
+        frame_times = m.load_checkpoint(checkpoint)['frame_times']
+        print(f"Resuming from {checkpoint} at frame {len(frame_times)}")
+    for sg in tqdm(sgs[len(frame_times):], disable=not progress):
+        sg.graph['cache'] = {}
         ns_start = time.time_ns()
         m.check(sg, save_usage_information=True)
         total_time = time.time_ns() - ns_start
         frame_times.append(total_time)
-    data = {
-        "folder": dir_to_check.name,
-        "ego_only": ego_only,
-        "phi": phi,
-        "run": run,
-        "frame_times": frame_times
-    }
+        if checkpoint_every is not None and len(frame_times) % checkpoint_every == 0:
+            m.save_checkpoint(checkpoint, frame_times=frame_times)
+    return frame_times
+
+
+def save_frame_times(save_folder, route, ego_only, phi, run, frame_times, frame_times_json=False):
+    TimingStore(save_folder).append(save_folder.name, route, ego_only, phi, run, frame_times)
+    if frame_times_json:
+        ego_only_str = 'ego' if ego_only else 'all'
+        data = {
+            "folder": route,
+            "ego_only": ego_only,
+            "phi": phi,
+            "run": run,
+            "frame_times": frame_times
+        }
+        frame_time_file = save_folder / f'{route}_frame_times_{ego_only_str}_phi_{phi}_run_{run}.json'
+        with open(frame_time_file, 'w') as f:
+            json.dump(data, f)
+
+
+def cached_results(cache: ResultCache, dir_to_check, ego_only, phi, monitor_options):
+    """
+    Looks up the results of the properties selected by ego_only and phi on the route.
+    :return: the properties that still have to be checked, the cache key of every property and the cached entries
+    """
+    route_hash = ResultCache.route_hash(dir_to_check)
+    to_check, keys, cached = [], {}, {}
+    for prop in SymbolicMonitor.select_properties(ego_only, phi):
+        keys[prop.name] = ResultCache.key(route_hash, prop, monitor_options)
+        entry = cache.get(keys[prop.name])
+        if entry is None:
+            to_check.append(prop)
+        else:
+            cached[prop.name] = entry
+    print(f"{dir_to_check}: {len(cached)} properties cached, {len(to_check)} to check")
+    return to_check, keys, cached
+
+
+def complete_from_cache(m: SymbolicMonitor, cache: ResultCache, keys, cached):
+    """Caches the results of the properties m checked and adds the cached results of the others to m's output."""
+    for prop in m.symbolic_properties:
+        cache.put(keys[prop.name], {
+            'property': prop.name,
+            'violations': ViolationStore.rows(m.violations[prop.name]),
+            'iterations': {frame: iterations.get(prop.name, 0) for frame, iterations in m.iterations_per_frame.items()},
+        })
+    if len(cached) == 0:
+        return
+    # added only now, so an interrupted run that is resumed does not add them twice
+    store = ViolationStore(m.log_path)
+    store.clear(m.route_path.name, list(cached))
+    for name, entry in cached.items():
+        store.add_rows(m.route_path.name, entry['violations'])
+        for frame, n in entry['iterations'].items():
+            m.iterations_per_frame.setdefault(frame, {})[name] = n
+    store.close()
+
+
+def check_directory_single_thread(dir_to_check, save_folder, threaded=False, ego_only=False, phi=-1, run=0,
+                                  trace=False, frame_times_json=False, checkpoint_every=None, resume=False,
+                                  cache: ResultCache = None, **monitor_options):
+    properties, keys, cached = None, {}, {}
+    if cache is not None:
+        properties, keys, cached = cached_results(cache, dir_to_check, ego_only, phi, monitor_options)
+        if len(properties) == 0:
+            m = SymbolicMonitor(log_path=save_folder, route_path=dir_to_check.name, properties=[], **monitor_options)
+            complete_from_cache(m, cache, keys, cached)
+            m.save_final_output()
+            return
     ego_only_str = 'ego' if ego_only else 'all'
-    frame_time_file = save_folder / f'{dir_to_check.name}_frame_times_{ego_only_str}_phi_{phi}_run_{run}.json'
-    with open(frame_time_file, 'w') as f:
-        json.dump(data, f)
+    tracer = NULL_TRACER
+    if trace:
+        tracer = Tracer(save_folder / 'traces' / f'{dir_to_check.name}_{ego_only_str}_phi_{phi}_run_{run}.json',
+                        route=dir_to_check.name)
+    m = SymbolicMonitor(log_path=save_folder, route_path=dir_to_check.name, ego_only=ego_only, phi=phi,
+                        tracer=tracer, properties=properties, **monitor_options)
+    sg_name_list = route_sg_names(dir_to_check)
+    print(f"{str(dir_to_check)}: Checking {len(sg_name_list)} files")
+    start = time.time()
+    sgs = load_route(dir_to_check, progress=not threaded, tracer=tracer)
+    load_sg_end = time.time()
+    print(f"Took {load_sg_end - start:.2f} seconds to load SGs")
+    with tracer.span('add_missing'):
+        utils.add_missing(sgs)
+    print(f"Took {time.time() - load_sg_end:.2f} seconds to add missing SGs")
+    checkpoint = checkpoint_path(save_folder, dir_to_check.name, ego_only, phi, run)
+    frame_times = check_sgs(m, sgs, progress=not threaded, checkpoint=checkpoint, checkpoint_every=checkpoint_every,
+                            resume=resume)
+    if cache is not None:
+        complete_from_cache(m, cache, keys, cached)
     m.save_final_output()
+    # written last, the frame times mark the route as done for --resume
+    save_frame_times(save_folder, dir_to_check.name, ego_only, phi, run, frame_times, frame_times_json)
+    checkpoint.unlink(missing_ok=True)
+    tracer.close()
     end = time.time()
     print(f"{str(dir_to_check)} | Checked {len(sg_name_list)} SGs | Total time taken: {end - start:.2f} seconds | Average time per SG: {(end - start) / len(sg_name_list):.2f} seconds")
 
-def check_directory(dir_to_check, save_folder, sgs, threaded=False):
-    m = SymbolicMonitor(log_path=save_folder, route_path=dir_to_check.name)
-    rsv_folder = dir_to_check/'rsv'
-    sg_name_list = [p for p in os.listdir(rsv_folder) if p.endswith(".pkl")]
-    sg_name_list = sorted(sg_name_list, key=natural_keys)
+def check_directory(dir_to_check, save_folder, threaded=False, ego_only=False, phi=-1, run=0, checkpoint_every=None,
+                    resume=False, cache: ResultCache = None, **monitor_options):
+    """Loads and checks one route, runs in a worker process with --threaded so only the path is sent to it."""
     start = time.time()
+    properties, keys, cached = None, {}, {}
+    if cache is not None:
+        properties, keys, cached = cached_results(cache, dir_to_check, ego_only, phi, monitor_options)
+        if len(properties) == 0:
+            m = SymbolicMonitor(log_path=save_folder, route_path=dir_to_check.name, properties=[], **monitor_options)
+            complete_from_cache(m, cache, keys, cached)
+            m.save_final_output()
+            return dir_to_check.name, 0, time.time() - start
+    m = SymbolicMonitor(log_path=save_folder, route_path=dir_to_check.name, ego_only=ego_only, phi=phi,
+                        properties=properties, **monitor_options)
+    sgs = load_route(dir_to_check, progress=not threaded)
+    load_sg_end = time.time()
     utils.add_missing(sgs)
-    print(f"Took {time.time() - start:.2f} seconds to add missing SGs")
-    for sg in tqdm(sgs, disable=threaded):
-        m.check(sg, save_usage_information=True)
-        # m.save_all_relevant_subgraphs(sg, sg_name.replace('.pkl', ''))
+    checkpoint = checkpoint_path(save_folder, dir_to_check.name, ego_only, phi, run)
+    frame_times = check_sgs(m, sgs, progress=not threaded, checkpoint=checkpoint, checkpoint_every=checkpoint_every,
+                            resume=resume)
+    if cache is not None:
+        complete_from_cache(m, cache, keys, cached)
     m.save_final_output()
+    # kept so that the next batch can be scheduled from these times (see route_scheduling), and marks the route as done
+    save_frame_times(save_folder, dir_to_check.name, ego_only, phi, run, frame_times)
+    checkpoint.unlink(missing_ok=True)
     end = time.time()
-    print(f"{str(dir_to_check)} | Checked {len(sg_name_list)} SGs | Total time taken: {end - start:.2f} seconds | Average time per SG: {(end - start) / len(sg_name_list):.2f} seconds")
+    print(f"{str(dir_to_check)} | Checked {len(sgs)} SGs | Load time: {load_sg_end - start:.2f} seconds | Total time taken: {end - start:.2f} seconds | Average time per SG: {(end - start) / max(len(sgs), 1):.2f} seconds")
+    return dir_to_check.name, len(sgs), end - start
+
+def try_check_directory(dir_to_check, **kwargs):
+    """check_directory for a worker pool: returns (route, None, error) instead of raising, so that one route that
+    cannot be checked does not stop the others."""
+    try:
+        return check_directory(dir_to_check, **kwargs)
+    except Exception as e:
+        return dir_to_check.name, None, e
+
+def stage_results(local_folder: Path, results_root: Path, route: str, tag: str):
+    """
+    Copies the route folder a worker wrote in its local save folder next to its place in the shared results root,
+    under a hidden name that is unique to tag. Returns the staged folder, or None if the route has no folder.
+    The copy is the slow part of an upload, staging it keeps it out of the window between completing a lease and
+    publishing its results.
+    """
+    if not (local_folder / route).exists():
+        return None
+    results_root.mkdir(parents=True, exist_ok=True)
+    staged = results_root / f'.{route}.{tag}.uploading'
+    shutil.rmtree(staged, ignore_errors=True)
+    try:
+        shutil.copytree(local_folder / route, staged)
+    except BaseException:
+        shutil.rmtree(staged, ignore_errors=True)
+        raise
+    return staged
+
+
+def upload_results(local_folder: Path, results_root: Path, route: str, staged: Path = None):
+    """
+    Moves what a worker wrote for one route in its local save folder into the shared results root: the route folder
+    (staged with stage_results) replaces any earlier one, the route's violations replace its rows in the results
+    root's ViolationStore and its frame times are appended to the TimingStore.
+    """
+    results_root.mkdir(parents=True, exist_ok=True)
+    if staged is not None:
+        shutil.rmtree(results_root / route, ignore_errors=True)
+        os.rename(staged, results_root / route)
+    for folder in ['outlier_profiles', 'traces']:
+        if (local_folder / folder).exists():
+            shutil.copytree(local_folder / folder, results_root / folder, dirs_exist_ok=True)
+    store = ViolationStore(results_root)
+    store.merge(local_folder, [route])
+    store.close()
+    if TimingStore.exists(local_folder):
+        TimingStore(results_root).merge(TimingStore(local_folder))
+
+
+def run_coordinator(queue: RouteQueue, folder_to_check: Path, save_folder: Path, ego_only=False, phi=-1, run=0,
+                    probe=True, poll_interval=10):
+    """Enqueues the routes of folder_to_check, most expensive first, then requeues stale leases until all are done."""
+    dirs = [d for d in sorted(folder_to_check.iterdir()) if (d / 'rsv').is_dir()]
+    estimates = route_scheduling.estimate_costs(dirs, save_folder, ego_only=ego_only, phi=phi, probe=probe)
+    # workers lease in priority order, which makes the queue an LPT schedule over however many workers there are
+    order = sorted(estimates, key=lambda route: estimates[route][0], reverse=True)
+    ego_only_str = 'ego' if ego_only else 'all'
+    n_added = 0
+    for priority, route in enumerate(order):
+        task = {'route_dir': str((folder_to_check / route).resolve()), 'save_folder': str(save_folder.resolve()),
+                'ego_only': ego_only, 'phi': phi, 'run': run}
+        n_added += queue.enqueue(f'{route}_{ego_only_str}_phi_{phi}_run_{run}', task, priority=priority)
+    print(f"Enqueued {n_added} of {len(order)} routes")
+    start = time.time()
+    while not queue.is_finished():
+        for file_name in queue.requeue_stale():
+            print(f"Requeued {file_name}, its lease expired")
+        counts = queue.counts()
+        print(f"{time.time() - start:.0f}s | " + ' | '.join(f'{state}: {n}' for state, n in counts.items()))
+        time.sleep(poll_interval)
+    counts = queue.counts()
+    print(f"Finished in {time.time() - start:.2f} seconds, {counts['done']} done, {counts['failed']} failed")
+
+
+def run_worker(queue: RouteQueue, local_folder: Path, poll_interval=10, cache: ResultCache = None, **monitor_options):
+    """Checks leased routes until the queue is finished, uploading the results of each to its shared save folder."""
+    while True:
+        queue.requeue_stale()
+        lease = queue.lease()
+        if lease is None:
+            if queue.is_finished():
+                return
+            # other workers still hold leases, which may expire and come back
+            time.sleep(poll_interval)
+            continue
+        task = lease.task
+        save_folder = Path(task['save_folder'])
+        route_dir = Path(task['route_dir'])
+        task_folder = local_folder / lease.file_name.replace('.json', '')
+        local_save_folder = task_folder / save_folder.name
+        staged = None
+        try:
+            # leaving the lease with an exception requeues the task, or moves it to failed after max_attempts
+            with lease:
+                shutil.rmtree(task_folder, ignore_errors=True)
+                check_directory(route_dir, local_save_folder, threaded=True, ego_only=task['ego_only'],
+                                phi=task['phi'], run=task['run'], cache=cache, **monitor_options)
+                # a lease that expired was given to another worker, whose results win: nothing is published
+                # before the task is marked done, which only succeeds while this worker still holds the lease
+                staged = stage_results(local_save_folder, save_folder, route_dir.name, lease.leased_name)
+                if lease.complete():
+                    upload_results(local_save_folder, save_folder, route_dir.name, staged=staged)
+                else:
+                    print(f"Lost the lease of {lease.file_name} while uploading, another worker checks it again")
+        except Exception as e:
+            # one route that cannot be checked must not stop this worker from checking the others
+            print(f"Failed to check {route_dir}: {e!r}")
+        finally:
+            shutil.rmtree(task_folder, ignore_errors=True)
+            # left over if the lease was lost or the upload failed, gone once it was moved into place
+            if staged is not None:
+                shutil.rmtree(staged, ignore_errors=True)
+
+
+def add_monitor_arguments(parser):
+    parser.add_argument('--history', choices=HistoryRetention.MODES, default='all',
+                        help='How much per-frame history each property instance keeps in memory')
+    parser.add_argument('--history_window', type=int, default=None,
+                        help='Number of frames kept when using --history window')
+    parser.add_argument('--history_spill_dir', type=Path, default=None,
+                        help='If set, history evicted from memory is written here instead of being dropped')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only re-evaluate predicates whose inputs changed since the previous frame')
+    parser.add_argument('--gc_absent_frames', type=int, default=None,
+                        help='Retire property instances bound to an entity that has been absent for this many frames. '
+                             'Retired instances are discarded without a verdict, like the instances still live at the '
+                             'end of a route, even if they are in a rejecting state (counted as absent_rejecting in '
+                             'gc_stats.json); violations they would have reached after the entity left are not found')
+    parser.add_argument('--gc_unviolable', action='store_true',
+                        help='Retire property instances as soon as their DFA can no longer reach a violation')
+    parser.add_argument('--profile', action='store_true',
+                        help='Write per-predicate evaluation counts, timings and cache statistics to profile.json')
+    parser.add_argument('--outlier_threshold_ms', type=float, default=None,
+                        help='Save a profile of every frame that takes longer than this to <save_folder>/outlier_profiles')
+    parser.add_argument('--outlier_mode', choices=OutlierProfiler.MODES, default='sample',
+                        help='Profile outlier frames by sampling stacks (cheap) or with cProfile (exact)')
+    parser.add_argument('--predicate_trace', action='store_true',
+                        help='Write the value of every predicate per binding and frame to <route>/predicate_trace.npz, '
+                             'so that other formulas can be checked with recheck_traces.py')
+
+
+def monitor_options_from_args(args):
+    """SymbolicMonitor keyword arguments for the options added by add_monitor_arguments."""
+    return {
+        'history_retention': HistoryRetention(args.history, window=args.history_window,
+                                              spill_dir=args.history_spill_dir),
+        'incremental': args.incremental,
+        'gc_absent_frames': args.gc_absent_frames,
+        'gc_unviolable': args.gc_unviolable,
+        'profile': args.profile,
+        'outlier_threshold_ms': args.outlier_threshold_ms,
+        'outlier_mode': args.outlier_mode,
+        'predicate_trace': args.predicate_trace,
+    }
+
 
 def main():
     parser = argparse.ArgumentParser(prog='Property checker')
-    parser.add_argument('-f', '--folder_to_check', type=Path, required=True)
+    parser.add_argument('-f', '--folder_to_check', type=Path, default=None)
     parser.add_argument('-s', '--save_folder', type=Path, default='default/')
     parser.add_argument('-t', '--threaded', action='store_true')
     parser.add_argument('--n_threads', type=int, default=8)
@@ -103,53 +358,120 @@ def main():
     parser.add_argument('--phi', type=int, default=-1)
     parser.add_argument('--run', type=int, default=0)
     parser.add_argument('--no_iter', action='store_true')
+    parser.add_argument('--no_probe', action='store_true',
+                        help='With --threaded, estimate the cost of routes without history from their frame count '
+                             'instead of probing a few of their SGs')
+    parser.add_argument('--trace', action='store_true',
+                        help='Write a Chrome trace-event file per route to <save_folder>/traces')
+    parser.add_argument('--frame_times_json', action='store_true',
+                        help='Also write the frame times of every route to a <route>_frame_times_*.json file')
+    parser.add_argument('--checkpoint_every', type=int, default=None,
+                        help='Save the monitor state every this many frames to <save_folder>/checkpoints')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip routes whose frame times are already in the save folder and continue the others '
+                             'from their checkpoint, if there is one')
+    parser.add_argument('--cache', type=Path, default=None,
+                        help='Result cache folder: properties whose definition and route files did not change since '
+                             'they were last checked with the same options are taken from it instead of being '
+                             'checked. The frame times then only cover the properties that were checked')
+    parser.add_argument('--queue', type=Path, default=None,
+                        help='Shared queue folder for checking routes on several machines, see --coordinator/--worker')
+    role = parser.add_mutually_exclusive_group()
+    role.add_argument('--coordinator', action='store_true',
+                      help='Enqueue the routes of --folder_to_check into --queue and wait until workers checked them')
+    role.add_argument('--worker', action='store_true',
+                      help='Check routes from --queue (in --n_threads processes with --threaded) and upload the '
+                           'results to the save folder given by the coordinator')
+    parser.add_argument('--local_folder', type=Path, default=None,
+                        help='Where a worker writes results before uploading them, a temporary folder by default')
+    parser.add_argument('--lease_timeout', type=float, default=300,
+                        help='Seconds without a heartbeat after which a leased route is given to another worker')
+    add_monitor_arguments(parser)
     args = parser.parse_args()
+    monitor_options = monitor_options_from_args(args)
+    cache = ResultCache(args.cache) if args.cache is not None else None
+    if (args.coordinator or args.worker) and args.queue is None:
+        parser.error('--coordinator and --worker need --queue')
+    if not args.worker and args.folder_to_check is None:
+        parser.error('--folder_to_check is required')
+
+    if args.coordinator:
+        run_coordinator(RouteQueue(args.queue, lease_timeout=args.lease_timeout), args.folder_to_check,
+                        args.save_folder, ego_only=args.ego_only, phi=args.phi, run=args.run,
+                        probe=not args.no_probe)
+        return
+    if args.worker:
+        with tempfile.TemporaryDirectory() as tmp:
+            local_folder = args.local_folder if args.local_folder is not None else Path(tmp)
+            worker = partial(run_worker, RouteQueue(args.queue, lease_timeout=args.lease_timeout), local_folder,
+                             cache=cache, **monitor_options)
+            if args.threaded:
+                with Pool(args.n_threads) as p:
+                    for r in [p.apply_async(worker) for _ in range(args.n_threads)]:
+                        r.get()
+            else:
+                worker()
+        return
 
     dirs = [p for p in args.folder_to_check.iterdir()]
+    checkpoint_options = {'checkpoint_every': args.checkpoint_every, 'resume': args.resume}
+    completed = TimingStore(args.save_folder).completed_runs() if args.resume else set()
+    dirs = [d for d in dirs if (d.name, args.ego_only, args.phi, args.run) not in completed]
     if args.threaded:
-        results = []
+        # workers load their own routes; the most expensive go first so that no long route is started last
+        dirs = {d.name: d for d in dirs if (d / 'rsv').is_dir()}
+        estimates = route_scheduling.estimate_costs(list(dirs.values()), args.save_folder, ego_only=args.ego_only,
+                                                    phi=args.phi, probe=not args.no_probe)
+        order, _, _ = route_scheduling.lpt_schedule({route: cost for route, (cost, _) in estimates.items()},
+                                                    args.n_threads)
+        worker = partial(try_check_directory, save_folder=args.save_folder, threaded=True, ego_only=args.ego_only,
+                         phi=args.phi, run=args.run, cache=cache, **checkpoint_options, **monitor_options)
+        actual_times = {}
+        failed = {}
+        start = time.time()
         with Pool(args.n_threads) as p:
-            for d in dirs:
-                # Check if d is a directory
-                if d.is_dir():
-                    print(d)
-                    start = time.time()
-                    rsv_folder = Path(d) /'rsv'
-                    sg_name_list = [p for p in os.listdir(rsv_folder) if p.endswith(".pkl")]
-                    sg_name_list = sorted(sg_name_list, key=natural_keys)
-                    sgs = []
-                    ego_logs_path = Path(d) /'ego_logs.json'
-                    ego_logs = None
-                    if ego_logs_path.exists():
-                        ego_logs = json.loads(ego_logs_path.read_text())['records']
-                    for sg_name in tqdm(sg_name_list, disable=False):
-                        sg = utils.load_sg(str(rsv_folder / sg_name))
-                        sg.graph['name'] = sg_name
-                        sg.graph['frame'] = sg_name.replace('.pkl', '')
-                        sg.graph['cache'] = {}
-                        if ego_logs is not None:
-                            cur_log = ego_logs[int(sg.graph['frame'])]
-                            ego_node = [node for node in sg.nodes if node.name == 'ego'][0]
-                            ego_node.attr['carla_speed'] = cur_log['state']['velocity']['value']
-                        sgs.append(sg)
-                    print(f"Took {time.time() - start:.2f} seconds to load all SGs")
-                    results.append(p.apply_async(check_directory, (d, args.save_folder, sgs, True)))
-                else:
+            for i, (route, n_frames, result) in enumerate(
+                    p.imap_unordered(worker, [dirs[route] for route in order], chunksize=1)):
+                if n_frames is None:
+                    # a failed route's time says nothing about its cost, so it is left out of the report's times
+                    failed[route] = repr(result)
+                    print(f"[{i + 1}/{len(dirs)}] {route} failed: {result!r}")
                     continue
-            for r in results:
-                r.wait()
+                actual_times[route] = result
+                print(f"[{i + 1}/{len(dirs)}] {route} done ({n_frames} SGs in {result:.2f} seconds, "
+                      f"estimated {estimates[route][0]:.2f} from {estimates[route][1]})")
+        report = route_scheduling.makespan_report(estimates, args.n_threads, actual_times, time.time() - start)
+        report['failed'] = failed
+        if len(failed) > 0:
+            print(f"{len(failed)} routes failed: {', '.join(sorted(failed))}")
+        route_scheduling.print_report(report)
+        with open(args.save_folder / 'schedule_report.json', 'w') as f:
+            json.dump(report, f, indent=2)
     else:
         if args.no_iter:
+            if (args.folder_to_check.name, args.ego_only, args.phi, args.run) in completed:
+                print(f"{args.folder_to_check} was already checked")
+                return
             check_directory_single_thread(args.folder_to_check, args.save_folder, False,
                                               ego_only=args.ego_only,
                                               phi=args.phi,
-                                              run=args.run)
+                                              run=args.run,
+                                              trace=args.trace,
+                                              frame_times_json=args.frame_times_json,
+                                              cache=cache,
+                                              **checkpoint_options,
+                                              **monitor_options)
         else:
             for d in sorted(dirs):
                 check_directory_single_thread(d, args.save_folder, False,
                                               ego_only=args.ego_only,
                                               phi=args.phi,
-                                              run=args.run)
+                                              run=args.run,
+                                              trace=args.trace,
+                                              frame_times_json=args.frame_times_json,
+                                              cache=cache,
+                                              **checkpoint_options,
+                                              **monitor_options)
 
 
 if __name__ == "__main__":
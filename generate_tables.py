@@ -1,9 +1,27 @@
+import argparse
 import json
 import os
 import pandas as pd
-from typing import Tuple
+from functools import partial
+from multiprocessing import Pool
+from typing import Dict, Tuple
 from pathlib import Path
 
+from ResultManifest import ResultManifest
+from ViolationStore import ViolationStore
+
+RESULT_ROOTS = {
+    "tcp": Path("./results/tcp/"),
+    "lav": Path("./results/lav/"),
+    "interfuser": Path("./results/interfuser/"),
+    "scenarios": Path("./results/scenarios/"),
+}
+AV_LABELS = {
+    "tcp": "TCP~\\cite{wu2022trajectory} ",
+    "lav": "LAV~\\cite{chen2022lav}  ",
+    "interfuser": "InterFuser~\\cite{shao2023safety}",
+}
+
 EXCLUDED_PROPERTIES = [
     "816_vehicle2_cannot_follow_vehicle1_10_visible",
     "816_vehicle2_cannot_follow_vehicle1_50_visible",
@@ -109,19 +127,34 @@ def create_df_from_violations(violations_dict: dict) -> pd.DataFrame:
     df.columns = pd.MultiIndex.from_tuples(columns)
     return df
 
-def parse_properties_check(base_folder: Path) -> Tuple[pd.DataFrame, pd.DataFrame]:
+def read_store_counts(store_path: Path) -> list:
+    store = ViolationStore(store_path.parent)
+    counts = [[route, violation_name, entity, all_d]
+              for (route, violation_name, entity), all_d in store.ego_counts().items()]
+    store.close()
+    return counts
+
+def parse_properties_check(base_folder: Path, use_manifest=True) -> Tuple[pd.DataFrame, pd.DataFrame]:
     violations_dict = {}
     all_dfa_stats = {}
-    for folder in os.listdir(base_folder):
+    # only files that changed since the last call are parsed again, see ResultManifest
+    manifest = ResultManifest(base_folder)
+    if not use_manifest:
+        manifest.entries = {}
+    # results written by the current monitor live in a single ViolationStore, older results are one JSON per violation
+    use_store = ViolationStore.exists(base_folder)
+    for folder in sorted(os.listdir(base_folder)):
+        if not os.path.isdir(base_folder / folder):
+            continue
         violations_dict[folder] = {}
         subfolder_list = os.listdir(base_folder / folder)
         if "stats.json" not in subfolder_list:
             print(f"{base_folder / folder} does not have stats.json")
             continue
         else:
-            dfa_stats = process_stats_json(base_folder / folder / "stats.json")
+            dfa_stats = manifest.get(base_folder / folder / "stats.json", process_stats_json)
             all_dfa_stats[folder] = dfa_stats
-        if len(subfolder_list) > 1:
+        if len(subfolder_list) > 1 and not use_store:
             for subfolder in subfolder_list:
                 if subfolder in EXCLUDED_PROPERTIES:
                     continue
@@ -135,63 +168,68 @@ def parse_properties_check(base_folder: Path) -> Tuple[pd.DataFrame, pd.DataFram
                     }
                     for json_file in os.listdir(violation_dir):
                         json_file_path = violation_dir / json_file
-                        d = process_violation_json(json_file_path, violation_name)
+                        d = manifest.get(json_file_path, partial(process_violation_json, violation_name=violation_name))
                         all_d["ego"] += d["ego"]
                         all_d["other"] += d["other"]
                     violations_dict[folder][PROPERTIES_MAPPING[violation_name]["name"]] = all_d
+    if use_store:
+        store_path = base_folder / ViolationStore.FILE_NAME
+        # with WAL, recent appends may only be in the -wal file
+        counts = manifest.get(store_path, read_store_counts, extra_paths=[store_path.with_name(store_path.name + '-wal')])
+        for route, violation_name, entity, all_d in counts:
+            if route not in all_dfa_stats or violation_name in EXCLUDED_PROPERTIES:
+                continue
+            if entity == PROPERTIES_MAPPING[violation_name]["violating_entity"]:
+                violations_dict[route][PROPERTIES_MAPPING[violation_name]["name"]] = all_d
+    manifest.save()
     violations_df = create_df_from_violations(violations_dict)
     dfa_stats_df = pd.DataFrame(all_dfa_stats).T
     return violations_df, dfa_stats_df
 
+def load_results(roots=None, n_workers=None, use_manifest=True) -> Dict[str, Tuple[pd.DataFrame, pd.DataFrame]]:
+    """
+    (violations_df, dfa_stats_df) of every results root, by name. The roots are parsed in parallel, one process each.
+    """
+    roots = RESULT_ROOTS if roots is None else roots
+    names = list(roots)
+    if n_workers == 1 or len(names) == 1:
+        return {name: parse_properties_check(roots[name], use_manifest) for name in names}
+    with Pool(min(n_workers or len(names), len(names))) as p:
+        parsed = p.starmap(parse_properties_check, [(roots[name], use_manifest) for name in names])
+    return dict(zip(names, parsed))
 
 
-# ## Autonomous Vehicles (TCP, InterFuser, LAV)
-tcp_violations_df, tcp_dfa_stats_df = parse_properties_check(
-    Path("./results/tcp/"))
-lav_violations_df, lav_dfa_stats_df = parse_properties_check(
-    Path("./results/lav/"))
-interfuser_violations_df, interfuser_dfa_stats_df = parse_properties_check(
-    Path("./results/interfuser/"))
 
-# Sum the tcp_violations_df
-aggregated_tcp_violations = tcp_violations_df.sum()
-# Convert the Series to a DataFrame and set the index to "TCP"
-aggregated_tcp_violations = aggregated_tcp_violations.to_frame().T
-aggregated_tcp_violations.index = ["TCP~\cite{wu2022trajectory} "]
-# Sum the lav_violations_df
-aggregated_lav_violations = lav_violations_df.sum()
-# Convert the Series to a DataFrame and set the index to "LAV"
-aggregated_lav_violations = aggregated_lav_violations.to_frame().T
-aggregated_lav_violations.index = ["LAV~\cite{chen2022lav}  "]
-# Sum the lav_violations_df
-aggregated_interfuser_violations = interfuser_violations_df.sum()
-# Convert the Series to a DataFrame and set the index to "InterFuser"
-aggregated_interfuser_violations = aggregated_interfuser_violations.to_frame().T
-aggregated_interfuser_violations.index = ["InterFuser~\cite{shao2023safety}"]
-# Concatenate the DataFrames
-aggregated_violations = pd.concat([aggregated_tcp_violations, aggregated_lav_violations])
-aggregated_violations = pd.concat([aggregated_violations, aggregated_interfuser_violations])
-# Append the total row to the DataFrame with the index "Total"
-total_row = aggregated_violations.sum()
-aggregated_violations.loc['Total'] = total_row
-# Rename the sub-columns
-aggregated_violations = aggregated_violations.rename(columns={'ego': 'e', 'other': 'o'}, level=1)
-# Replace all 0 with '-'
-aggregated_violations = aggregated_violations.replace(0, '-')
-# Switch position of col 1 and col 2
-cols = list(aggregated_violations.columns)
-cols[0], cols[1], cols[2], cols[3] = cols[2], cols[3], cols[0], cols[1]
-# Drop last 2 columns
-cols = cols[:-2]
-aggregated_violations = aggregated_violations[cols]
-print(aggregated_violations)
+def av_violations_table(results: Dict[str, Tuple[pd.DataFrame, pd.DataFrame]]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Violations summed over the routes of each autonomous vehicle, all properties and the ones shown in the paper."""
+    # ## Autonomous Vehicles (TCP, InterFuser, LAV)
+    aggregated = []
+    for name, label in AV_LABELS.items():
+        # Sum the violations of the AV and convert the Series to a DataFrame with the AV as index
+        aggregated_av_violations = results[name][0].sum().to_frame().T
+        aggregated_av_violations.index = [label]
+        aggregated.append(aggregated_av_violations)
+    # Concatenate the DataFrames
+    aggregated_violations = pd.concat(aggregated)
+    # Append the total row to the DataFrame with the index "Total"
+    total_row = aggregated_violations.sum()
+    aggregated_violations.loc['Total'] = total_row
+    # Rename the sub-columns
+    aggregated_violations = aggregated_violations.rename(columns={'ego': 'e', 'other': 'o'}, level=1)
+    # Replace all 0 with '-'
+    aggregated_violations = aggregated_violations.replace(0, '-')
+    # Switch position of col 1 and col 2
+    cols = list(aggregated_violations.columns)
+    cols[0], cols[1], cols[2], cols[3] = cols[2], cols[3], cols[0], cols[1]
+    # Drop last 2 columns
+    cols = cols[:-2]
+    aggregated_violations = aggregated_violations[cols]
 
-
-df_dropped = aggregated_violations.drop(
-    columns=['$\phi_1^{50}$', '$\phi_1^{10}$', "$\phi_4$", "$\phi_5$", "$\phi_6$", "$\phi_8^{10}$"], level=0)
-# Replace NaN back with '-'
-df_dropped = df_dropped.replace(pd.NA, '-')
-print(df_dropped)
+    df_dropped = aggregated_violations.drop(
+        columns=['$\phi_1^{50}$', '$\phi_1^{10}$', "$\phi_4$", "$\phi_5$", "$\phi_6$", "$\phi_8^{10}$"], level=0)
+    # Replace NaN back with '-'
+    df_dropped = df_dropped.replace(pd.NA, '-')
+    return aggregated_violations, df_dropped
 
 
 
@@ -221,67 +259,82 @@ def post_process_latex(latex: str) -> str:
 
 
 
-# latex = aggregated_violations.to_latex(escape=False)
-latex = df_dropped.to_latex(escape=False)
-latex = post_process_latex(latex)
+def scenario_violations_table(violations_df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame, dict]:
+    """Violations of the scenarios shown in the paper, all properties and the ones shown, and the S<n> names."""
+    # ## Leaderboard 2.0 - ScenarioLogs
+    # Filter rows where any value in the row is non-zero
+    filtered_df = violations_df.loc[(violations_df != 0).any(axis=1)]
 
+    # Get the current index
+    current_index = filtered_df.index
+    # Create new index names
+    new_index = [f'S{i + 1}' for i in range(len(current_index))]  # + ['Total']
+    # Create a dictionary mapping the new index names to the original index names
+    index_mapping = {new: old for new, old in zip(new_index, current_index)}
+    # Invert index mapping
+    inverted_index_mapping = {v: k for k, v in index_mapping.items()}
+    # Assign the new index names to the DataFrame
+    filtered_df.index = new_index
+    # Rename the sub-columns
+    filtered_df = filtered_df.rename(columns={'ego': 'e', 'other': 'o'}, level=1)
 
-print(latex)
+    # Switch position of col 1 and col 2
+    cols = list(filtered_df.columns)
+    cols[0], cols[1], cols[2], cols[3] = cols[2], cols[3], cols[0], cols[1]
+    # Drop last 2 columns
+    cols = cols[:-2]
+    filtered_df = filtered_df[cols]
+    # Drop all rows except the ones in keep_rows
+    keep_rows = [
+        inverted_index_mapping["VehicleTurningRoute_left"],
+        inverted_index_mapping["OppositeVehicleTakingPriority"],
+        inverted_index_mapping["HazardAtSideLaneTwoWays"],
+    ]
+    filtered_df = filtered_df.loc[keep_rows]
+    # Rename all row indexes from 1 to n
+    filtered_df = filtered_df.reset_index(drop=True)
+    # Add S in front of the index
+    filtered_df.index = [f'S{i + 1}' for i in range(len(filtered_df))]
+    # Calculate the sum of each column
+    total_row = filtered_df.sum()
+    # Append the total row to the DataFrame with the index "Total"
+    filtered_df.loc['Total'] = total_row
+    # Replace all 0 with '-'
+    filtered_df = filtered_df.replace(0, '-')
 
+    df_dropped = filtered_df.drop(
+        columns=['$\phi_1^{50}$', "$\phi_2$", "$\phi_4$", "$\phi_5$", "$\phi_7$", "$\phi_8^{10}$"], level=0)
+    # Replace NaN back with '-'
+    df_dropped = df_dropped.replace(pd.NA, '-')
+    return filtered_df, df_dropped, index_mapping
 
-# ## Leaderboard 2.0 - ScenarioLogs
-violations_df, dfa_stats_df = parse_properties_check(
-    Path("./results/scenarios/"))
 
 
-# Filter rows where any value in the row is non-zero
-filtered_df = violations_df.loc[(violations_df != 0).any(axis=1)]
+def main():
+    parser = argparse.ArgumentParser(prog='Violation tables')
+    parser.add_argument('--n_workers', type=int, default=None,
+                        help='Processes parsing the results roots, one per root by default')
+    parser.add_argument('--no_manifest', action='store_true',
+                        help='Parse every result file again instead of only the ones that changed')
+    args = parser.parse_args()
+    results = load_results(n_workers=args.n_workers, use_manifest=not args.no_manifest)
 
-# Get the current index
-current_index = filtered_df.index
-# Create new index names
-new_index = [f'S{i + 1}' for i in range(len(current_index))]  # + ['Total']
-# Create a dictionary mapping the new index names to the original index names
-index_mapping = {new: old for new, old in zip(new_index, current_index)}
-# Invert index mapping
-inverted_index_mapping = {v: k for k, v in index_mapping.items()}
-# Assign the new index names to the DataFrame
-filtered_df.index = new_index
-# Rename the sub-columns
-filtered_df = filtered_df.rename(columns={'ego': 'e', 'other': 'o'}, level=1)
+    aggregated_violations, df_dropped = av_violations_table(results)
+    print(aggregated_violations)
+    print(df_dropped)
+    # latex = aggregated_violations.to_latex(escape=False)
+    latex = df_dropped.to_latex(escape=False)
+    latex = post_process_latex(latex)
+    print(latex)
 
-# Switch position of col 1 and col 2
-cols = list(filtered_df.columns)
-cols[0], cols[1], cols[2], cols[3] = cols[2], cols[3], cols[0], cols[1]
-# Drop last 2 columns
-cols = cols[:-2]
-filtered_df = filtered_df[cols]
-# Drop all rows except the ones in keep_rows
-keep_rows = [
-    inverted_index_mapping["VehicleTurningRoute_left"],
-    inverted_index_mapping["OppositeVehicleTakingPriority"],
-    inverted_index_mapping["HazardAtSideLaneTwoWays"],
-]
-filtered_df = filtered_df.loc[keep_rows]
-# Rename all row indexes from 1 to n
-filtered_df = filtered_df.reset_index(drop=True)
-# Add S in front of the index
-filtered_df.index = [f'S{i + 1}' for i in range(len(filtered_df))]
-# Calculate the sum of each column
-total_row = filtered_df.sum()
-# Append the total row to the DataFrame with the index "Total"
-filtered_df.loc['Total'] = total_row
-# Replace all 0 with '-'
-filtered_df = filtered_df.replace(0, '-')
-print(filtered_df)
+    filtered_df, df_dropped, index_mapping = scenario_violations_table(results['scenarios'][0])
+    print(filtered_df)
+    print(df_dropped)
+    print(index_mapping)
+    latex = df_dropped.to_latex(escape=False)
+    latex = post_process_latex(latex)
+    print(latex)
 
 
-df_dropped = filtered_df.drop(
-    columns=['$\phi_1^{50}$', "$\phi_2$", "$\phi_4$", "$\phi_5$", "$\phi_7$", "$\phi_8^{10}$"], level=0)
-# Replace NaN back with '-'
-df_dropped = df_dropped.replace(pd.NA, '-')
-print(df_dropped)
-print(index_mapping)
-latex = df_dropped.to_latex(escape=False)
-latex = post_process_latex(latex)
-print(latex)
+if __name__ == '__main__':
+    main()
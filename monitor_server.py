@@ -0,0 +1,340 @@
+"""
+Monitor service that checks scene graphs streamed from several simulators at once.
+
+Every message, in both directions, is a 4-byte big-endian length followed by the body.
+Client -> server bodies are pickled dicts, using the same pickling as the rsv/*.pkl scene graphs:
+    {'type': 'open', 'session': str, 'route': str, 'ego_only': bool, 'phi': int}
+    {'type': 'frame', 'session': str, 'sg': nx.DiGraph, 'ego_log': dict or None}
+    {'type': 'close', 'session': str}
+    {'type': 'stats'}
+Server -> client bodies are JSON dicts with the same 'type' ('verdict' for frames, 'error' if a message failed).
+A route can only be open in one session at a time. Sessions add to the violation store without clearing the rows of
+earlier sessions of the same route.
+If the monitor fails on a frame, the session gets an 'error' with its 'session', its results so far are saved and
+its later frames are rejected; the other sessions keep running.
+Since frames are unpickled, only listen on localhost or a unix socket.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import pickle
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import SG_Utils as utils
+from check_symbolic_properties import add_monitor_arguments, monitor_options_from_args
+from SymbolicMonitor import SymbolicMonitor, FrameVerdict
+
+HEADER = struct.Struct('>I')
+
+
+async def read_message(reader: asyncio.StreamReader):
+    try:
+        header = await reader.readexactly(HEADER.size)
+        return await reader.readexactly(HEADER.unpack(header)[0])
+    except asyncio.IncompleteReadError:
+        return None
+
+
+def encode_message(body: bytes) -> bytes:
+    return HEADER.pack(len(body)) + body
+
+
+class MonitorSession:
+    """One independent stream of SGs with its own monitor and counters."""
+    def __init__(self, session_id, monitor: SymbolicMonitor, max_pending):
+        self.session_id = session_id
+        self.monitor = monitor
+        # bounded so that a session that falls behind stops its connection from reading more frames
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.task = None
+        # set when a frame could not be checked, the session then drops the rest of its frames
+        self.error = None
+        self.frames_received = 0
+        self.frames_checked = 0
+        self.n_violations = 0
+        self.total_latency_ns = 0
+        self.max_latency_ns = 0
+
+    def record(self, verdict: FrameVerdict):
+        self.frames_checked += 1
+        self.n_violations += len(verdict.violations)
+        self.total_latency_ns += verdict.latency_ns
+        self.max_latency_ns = max(self.max_latency_ns, verdict.latency_ns)
+
+    def stats(self):
+        return {
+            'frames_received': self.frames_received,
+            'frames_checked': self.frames_checked,
+            'pending': self.queue.qsize(),
+            'violations': self.n_violations,
+            'live_instances': len(self.monitor.concrete_properties),
+            'mean_latency_ms': self.total_latency_ns / self.frames_checked / 1e6 if self.frames_checked > 0 else None,
+            'max_latency_ms': self.max_latency_ns / 1e6,
+        }
+
+
+class MonitorServer:
+    def __init__(self, save_folder, max_pending=4, n_workers=None, **monitor_options):
+        self.save_folder = Path(save_folder)
+        self.max_pending = max_pending
+        self.monitor_options = monitor_options
+        self.executor = ThreadPoolExecutor(max_workers=n_workers)
+        self.sessions = {}
+        self.started = time.time()
+        self.sessions_total = 0
+        self.frames_received = 0
+        self.frames_checked = 0
+        self.n_violations = 0
+
+    def stats(self):
+        uptime = time.time() - self.started
+        return {
+            'type': 'stats',
+            'uptime_s': uptime,
+            'sessions_open': len(self.sessions),
+            'sessions_total': self.sessions_total,
+            'frames_received': self.frames_received,
+            'frames_checked': self.frames_checked,
+            'violations': self.n_violations,
+            'frames_per_second': self.frames_checked / uptime if uptime > 0 else 0,
+            'sessions': {session_id: session.stats() for session_id, session in self.sessions.items()},
+        }
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        write_lock = asyncio.Lock()
+
+        async def send(data):
+            async with write_lock:
+                writer.write(encode_message(json.dumps(data).encode()))
+                await writer.drain()
+
+        owned = {}
+        try:
+            while True:
+                body = await read_message(reader)
+                if body is None:
+                    break
+                try:
+                    message = utils.SGUnpickler(io.BytesIO(body)).load()
+                    if message['type'] == 'frame':
+                        session = self.sessions.get(message['session'])
+                        if session is None:
+                            raise ValueError(f"Session {message['session']} is not open")
+                        session.frames_received += 1
+                        self.frames_received += 1
+                        # blocks this connection until the session has room, which pushes back on the sender
+                        await session.queue.put((message['sg'], message.get('ego_log')))
+                    elif message['type'] == 'open':
+                        session_id = message['session']
+                        if session_id in self.sessions:
+                            raise ValueError(f'Session {session_id} is already open')
+                        route = message.get('route', session_id)
+                        if any(session.monitor.route_path.name == route for session in self.sessions.values()):
+                            raise ValueError(f'Route {route} is already open in another session')
+                        # sessions share the save folder, so a session must not clear the rows of earlier ones
+                        monitor = SymbolicMonitor(self.save_folder, route,
+                                                  ego_only=message.get('ego_only', False),
+                                                  phi=message.get('phi', -1),
+                                                  clear_results=False,
+                                                  **self.monitor_options)
+                        session = MonitorSession(session_id, monitor, self.max_pending)
+                        session.task = asyncio.create_task(self._run_session(session, send))
+                        self.sessions[session_id] = session
+                        self.sessions_total += 1
+                        owned[session_id] = session
+                        await send({'type': 'opened', 'session': session_id})
+                    elif message['type'] == 'close':
+                        session = owned.pop(message['session'], None)
+                        if session is None:
+                            raise ValueError(f"Session {message['session']} is not open on this connection")
+                        await self._close_session(session)
+                        await send({'type': 'closed', 'session': message['session']})
+                    elif message['type'] == 'stats':
+                        await send(self.stats())
+                    else:
+                        raise ValueError(f"Unknown message type {message['type']}")
+                except (KeyError, ValueError, pickle.UnpicklingError, EOFError) as e:
+                    await send({'type': 'error', 'message': repr(e)})
+        except asyncio.CancelledError:
+            pass  # the server is shutting down, the sessions are still closed below
+        finally:
+            # a client that disconnects without closing its sessions still gets its results saved
+            for session in owned.values():
+                await self._close_session(session)
+            writer.close()
+
+    async def _run_session(self, session: MonitorSession, send):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await session.queue.get()
+            if item is None:
+                break
+            sg, ego_log = item
+            try:
+                verdict = await loop.run_in_executor(self.executor, session.monitor.feed, sg, ego_log)
+            except Exception as e:
+                self._fail_session(session, e)
+                await self._send_error(send, session, e)
+                break
+            session.record(verdict)
+            self.frames_checked += 1
+            self.n_violations += len(verdict.violations)
+            try:
+                await send({'type': 'verdict',
+                            'session': session.session_id,
+                            'frame': verdict.frame,
+                            'step': verdict.step,
+                            'latency_ms': verdict.latency_ns / 1e6,
+                            'live_instances': verdict.live_instances,
+                            'violations': [{'property': violation.property_name,
+                                            'bindings': violation.to_dict()['entity_mapping']}
+                                           for violation in verdict.violations]})
+            except ConnectionError:
+                pass  # keep checking so the results on disk are complete
+        try:
+            # the results of a failed session are saved up to the frame that failed
+            await loop.run_in_executor(self.executor, session.monitor.save_final_output)
+        except Exception as e:
+            self._fail_session(session, e)
+            await self._send_error(send, session, e)
+
+    def _fail_session(self, session: MonitorSession, error):
+        """Stops accepting frames for the session and drops the queued ones, which unblocks a sender waiting on it."""
+        if session.error is None:
+            session.error = error
+        if self.sessions.get(session.session_id) is session:
+            del self.sessions[session.session_id]
+        while not session.queue.empty():
+            session.queue.get_nowait()
+
+    @staticmethod
+    async def _send_error(send, session: MonitorSession, error):
+        with contextlib.suppress(ConnectionError):
+            await send({'type': 'error', 'session': session.session_id, 'message': repr(error)})
+
+    async def _close_session(self, session: MonitorSession):
+        if self.sessions.get(session.session_id) is session:
+            del self.sessions[session.session_id]
+        # a session that failed stops reading its queue, so don't wait for the end marker to be taken
+        closing = asyncio.create_task(session.queue.put(None))
+        # the task reports its own errors; it is only cancelled when the server shuts down
+        with contextlib.suppress(asyncio.CancelledError):
+            await session.task
+        closing.cancel()
+
+    async def serve(self, host='127.0.0.1', port=8765, unix_path=None):
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, path=str(unix_path))
+            print(f'Monitor server listening on {unix_path}')
+        else:
+            server = await asyncio.start_server(self.handle_connection, host=host, port=port)
+            print(f'Monitor server listening on {host}:{port}')
+        async with server:
+            await server.serve_forever()
+
+
+async def open_connection(host, port, unix_path):
+    if unix_path is not None:
+        return await asyncio.open_unix_connection(str(unix_path))
+    return await asyncio.open_connection(host, port)
+
+
+async def send_message(writer: asyncio.StreamWriter, message):
+    writer.write(encode_message(pickle.dumps(message)))
+    await writer.drain()
+
+
+async def replay_route(route_dir: Path, host='127.0.0.1', port=8765, unix_path=None, ego_only=False, phi=-1):
+    """Stand-in for a simulator: streams a recorded route's SGs to the server and collects the verdicts."""
+    rsv_folder = route_dir / 'rsv'
+    sg_name_list = utils.route_sg_names(route_dir)
+    ego_logs_path = route_dir / 'ego_logs.json'
+    ego_logs = json.loads(ego_logs_path.read_text())['records'] if ego_logs_path.exists() else None
+    reader, writer = await open_connection(host, port, unix_path)
+    session_id = f'{route_dir.name}_{os.getpid()}_{id(route_dir)}'
+    verdicts = []
+
+    async def collect():
+        while True:
+            body = await read_message(reader)
+            if body is None:
+                return
+            data = json.loads(body)
+            if data['type'] == 'verdict':
+                verdicts.append(data)
+            elif data['type'] == 'error':
+                print(f"{route_dir.name}: server error {data['message']}")
+            elif data['type'] == 'closed':
+                return
+
+    collector = asyncio.create_task(collect())
+    await send_message(writer, {'type': 'open', 'session': session_id, 'route': route_dir.name,
+                                'ego_only': ego_only, 'phi': phi})
+    start = time.time()
+    for sg_name in sg_name_list:
+        sg = utils.load_sg(str(rsv_folder / sg_name))
+        sg.graph['name'] = sg_name
+        sg.graph['frame'] = sg_name.replace('.pkl', '')
+        ego_log = ego_logs[int(sg.graph['frame'])] if ego_logs is not None else None
+        await send_message(writer, {'type': 'frame', 'session': session_id, 'sg': sg, 'ego_log': ego_log})
+    await send_message(writer, {'type': 'close', 'session': session_id})
+    await collector
+    writer.close()
+    elapsed = time.time() - start
+    n_violations = sum(len(v['violations']) for v in verdicts)
+    max_latency = max([v['latency_ms'] for v in verdicts], default=0)
+    print(f'{route_dir.name} | {len(verdicts)}/{len(sg_name_list)} verdicts | {n_violations} violations | '
+          f'{len(verdicts) / elapsed:.2f} frames/s | max latency {max_latency:.2f}ms')
+    return verdicts
+
+
+async def request_stats(host='127.0.0.1', port=8765, unix_path=None):
+    reader, writer = await open_connection(host, port, unix_path)
+    await send_message(writer, {'type': 'stats'})
+    stats = json.loads(await read_message(reader))
+    writer.close()
+    return stats
+
+
+async def replay_folder(folder: Path, host, port, unix_path, ego_only, phi):
+    routes = [d for d in sorted(folder.iterdir()) if (d / 'rsv').is_dir()]
+    if (folder / 'rsv').is_dir():
+        routes = [folder]
+    await asyncio.gather(*[replay_route(d, host, port, unix_path, ego_only, phi) for d in routes])
+    print(json.dumps(await request_stats(host, port, unix_path), indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Monitor server')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='Run the monitor service')
+    serve_parser.add_argument('-s', '--save_folder', type=Path, default='live_results/')
+    serve_parser.add_argument('--max_pending', type=int, default=4,
+                              help='Frames a session may have queued before its connection stops being read')
+    serve_parser.add_argument('--n_workers', type=int, default=None)
+    add_monitor_arguments(serve_parser)
+    replay_parser = subparsers.add_parser('replay', help='Stream recorded routes to a running server')
+    replay_parser.add_argument('-f', '--folder_to_check', type=Path, required=True)
+    replay_parser.add_argument('--ego_only', action='store_true')
+    replay_parser.add_argument('--phi', type=int, default=-1)
+    for sub in [serve_parser, replay_parser]:
+        sub.add_argument('--host', default='127.0.0.1')
+        sub.add_argument('--port', type=int, default=8765)
+        sub.add_argument('--unix', type=Path, default=None, help='Use this unix socket instead of TCP')
+    args = parser.parse_args()
+    if args.command == 'serve':
+        server = MonitorServer(args.save_folder, max_pending=args.max_pending, n_workers=args.n_workers,
+                               **monitor_options_from_args(args))
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    else:
+        asyncio.run(replay_folder(args.folder_to_check, args.host, args.port, args.unix, args.ego_only, args.phi))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""
+Checks a new or modified formula over the predicate traces written by check_symbolic_properties.py --predicate_trace,
+without loading the SGs. The formula may use any of the property's symbols; its instances are bound and stepped as by
+SymbolicMonitor, but the predicates are looked up in the trace instead of being evaluated.
+A trace only holds the values of the bindings the original formula made the monitor step, so a new formula can need a
+value that was never recorded. Such values are unknown: an instance then follows every DFA state it can be in, and a
+verdict that depends on them is reported as unknown rather than as a violation. The number of such values and the
+frames they are in are reported as well: instances that followed an unknown value and never reached a verdict are not
+listed, so a recheck with unrecorded values is incomplete even without unknown verdicts.
+Instance GC (--gc_absent_frames, --gc_unviolable) is not replayed.
+Usage: python recheck_traces.py -s ./results/tcp/ -p 821_vehicle2_needs_to_yield_to_vehicle1_stop -f "G(v1_at_junc -> ...)"
+"""
+import argparse
+import itertools
+import json
+from collections import Counter
+from pathlib import Path
+from typing import List, Set, Tuple
+
+from LTLfDFA import LTLfDFA
+from PredicateTrace import PredicateTrace, FALSE, TRUE, UNBOUND, binding_key
+from SymbolicProperty import valid_mapping
+
+UNBOUND_VALUE = object()
+
+
+class TraceInstance:
+    """A property instance in the replay: its bindings (entity name -> id or None) and the DFA states it may be in."""
+    def __init__(self, initial_frame, mapping, states, uncertain=False):
+        self.initial_frame = initial_frame
+        self.mapping = mapping
+        self.states = states
+        # whether the states depend on values that were not recorded
+        self.uncertain = uncertain
+
+
+def step_outcomes(dfa: LTLfDFA, trace: PredicateTrace, property_name, frame, instance: TraceInstance, evaluated,
+                  unrecorded):
+    """
+    Steps the instance from each of its states for each value the unknown symbols can have.
+    :param evaluated: the (symbol, binding) pairs already looked up in this frame; as in the monitor, whose per-frame
+        cache they mimic, only the first lookup of a pair binds the unbound entities of the symbol
+    :param unrecorded: the (frame, symbol, binding) of every value that was needed but not recorded is added to it
+    :return: next states, entities that have to be bound after the step, entities that have to be bound instead of
+        the step (if no single transition could be taken), and whether any unknown value was involved
+    """
+    symbol_entities = trace.symbol_entities(property_name)
+    next_states, undef, unbound = set(), set(), set()
+    uncertain = False
+    for state in sorted(instance.states):
+        edges = list(dfa._dfa.out_edges(state, data=True))
+        domains = {}
+        for _, _, a in edges:
+            for symbol in a['symbols']:
+                if symbol in domains:
+                    continue
+                entity_ids = [instance.mapping[entity] for entity in symbol_entities[symbol]]
+                key = (symbol, binding_key(entity_ids))
+                if key not in evaluated:
+                    evaluated.add(key)
+                    undef.update(entity for entity, entity_id in zip(symbol_entities[symbol], entity_ids)
+                                 if entity_id is None)
+                value = trace.value(property_name, frame, symbol, entity_ids)
+                if value is None:
+                    uncertain = True
+                    unrecorded.add((frame, symbol, binding_key(entity_ids)))
+                    domains[symbol] = [False, True] + ([UNBOUND_VALUE] if None in entity_ids else [])
+                else:
+                    domains[symbol] = [{FALSE: False, TRUE: True, UNBOUND: UNBOUND_VALUE}[value]]
+        symbols = list(domains)
+        for values in itertools.product(*[domains[symbol] for symbol in symbols]):
+            data = dict(zip(symbols, values))
+            # as in ConcreteProperty.step, edges that need an unbound entity cannot be taken
+            valid = dfa.transitions(state, {symbol: bool(value) for symbol, value in data.items()},
+                                    ignore={symbol for symbol, value in data.items() if value is UNBOUND_VALUE})
+            if len(valid) == 1:
+                next_states.add(valid[0])
+                continue
+            missing = {entity for symbol, value in data.items() if value is UNBOUND_VALUE
+                       for entity, entity_id in zip(symbol_entities[symbol],
+                                                    [instance.mapping[entity] for entity in symbol_entities[symbol]])
+                       if entity_id is None}
+            if len(missing) == 0:
+                raise ValueError(f'Unable to find state transition from {state} with {data} in frame {frame}')
+            unbound.update(missing)
+    return next_states, undef, unbound, uncertain
+
+
+def expand(trace: PredicateTrace, property_name, frame, instance: TraceInstance, entities) -> List[TraceInstance]:
+    """Binds the given entities to every matching entity of the frame, as ConcreteProperty.additional_concrete_specific."""
+    if len(entities) == 0:
+        return []
+    entities = sorted(entities)
+    extensions = []
+    for ids in itertools.product(*[trace.candidates(property_name, frame, entity) for entity in entities]):
+        if not valid_mapping(ids):
+            continue
+        mapping = dict(instance.mapping, **dict(zip(entities, ids)))
+        if valid_mapping(list(mapping.values())):
+            extensions.append(TraceInstance(instance.initial_frame, mapping, instance.states, instance.uncertain))
+    return extensions
+
+
+def recheck(trace: PredicateTrace, property_name, dfa: LTLfDFA) -> Tuple[List[dict], Set[tuple]]:
+    """
+    Verdicts of the formula of dfa over the property's trace: every instance that ended in a trap state.
+    :return: the verdicts and the (frame index, symbol, binding) of every value that was needed but not recorded
+    """
+    recorded = trace.properties[property_name]
+    missing = set(dfa.symbols) - set(recorded['symbols'])
+    if len(missing) > 0:
+        raise ValueError(f'{property_name} has no predicates for {sorted(missing)}, '
+                         f'the trace only has {recorded["symbols"]}')
+    instances = []
+    verdicts = []
+    unrecorded = set()
+    for frame, frame_name in enumerate(trace.frames):
+        instances.append(TraceInstance(frame_name, {entity: None for entity in recorded['entities']},
+                                       {dfa.get_init_state()}))
+        evaluated = set()
+        to_check = instances
+        to_keep = []
+        while len(to_check) > 0:
+            instance = to_check.pop(0)
+            next_states, undef, unbound, uncertain = step_outcomes(dfa, trace, property_name, frame, instance,
+                                                                   evaluated, unrecorded)
+            if len(next_states) == 0:
+                # the instance is replaced by its extensions, as when ConcreteProperty.step raises UnboundEntityError
+                to_check.extend(expand(trace, property_name, frame, instance, unbound))
+                continue
+            # extensions start from the states before the step; with unknown values, the instance both steps and is
+            # extended if either can happen
+            to_check.extend(expand(trace, property_name, frame, instance, undef | unbound))
+            instance.states = next_states
+            instance.uncertain = instance.uncertain or uncertain or len(unbound) > 0
+            if not all(dfa.is_trap_state(state) for state in next_states):
+                to_keep.append(instance)
+                continue
+            accepting = [dfa.is_accepting(state) for state in next_states]
+            if not all(accepting):
+                verdicts.append({
+                    'frame': frame_name,
+                    'initial_frame': instance.initial_frame,
+                    'bindings': instance.mapping,
+                    'verdict': 'unknown' if instance.uncertain or any(accepting) else 'violation',
+                })
+        instances = to_keep
+    return verdicts, unrecorded
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Trace rechecker')
+    parser.add_argument('-s', '--save_folder', type=Path, required=True,
+                        help='Results folder of a check with --predicate_trace')
+    parser.add_argument('-p', '--property', required=True, help='Property whose predicates the formula uses')
+    parser.add_argument('-f', '--formula', default=None, help='By default the formula the trace was recorded with')
+    parser.add_argument('-o', '--output', type=Path, default=None, help='Write the verdicts to this JSON file')
+    args = parser.parse_args()
+
+    traces = [trace for trace in PredicateTrace.find(args.save_folder) if args.property in trace.properties]
+    if len(traces) == 0:
+        parser.error(f'No predicate traces of {args.property} in {args.save_folder}')
+    formula = args.formula if args.formula is not None else traces[0].properties[args.property]['formula']
+    dfa = LTLfDFA(formula)
+    results = {}
+    unrecorded = {}
+    for trace in traces:
+        verdicts, missing = recheck(trace, args.property, dfa)
+        results[trace.route] = verdicts
+        frames = sorted({frame for frame, _, _ in missing})
+        unrecorded[trace.route] = {'values': len(missing), 'frames': [trace.frames[frame] for frame in frames]}
+        counts = Counter(verdict['verdict'] for verdict in verdicts)
+        print(f"{trace.route} | {len(trace.frames)} frames | {counts['violation']} violations | "
+              f"{counts['unknown']} unknown | {len(missing)} unrecorded values in {len(frames)} frames")
+    totals = Counter(verdict['verdict'] for verdicts in results.values() for verdict in verdicts)
+    n_unrecorded = sum(route['values'] for route in unrecorded.values())
+    print(f"{len(traces)} routes | {totals['violation']} violations | {totals['unknown']} unknown | "
+          f"{n_unrecorded} unrecorded values")
+    if n_unrecorded > 0:
+        print("The formula needs predicate values the trace does not have, the verdicts are incomplete; "
+              "check with --predicate_trace and this formula to get all of them")
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'property': args.property, 'formula': formula, 'routes': results, 'unrecorded': unrecorded},
+                      f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
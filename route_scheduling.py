@@ -0,0 +1,113 @@
+"""
+Orders the routes of a batch check so that the slowest routes start first (longest processing time first).
+The cost of a route is estimated from, in order of preference:
+1) its frame times in earlier results (a TimingStore or legacy *_frame_times_*.json files in the save folder)
+2) a probe of a few of its SGs: frames * (entities + 1)^2, since most properties bind pairs of entities
+3) its frame count
+Probe and frame count estimates are scaled to seconds with the routes that have history, if there are any.
+"""
+import heapq
+import json
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import SG_Utils as utils
+from TimingStore import TimingStore
+
+def history_costs(save_folder: Path, ego_only=False, phi=-1) -> Dict[str, float]:
+    """Mean total check time (s) of each route over the earlier runs, preferring runs with the same ego_only and phi."""
+    totals = defaultdict(dict)  # route -> (ego_only, phi, run) -> seconds
+    for store in TimingStore.find([save_folder]):
+        records = store.read()
+        routes = np.asarray(store.read_names()['route'])
+        keys = np.stack([records['route'], records['ego_only'], records['phi'], records['run']], axis=1)
+        unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+        sums = np.bincount(inverse.ravel(), weights=records['time_ns']) * 1e-9
+        for (route, run_ego_only, run_phi, run), total in zip(unique.tolist(), sums.tolist()):
+            totals[routes[route]][(bool(run_ego_only), run_phi, run)] = total
+    for timing_file in Path(save_folder).glob('**/*_frame_times_*.json'):
+        if TimingStore.exists(timing_file.parent):
+            continue
+        data = json.loads(timing_file.read_text())
+        totals[data['folder']][(bool(data['ego_only']), data['phi'], data['run'])] = sum(data['frame_times']) * 1e-9
+    costs = {}
+    for route, runs in totals.items():
+        matching = [total for (run_ego_only, run_phi, _), total in runs.items()
+                    if run_ego_only == ego_only and run_phi == phi]
+        costs[route] = float(np.mean(matching if len(matching) > 0 else list(runs.values())))
+    return costs
+
+
+def probe_cost(route_dir: Path, n_samples=3) -> float:
+    """frames * (entities + 1)^2, counting the entities of n_samples SGs spread over the route."""
+    sg_names = utils.route_sg_names(route_dir)
+    if len(sg_names) == 0:
+        return 0.0
+    samples = [sg_names[i] for i in np.linspace(0, len(sg_names) - 1, min(n_samples, len(sg_names))).astype(int)]
+    entities = [sum(1 for node in utils.load_sg(str(route_dir / 'rsv' / name)).nodes
+                    if node.base_class not in utils.ROAD_CLASSES) for name in samples]
+    return len(sg_names) * (np.mean(entities) + 1) ** 2
+
+
+def estimate_costs(route_dirs: List[Path], save_folder: Path, ego_only=False, phi=-1, probe=True,
+                   n_calibration=5) -> Dict[str, Tuple[float, str]]:
+    """{route: (estimated cost, source)}, in seconds if any route has history."""
+    history = history_costs(save_folder, ego_only, phi) if Path(save_folder).exists() else {}
+    source = 'probe' if probe else 'frames'
+
+    def units(route_dir):
+        return probe_cost(route_dir) if probe else float(len(utils.route_sg_names(route_dir)))
+
+    scale = 1.0
+    if any(route_dir.name not in history for route_dir in route_dirs):
+        # seconds per unit, measured on a few of the routes that have history
+        calibration = [route_dir for route_dir in route_dirs if route_dir.name in history][:n_calibration]
+        ratios = [history[route_dir.name] / u for route_dir in calibration if (u := units(route_dir)) > 0]
+        if len(ratios) > 0:
+            scale = float(np.median(ratios))
+    return {route_dir.name: (history[route_dir.name], 'history') if route_dir.name in history
+            else (units(route_dir) * scale, source) for route_dir in route_dirs}
+
+
+def lpt_schedule(costs: Dict[str, float], n_workers) -> Tuple[List[str], Dict[str, int], float]:
+    """
+    The routes in longest processing time first order, the worker each one ends up on if the estimates are exact and
+    the resulting makespan. A pool handing the routes out in this order to whichever worker is free follows it.
+    """
+    order = sorted(costs, key=costs.get, reverse=True)
+    loads = [(0.0, worker) for worker in range(n_workers)]
+    assignment = {}
+    for route in order:
+        load, worker = heapq.heappop(loads)
+        assignment[route] = worker
+        heapq.heappush(loads, (load + costs[route], worker))
+    return order, assignment, max(load for load, _ in loads)
+
+
+def makespan_report(estimates: Dict[str, Tuple[float, str]], n_workers, actual_times: Dict[str, float],
+                    actual_makespan) -> dict:
+    costs = {route: cost for route, (cost, _) in estimates.items()}
+    _, assignment, expected_makespan = lpt_schedule(costs, n_workers)
+    calibrated = any(source == 'history' for _, source in estimates.values())
+    return {
+        'n_workers': n_workers,
+        'calibrated': calibrated,  # estimates and the expected makespan are in seconds
+        'expected_makespan': expected_makespan,
+        'actual_makespan': actual_makespan,
+        # no schedule can beat the longest route or the total work spread evenly
+        'actual_lower_bound': max(max(actual_times.values(), default=0.0),
+                                  sum(actual_times.values()) / n_workers),
+        'routes': {route: {'estimated': cost, 'source': source, 'worker': assignment[route],
+                           'actual': actual_times.get(route)}
+                   for route, (cost, source) in estimates.items()},
+    }
+
+
+def print_report(report):
+    unit = 's' if report['calibrated'] else ' (relative)'
+    print(f"Expected makespan: {report['expected_makespan']:.2f}{unit} | Actual makespan: "
+          f"{report['actual_makespan']:.2f}s | Lower bound from actual route times: "
+          f"{report['actual_lower_bound']:.2f}s")
@@ -0,0 +1,83 @@
+"""
+Runs the phi x run timing sweep of run.sh in a single process: the properties are compiled once, every route is
+loaded (and gets its phantom nodes) once, and then checked by a fresh SymbolicMonitor for every run and phi.
+Each check starts with an empty per-frame cache and a garbage collection, so the timings are as independent of the
+earlier checks as with one process per check. The frame times and results are written as by check_symbolic_properties.
+Every check replaces the route's violations of the properties it checks (see ViolationStore), so the save folder ends
+up with the violations of the last run of each property rather than one copy per run and phi.
+Usage: python run_experiments.py -f ./study_data/tcp/run1/ -s ./results_time_ego/tcp/ --runs 1 2 3 --ego_only
+"""
+import argparse
+import gc
+import time
+from pathlib import Path
+
+import SG_Utils as utils
+from check_symbolic_properties import (add_monitor_arguments, check_sgs, checkpoint_path, load_route,
+                                       monitor_options_from_args, save_frame_times)
+from SymbolicMonitor import SymbolicMonitor
+from TimingStore import TimingStore
+from symbolic_properties import all_symbolic_properties
+from symbolic_properties_ego_only import all_symbolic_properties as ego_all_symbolic_properties
+
+
+def sweep_route(route_dir: Path, save_folder: Path, phis, runs, ego_only=False, frame_times_json=False,
+                checkpoint_every=None, resume=False, completed=frozenset(), **monitor_options):
+    """Checks the route for every run and phi, except the (route, ego_only, phi, run) in completed."""
+    todo = [(run, phi) for run in runs for phi in phis if (route_dir.name, ego_only, phi, run) not in completed]
+    if len(todo) == 0:
+        print(f"{route_dir}: already checked")
+        return
+    start = time.time()
+    sgs = load_route(route_dir)
+    utils.add_missing(sgs)
+    print(f"{route_dir}: loaded {len(sgs)} SGs in {time.time() - start:.2f} seconds")
+    for run, phi in todo:
+        gc.collect()
+        m = SymbolicMonitor(log_path=save_folder, route_path=route_dir.name, ego_only=ego_only, phi=phi,
+                            **monitor_options)
+        checkpoint = checkpoint_path(save_folder, route_dir.name, ego_only, phi, run)
+        frame_times = check_sgs(m, sgs, checkpoint=checkpoint, checkpoint_every=checkpoint_every, resume=resume)
+        m.save_final_output()
+        # written last, the frame times mark the check as done for --resume
+        save_frame_times(save_folder, route_dir.name, ego_only, phi, run, frame_times, frame_times_json)
+        checkpoint.unlink(missing_ok=True)
+        print(f"{route_dir.name} | run {run} | phi {phi} | {sum(frame_times) / 1e9:.2f} seconds")
+    # the SGs now have phantom nodes, they must not be handed out again by load_sg
+    utils.load_sg.cache_clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Experiment runner')
+    parser.add_argument('-f', '--folder_to_check', type=Path, required=True)
+    parser.add_argument('-s', '--save_folder', type=Path, default='default/')
+    parser.add_argument('--ego_only', action='store_true')
+    parser.add_argument('--phis', type=int, nargs='+', default=None,
+                        help='Property indices to check one at a time, -1 checks all properties together. '
+                             'By default -1 and every property')
+    parser.add_argument('--runs', type=int, nargs='+', default=[1])
+    parser.add_argument('--frame_times_json', action='store_true',
+                        help='Also write the frame times of every route to a <route>_frame_times_*.json file')
+    parser.add_argument('--checkpoint_every', type=int, default=None,
+                        help='Save the monitor state every this many frames to <save_folder>/checkpoints')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the checks whose frame times are already in the save folder and continue the '
+                             'others from their checkpoint, if there is one')
+    add_monitor_arguments(parser)
+    args = parser.parse_args()
+    monitor_options = monitor_options_from_args(args)
+    properties = ego_all_symbolic_properties if args.ego_only else all_symbolic_properties
+    phis = args.phis if args.phis is not None else [-1] + list(range(len(properties)))
+
+    start = time.time()
+    dirs = [d for d in sorted(args.folder_to_check.iterdir()) if (d / 'rsv').is_dir()]
+    completed = TimingStore(args.save_folder).completed_runs() if args.resume else frozenset()
+    for route_dir in dirs:
+        sweep_route(route_dir, args.save_folder, phis, args.runs, ego_only=args.ego_only,
+                    frame_times_json=args.frame_times_json, checkpoint_every=args.checkpoint_every,
+                    resume=args.resume, completed=completed, **monitor_options)
+    print(f"Checked {len(dirs)} routes x {len(phis)} phis x {len(args.runs)} runs in {time.time() - start:.2f} seconds")
+
+
+if __name__ == '__main__':
+    main()
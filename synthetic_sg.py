@@ -0,0 +1,271 @@
+"""
+Generates synthetic scene graphs that use the same Node / relationship vocabulary as the recorded routes, at sizes
+that can be controlled independently: number of vehicles, lanes per direction, roads meeting at the junction,
+bicycles and emergency vehicles.
+
+The map is a single junction where n_roads straight roads meet. Every road has n_lanes lanes driving towards the
+junction and n_lanes driving away from it, and every road has a stop sign controlling its incoming lanes. Vehicles
+drive towards the junction, cross it on a connector road and leave on the next road; once they reach the end of a
+road they come back on a random incoming road, so the number of vehicles stays the same.
+Frames are 0.5s apart, like the study recordings.
+Usage: python synthetic_sg.py -o synthetic/vehicles_20 --vehicles 20 --bicycles 2 --emergency 1 --frames 200
+"""
+import argparse
+import math
+import pickle
+import random
+from pathlib import Path
+
+import networkx as nx
+
+from SG_Utils import Node
+
+# (relationship, distance in metres) from closest to furthest, a pair of entities gets the first that applies
+DISTANCE_RELATIONS = [('safe_hazard', 4), ('near_coll', 7), ('super_near', 10), ('very_near', 16), ('near', 25),
+                      ('visible', 50)]
+LANE_WIDTH = 3.5
+ROAD_LENGTH = 100.0
+JUNCTION_LENGTH = 20.0
+SIDE_BY_SIDE = 5.0  # metres along the road within which vehicles in adjacent lanes are beside each other
+FRAME_DT = 0.5
+
+CAR_TYPES = ['vehicle.tesla.model3', 'vehicle.audi.a2', 'vehicle.lincoln.mkz_2020', 'vehicle.nissan.patrol']
+TRUCK_TYPES = ['vehicle.carlamotors.carlacola']
+BICYCLE_TYPES = ['vehicle.bh.crossbike', 'vehicle.diamondback.century']
+EMERGENCY_TYPES = ['vehicle.ford.ambulance', 'vehicle.carlamotors.firetruck']
+
+
+class SyntheticVehicle:
+    def __init__(self, entity_id, base_class, type_id, speed, emergency=False):
+        self.entity_id = entity_id
+        self.base_class = base_class
+        self.type_id = type_id
+        self.cruise_speed = speed
+        self.speed = speed
+        self.emergency = emergency
+        self.road = 0
+        self.incoming = True  # driving towards the junction
+        self.in_junction = False
+        self.lane = 0
+        self.s = 0.0  # distance from the junction, or travelled through the junction
+        self.stopped_frames = 0
+
+    @property
+    def name(self):
+        return 'ego' if self.base_class == 'ego' else f'{self.base_class}_{self.entity_id}'
+
+
+class SyntheticScene:
+    def __init__(self, n_vehicles=10, n_lanes=2, n_roads=4, n_bicycles=0, n_emergency=0, stop_signs=True,
+                 lane_change_prob=0.05, seed=0):
+        if n_roads < 2:
+            raise ValueError('The junction needs at least two roads')
+        self.n_lanes = n_lanes
+        self.n_roads = n_roads
+        self.stop_signs = stop_signs
+        self.lane_change_prob = lane_change_prob
+        self.random = random.Random(seed)
+        self.frame = 0
+        self.vehicles = []
+        # entity 0 is the ego, like in the recordings the ego is always a car
+        for i in range(max(n_vehicles, 1)):
+            base_class = 'ego' if i == 0 else self.random.choice(['car', 'car', 'car', 'truck', 'van'])
+            type_id = self.random.choice(TRUCK_TYPES if base_class == 'truck' else CAR_TYPES)
+            self.vehicles.append(SyntheticVehicle(i, base_class, type_id, self.random.uniform(6, 14)))
+        for i in range(n_bicycles):
+            self.vehicles.append(SyntheticVehicle(len(self.vehicles), 'bicycle', self.random.choice(BICYCLE_TYPES),
+                                                  self.random.uniform(3, 6)))
+        for i in range(n_emergency):
+            self.vehicles.append(SyntheticVehicle(len(self.vehicles), 'van', self.random.choice(EMERGENCY_TYPES),
+                                                  self.random.uniform(10, 16), emergency=True))
+        for vehicle in self.vehicles:
+            self.respawn(vehicle, self.random.uniform(0, ROAD_LENGTH))
+
+    def respawn(self, vehicle, s=ROAD_LENGTH):
+        vehicle.road = self.random.randrange(self.n_roads)
+        vehicle.incoming = True
+        vehicle.in_junction = False
+        # bicycles keep to the rightmost lane
+        vehicle.lane = self.n_lanes - 1 if vehicle.base_class == 'bicycle' else self.random.randrange(self.n_lanes)
+        vehicle.s = s
+
+    # --- map ---
+
+    def lane_name(self, road, incoming, lane):
+        return f'Lane {road}_{"in" if incoming else "out"}_{lane}'
+
+    def add_map(self, sg, nodes):
+        def node(name, base_class):
+            if name not in nodes:
+                nodes[name] = Node(name, base_class, {'entity_id': name})
+            return nodes[name]
+
+        junction = node('Junction 0', 'junction')
+        for road in range(self.n_roads):
+            road_node = node(f'Road {road}', 'road')
+            for incoming in [True, False]:
+                # lane 0 is next to the opposing direction, n_lanes - 1 is the rightmost lane
+                lanes = [node(self.lane_name(road, incoming, lane), 'lane') for lane in range(self.n_lanes)]
+                for lane in lanes:
+                    sg.add_edge(lane, road_node, label='isIn')
+                for left, right in zip(lanes, lanes[1:]):
+                    sg.add_edge(left, right, label='toLeftOf')
+                    sg.add_edge(right, left, label='toRightOf')
+                    sg.add_edge(left, right, label='laneChange')
+                    sg.add_edge(right, left, label='laneChange')
+            for lane in range(self.n_lanes):
+                for other in range(self.n_lanes):
+                    in_lane = nodes[self.lane_name(road, True, lane)]
+                    out_lane = nodes[self.lane_name(road, False, other)]
+                    sg.add_edge(in_lane, out_lane, label='opposes')
+                    sg.add_edge(out_lane, in_lane, label='opposes')
+            # the innermost lanes of both directions are to the left of each other
+            sg.add_edge(nodes[self.lane_name(road, True, 0)], nodes[self.lane_name(road, False, 0)], label='toLeftOf')
+            sg.add_edge(nodes[self.lane_name(road, False, 0)], nodes[self.lane_name(road, True, 0)], label='toLeftOf')
+            if self.stop_signs:
+                stop_sign = node(f'stop_sign_{road}', 'stop_sign')
+                for lane in range(self.n_lanes):
+                    sg.add_edge(stop_sign, nodes[self.lane_name(road, True, lane)], label='controlsTrafficOf')
+            # connector through the junction to the next road
+            connector_road = node(f'Road J{road}', 'road')
+            connector_lane = node(f'Lane J{road}', 'lane')
+            sg.add_edge(connector_lane, connector_road, label='isIn')
+            sg.add_edge(connector_road, junction, label='isIn')
+
+    # --- vehicles ---
+
+    def position(self, vehicle):
+        """Position in metres, with the junction at the origin and road r pointing at angle 2*pi*r/n_roads."""
+        if vehicle.in_junction:
+            start = self.road_position(vehicle.road, True, vehicle.lane, 0)
+            end = self.road_position((vehicle.road + 1) % self.n_roads, False, vehicle.lane, 0)
+            t = vehicle.s / JUNCTION_LENGTH
+            return start[0] + t * (end[0] - start[0]), start[1] + t * (end[1] - start[1])
+        return self.road_position(vehicle.road, vehicle.incoming, vehicle.lane, vehicle.s)
+
+    def road_position(self, road, incoming, lane, s):
+        angle = 2 * math.pi * road / self.n_roads
+        offset = (lane + 0.5) * LANE_WIDTH * (1 if incoming else -1)
+        return (s * math.cos(angle) - offset * math.sin(angle),
+                s * math.sin(angle) + offset * math.cos(angle))
+
+    def step(self):
+        for vehicle in self.vehicles:
+            if vehicle.stopped_frames > 0:
+                vehicle.stopped_frames -= 1
+                vehicle.speed = 0.0
+                continue
+            vehicle.speed = vehicle.cruise_speed
+            distance = vehicle.speed * FRAME_DT
+            if vehicle.in_junction:
+                vehicle.s += distance
+                if vehicle.s >= JUNCTION_LENGTH:
+                    vehicle.in_junction = False
+                    vehicle.incoming = False
+                    vehicle.road = (vehicle.road + 1) % self.n_roads
+                    vehicle.s = vehicle.s - JUNCTION_LENGTH
+            elif vehicle.incoming:
+                if self.stop_signs and vehicle.s > 2 and vehicle.s - distance <= 2:
+                    # come to a stop at the stop line
+                    vehicle.s = 2
+                    vehicle.stopped_frames = 2
+                    vehicle.speed = 0.0
+                    continue
+                vehicle.s -= distance
+                if vehicle.s <= 0:
+                    vehicle.in_junction = True
+                    vehicle.s = -vehicle.s
+            else:
+                vehicle.s += distance
+                if vehicle.s >= ROAD_LENGTH:
+                    self.respawn(vehicle)
+            if not vehicle.in_junction and vehicle.base_class != 'bicycle' \
+                    and self.random.random() < self.lane_change_prob:
+                vehicle.lane = min(max(vehicle.lane + self.random.choice([-1, 1]), 0), self.n_lanes - 1)
+        self.frame += 1
+
+    def make_sg(self) -> nx.MultiDiGraph:
+        # a multigraph, since e.g. a vehicle can be both 'near' and 'atDRearOf' another
+        sg = nx.MultiDiGraph()
+        nodes = {}
+        self.add_map(sg, nodes)
+        vehicle_nodes = {}
+        for vehicle in self.vehicles:
+            emergency_lights = vehicle.emergency and self.random.random() < 0.8
+            attr = {'entity_id': vehicle.entity_id,
+                    'carla_speed': vehicle.speed,
+                    'carla_type_id': vehicle.type_id,
+                    'light_Special1': emergency_lights,
+                    'light_Special2': emergency_lights,
+                    'light_LowBeam': True,
+                    'light_Brake': vehicle.speed == 0.0}
+            node = Node(vehicle.name, vehicle.base_class, attr)
+            vehicle_nodes[vehicle.entity_id] = node
+            sg.add_node(node)
+            lane = nodes[f'Lane J{vehicle.road}'] if vehicle.in_junction \
+                else nodes[self.lane_name(vehicle.road, vehicle.incoming, vehicle.lane)]
+            sg.add_edge(node, lane, label='isIn')
+        positions = {vehicle.entity_id: self.position(vehicle) for vehicle in self.vehicles}
+        for vehicle in self.vehicles:
+            for other in self.vehicles:
+                if other is vehicle:
+                    continue
+                u = vehicle_nodes[vehicle.entity_id]
+                v = vehicle_nodes[other.entity_id]
+                distance = math.dist(positions[vehicle.entity_id], positions[other.entity_id])
+                for relation, max_distance in DISTANCE_RELATIONS:
+                    if distance <= max_distance:
+                        sg.add_edge(u, v, label=relation)
+                        break
+                same_direction = not vehicle.in_junction and not other.in_junction \
+                    and vehicle.road == other.road and vehicle.incoming == other.incoming
+                if not same_direction or distance > DISTANCE_RELATIONS[-1][1]:
+                    continue
+                # s shrinks towards the junction on incoming roads, so "ahead" flips with the direction
+                ahead = other.s < vehicle.s if vehicle.incoming else other.s > vehicle.s
+                lane_offset = other.lane - vehicle.lane
+                if lane_offset == 0:
+                    sg.add_edge(u, v, label='atDRearOf' if ahead else 'inDFrontOf')
+                elif abs(lane_offset) == 1:
+                    if abs(other.s - vehicle.s) <= SIDE_BY_SIDE:
+                        # lanes are numbered from the inside, so a higher lane is to the right
+                        sg.add_edge(u, v, label='toLeftOf' if lane_offset > 0 else 'toRightOf')
+                    sg.add_edge(u, v, label='atSRearOf' if ahead else 'inSFrontOf')
+        sg.graph['name'] = f'{self.frame}.pkl'
+        sg.graph['frame'] = str(self.frame)
+        return sg
+
+    def frames(self, n_frames):
+        for _ in range(n_frames):
+            yield self.make_sg()
+            self.step()
+
+
+def write_route(route_dir: Path, scene: SyntheticScene, n_frames):
+    """Writes the frames in the layout of a recorded route (<route>/rsv/<frame>.pkl) so the checkers can run on it."""
+    rsv_folder = route_dir / 'rsv'
+    rsv_folder.mkdir(parents=True, exist_ok=True)
+    for sg in scene.frames(n_frames):
+        with open(rsv_folder / sg.graph['name'], 'wb') as f:
+            pickle.dump(sg, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Synthetic scene graph generator')
+    parser.add_argument('-o', '--output', type=Path, required=True, help='Route folder to write the SGs to')
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--vehicles', type=int, default=10, help='Number of vehicles, including the ego')
+    parser.add_argument('--lanes', type=int, default=2, help='Lanes per direction on every road')
+    parser.add_argument('--roads', type=int, default=4, help='Roads meeting at the junction')
+    parser.add_argument('--bicycles', type=int, default=0)
+    parser.add_argument('--emergency', type=int, default=0)
+    parser.add_argument('--no_stop_signs', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    scene = SyntheticScene(n_vehicles=args.vehicles, n_lanes=args.lanes, n_roads=args.roads, n_bicycles=args.bicycles,
+                           n_emergency=args.emergency, stop_signs=not args.no_stop_signs, seed=args.seed)
+    write_route(args.output, scene, args.frames)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,125 +1,327 @@
+import argparse
 import json
-from collections import defaultdict
+from collections import Counter
 
 import matplotlib.pyplot as plt
-from matplotlib import cbook
 import matplotlib
 
 matplotlib.rcParams.update({'font.size': 12})
 
 import numpy as np
+import pandas as pd
 
 from pathlib import Path
-from glob import glob
 
 from symbolic_properties_ego_only import all_symbolic_properties as ego_all_symbolic_properties
 from symbolic_properties import all_symbolic_properties
 from generate_tables import PROPERTIES_MAPPING
+from TimingStore import TimingStore
+
+TIMING_ROOTS = ['study_timing_data/results_time_ego', 'study_timing_data/results_time']
+SERIAL_LABEL = 'Serial'
+PARALLEL_LABEL = 'Parallel'
+EGO_STR = ''
+ALL_STR = ' (all)'
+FRAME_BUDGET_S = 0.5  # 2Hz
+WHIS = (5, 95)
+EXPECTED_PHIS = range(-1, 12)
+EXPECTED_RUNS = range(1, 11)
 
 
 def get_properties(ego_only):
     return ego_all_symbolic_properties if ego_only else all_symbolic_properties
 
 
-def plot_data(data_dict, key_order):
+def label(method, ego_only):
+    return method + (EGO_STR if ego_only else ALL_STR)
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch in the style of DDSketch: values are counted in logarithmic buckets, so every quantile is
+    within relative_accuracy of the exact one while the memory only grows with the log of the value range. Sketches of
+    separate routes can be merged, which is what lets --streaming summarize a study one route at a time.
+    Count, sum, min, max and the number of frames over the budget are exact.
+    """
+
+    def __init__(self, relative_accuracy=0.01, budget=FRAME_BUDGET_S):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.budget = budget
+        # bucket i counts the values in (gamma^(i-1), gamma^i]
+        self.buckets = Counter()
+        self.zero_count = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.over_budget = 0
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.total += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.over_budget += int(np.count_nonzero(values > self.budget))
+        positive = values[values > 0]
+        self.zero_count += len(values) - len(positive)
+        keys, counts = np.unique(np.ceil(np.log(positive) / self.log_gamma).astype(np.int64), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.buckets[key] += count
+
+    def merge(self, other: "QuantileSketch"):
+        if other.relative_accuracy != self.relative_accuracy or other.budget != self.budget:
+            raise ValueError('Can only merge sketches with the same relative accuracy and budget')
+        self.buckets.update(other.buckets)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.over_budget += other.over_budget
+
+    def quantile(self, q):
+        if self.count == 0:
+            return np.nan
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        cumulative = self.zero_count
+        for key in sorted(self.buckets):
+            cumulative += self.buckets[key]
+            if cumulative > rank:
+                return min(max(2 * self.gamma ** key / (self.gamma + 1), self.min), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count > 0 else np.nan
+
+
+def box_stats(times, key):
+    """The box plot statistics of ax.bxp plus max and the fraction over the frame budget, from exact times."""
+    times = np.asarray(times)
+    low, q1, med, q3, high = np.percentile(times, [WHIS[0], 25, 50, 75, WHIS[1]])
+    return {
+        'label': key, 'med': med, 'q1': q1, 'q3': q3,
+        # like cbook.boxplot_stats, the whiskers end at the most extreme data point within the percentiles
+        'whislo': times[times >= low].min(), 'whishi': times[times <= high].max(),
+        'mean': times.mean(), 'max': times.max(), 'fliers': [],
+        'over_budget': np.count_nonzero(times > FRAME_BUDGET_S) / len(times),
+    }
+
+
+def sketch_stats(sketch: QuantileSketch, key):
+    """box_stats from a sketch, the percentiles are approximate."""
+    low, q1, med, q3, high = [sketch.quantile(p / 100) for p in [WHIS[0], 25, 50, 75, WHIS[1]]]
+    return {
+        'label': key, 'med': med, 'q1': q1, 'q3': q3, 'whislo': low, 'whishi': high,
+        'mean': sketch.mean, 'max': sketch.max, 'fliers': [],
+        'over_budget': sketch.over_budget / sketch.count,
+    }
+
+
+def records_to_frame(records, names):
+    return pd.DataFrame({
+        'dataset': pd.Categorical.from_codes(records['dataset'], names['dataset']),
+        'route': pd.Categorical.from_codes(records['route'], names['route']),
+        'ego_only': records['ego_only'].astype(bool),
+        'phi': records['phi'],
+        'run': records['run'],
+        'frame': records['frame'],
+        'time': records['time_ns'] * 1e-9,  # convert from ns to s
+    })
+
+
+def legacy_timing_files(roots):
+    """<route>_frame_times_*.json files in folders that do not have a TimingStore yet."""
+    return [Path(f) for root in roots for f in sorted(Path(root).glob('**/*_frame_times_*.json'))
+            if not TimingStore.exists(Path(f).parent)]
+
+
+def legacy_timing_routes(roots):
+    """The legacy frame time files of legacy_timing_files, grouped by folder and route."""
+    routes = {}
+    for timing_file in legacy_timing_files(roots):
+        route = timing_file.name[:timing_file.name.rindex('_frame_times_')]
+        routes.setdefault((timing_file.parent, route), []).append(timing_file)
+    return routes
+
+
+def load_legacy(timing_file: Path) -> pd.DataFrame:
+    data = json.loads(timing_file.read_text())
+    times = np.asarray(data['frame_times'], dtype=np.float64) * 1e-9
+    return pd.DataFrame({
+        'dataset': timing_file.parent.name, 'route': data['folder'], 'ego_only': bool(data['ego_only']),
+        'phi': data['phi'], 'run': data['run'], 'frame': np.arange(len(times)), 'time': times,
+    })
+
+
+def load_timings(roots) -> pd.DataFrame:
+    frames = [records_to_frame(store.read(), store.read_names()) for store in TimingStore.find(roots)]
+    legacy = legacy_timing_files(roots)
+    if len(legacy) > 0:
+        print(f'Reading {len(legacy)} legacy frame time files, run with --ingest to convert them')
+        frames.extend(load_legacy(f) for f in legacy)
+    df = pd.concat(frames, ignore_index=True)
+    for column in ['dataset', 'route']:
+        df[column] = df[column].astype(str).astype('category')
+    return df
+
+
+def serial_and_parallel(df: pd.DataFrame):
+    """
+    Frame times by label. Serial is the time of the monitor checking all properties (phi -1), Parallel the time of
+    the slowest of the monitors that each check one property (phi >= 0) on the same frame.
+    """
+    df = df[~df['dataset'].astype(str).str.contains('scenario')]
+    by_label = {}
+    serial = df[df['phi'] == -1]
+    for ego_only, times in serial.groupby('ego_only')['time']:
+        by_label[label(SERIAL_LABEL, ego_only)] = times.to_numpy()
+    parallel = df[df['phi'] >= 0].groupby(['ego_only', 'dataset', 'route', 'run', 'frame'], observed=True)['time'].max()
+    for ego_only, times in parallel.groupby(level='ego_only'):
+        by_label[label(PARALLEL_LABEL, ego_only)] = times.to_numpy()
+    return by_label
+
+
+def find_missing(present: pd.DataFrame):
+    """The (route, phi, run) combinations without frame times, given the combinations that have them."""
+    present = present[['route', 'phi', 'run']].drop_duplicates()
+    expected = pd.MultiIndex.from_product([present['route'].unique(), EXPECTED_PHIS, EXPECTED_RUNS],
+                                          names=['route', 'phi', 'run'])
+    return expected.difference(pd.MultiIndex.from_frame(present))
+
+
+def stream_sketches(roots):
+    """
+    Sketches by label and the (route, phi, run) combinations present, memory-mapping the stores and only holding the
+    records of one route in memory at a time.
+    """
+    sketches = {}
+    present = []
+
+    def add(df):
+        present.append(df[['route', 'phi', 'run']].drop_duplicates().astype({'route': str}))
+        for key, times in serial_and_parallel(df).items():
+            sketches.setdefault(key, QuantileSketch()).add(times)
+
+    for store in TimingStore.find(roots):
+        records = store.read(mmap=True)
+        names = store.read_names()
+        order = np.argsort(records['route'], kind='stable')
+        routes = np.asarray(records['route'])[order]
+        boundaries = np.flatnonzero(np.diff(routes)) + 1
+        for indices in np.split(order, boundaries):
+            if len(indices) == 0:
+                continue
+            add(records_to_frame(records[np.sort(indices)], names))
+    legacy = legacy_timing_routes(roots)
+    if len(legacy) > 0:
+        print(f'Reading the legacy frame time files of {len(legacy)} routes, run with --ingest to convert them')
+    for timing_files in legacy.values():
+        add(pd.concat([load_legacy(f) for f in timing_files], ignore_index=True))
+    return sketches, pd.concat(present, ignore_index=True)
+
+
+def ingest(roots):
+    for timing_file in legacy_timing_files(roots):
+        TimingStore(timing_file.parent).ingest_json(timing_file)
+        print(f'Ingested {timing_file}')
+
+
+def print_reduction(stats):
+    """How much checking properties in parallel reduces the worst case compared to checking them serially."""
+    for suffix in [EGO_STR, ALL_STR]:
+        serial = stats.get(SERIAL_LABEL + suffix)
+        parallel = stats.get(PARALLEL_LABEL + suffix)
+        if serial is None or parallel is None:
+            continue
+        print(f"{PARALLEL_LABEL}{suffix} vs {SERIAL_LABEL}{suffix}")
+        for stat, name in [('whishi', f'{WHIS[-1]}%'), ('max', 'max')]:
+            print(f"\t{name}:\t{serial[stat]:.3f}s -> {parallel[stat]:.3f}s "
+                  f"({(1 - parallel[stat] / serial[stat]) * 100:.1f}% lower)")
+        print(f"\t>{FRAME_BUDGET_S}s:\t{serial['over_budget'] * 100:.2f}% -> {parallel['over_budget'] * 100:.2f}%")
+
+
+def plot_data(stats_by_label, key_order):
     plt.figure(figsize=(16, 9) if len(key_order) > 2 else (5, 9))
-    whis_offset = 5
-    whis = (whis_offset, 100-whis_offset)
-    result = plt.boxplot([data_dict[key] for key in key_order], labels=key_order, whis=whis, showfliers=False, showmeans=True, whiskerprops={'color': 'red', 'linestyle': 'dotted'})
-    stats = cbook.boxplot_stats([data_dict[key] for key in key_order], labels=key_order, whis=whis)
+    stats = [stats_by_label[key] for key in key_order]
+    result = plt.gca().bxp(stats, showfliers=False, showmeans=True,
+                           whiskerprops={'color': 'red', 'linestyle': 'dotted'})
     for data in stats:
         print(f"{data['label']} (seconds)")
-        print(f"\t{whis[0]}:\t{data['whislo']}")
+        print(f"\t{WHIS[0]}:\t{data['whislo']}")
         print(f"\tq1:\t{data['q1']}")
         print(f"\tmedian:\t{data['med']}")
         print(f"\tq3:\t{data['q3']}")
-        print(f"\t{whis[-1]}:\t{data['whishi']}")
-        print(f"\tmax:\t{max(data['fliers'])}")
+        print(f"\t{WHIS[-1]}:\t{data['whishi']}")
+        print(f"\tmax:\t{data['max']}")
         print(f"\tmean:\t{data['mean']}")
     plt.ylim([0, 0.57] if len(key_order) == 2 else [0, 2])
     plt.xlim([0.5, len(key_order)+0.5])
-    hline = plt.hlines(y=0.5, xmin=0.5, xmax=len(key_order)+.5, label='0.5s ($2Hz$) Framerate', linestyle='--')
-    for index, key in enumerate(key_order):
-        number_above = len([i for i in data_dict[key] if i > 0.5])
-        plt.text(index+1, .535 if len(key_order) == 2 else 1.8, f'{key}\n{round(number_above/len(data_dict[key])*100, 2)}%>0.5s $(2Hz)$\nMax:\n{max(data_dict[key]):.2f}s',
+    hline = plt.hlines(y=FRAME_BUDGET_S, xmin=0.5, xmax=len(key_order)+.5, label='0.5s ($2Hz$) Framerate', linestyle='--')
+    for index, data in enumerate(stats):
+        plt.text(index+1, .535 if len(key_order) == 2 else 1.8, f"{data['label']}\n{round(data['over_budget']*100, 2)}%>0.5s $(2Hz)$\nMax:\n{data['max']:.2f}s",
                   bbox={'facecolor': 'white', 'alpha': 1, 'edgecolor': 'none', 'pad': 1},
                   ha='center', va='center')
-        plt.text(index + 1, min(stats[index]["whishi"] + (.015 if len(key_order) == 2 else 0.035), 0.485 if len(key_order) == 2 else 1000),
-                 f'{whis[-1]}%$\leq${stats[index]["whishi"]:.2f}s',
+        plt.text(index + 1, min(data["whishi"] + (.015 if len(key_order) == 2 else 0.035), 0.485 if len(key_order) == 2 else 1000),
+                 f'{WHIS[-1]}%$\leq${data["whishi"]:.2f}s',
                  bbox={'facecolor': 'white', 'alpha': 1, 'edgecolor': 'none', 'pad': 1},
                  ha='center', va='center')
     plt.ylabel('Time to Compute (seconds)')
     plt.xlabel('Property' if len(key_order) > 2 else 'Evaluation Method')
     plt.title('Time to Compute Properties per Frame')
     plt.legend([hline, result["whiskers"][0], result["medians"][0], result["means"][0]],
-               ['0.5s ($2Hz$) Framerate', f'{whis[0]}% to {whis[1]}%', "Median", "Mean"],
+               ['0.5s ($2Hz$) Framerate', f'{WHIS[0]}% to {WHIS[1]}%', "Median", "Mean"],
                loc='center right')
     filename = f"frame_time_hist_{'ego_only' if len(key_order) == 2 else 'all'}"
     for ending in ['svg', 'pdf']:
         plt.savefig(f'{filename}.{ending}')
 
+
 def main():
-    serial_label = 'Serial'
-    parallel_label = 'Parallel'
-    ego_files = glob('study_timing_data/results_time_ego/**/*_frame_times_*.json')
-    not_ego_files = glob('study_timing_data/results_time/**/*_frame_times_*.json')
-    all_files = []
-    all_files.extend(ego_files)
-    all_files.extend(not_ego_files)
-    all_times = []
-    totals = defaultdict(int)
-    by_phi = defaultdict(list)
-    route_map = defaultdict(list)
-    folder_times = defaultdict(list)
-    parallel_times = defaultdict(list)
-    ego_str = ''
-    all_str = ' (all)'
-    for timing_file in all_files:
-        with open(timing_file) as f:
-            times_data = json.load(f)
-            route = times_data['folder']
-            phi = times_data['phi']
-            run = times_data['run']
-            folder = timing_file.split('/')[-2]
-            route_map[route].append((phi, run))
-            totals[phi] += len(times_data['frame_times'])
-            times = times_data['frame_times']
-            times = [i * 1e-9 for i in times]  # convert from ns to s
-            all_times.extend(times)
-            folder_times['all'].extend(times)
-            folder_times[folder].extend(times)
-            if 'scenario' not in timing_file:
-                if phi == -1:
-                    phi_name = serial_label + (ego_str if 'ego' in timing_file else all_str)
-                    by_phi[phi_name].extend(times)
-                else:
-                    parallel_times[('ego' if 'ego' in timing_file else 'all', folder, route, run)].append(times)
-    for key, timing_lists in parallel_times.items():
-        timing_lists = np.array(timing_lists)
-        worst_times = np.max(timing_lists, axis=0)
-        by_phi[parallel_label + (ego_str if 'ego' in key[0] else all_str)].extend(worst_times.tolist())
-    missing = False
-    for route in route_map:
-        for phi in range(-1, 12):
-            for run in range(1, 11):
-                key = (phi, run)
-                if key not in route_map[route]:
-                    print('missing', route, 'phi', phi, 'run', run)
-                    missing = True
-    if missing:
+    parser = argparse.ArgumentParser(prog='Frame time parser')
+    parser.add_argument('--roots', type=Path, nargs='+', default=TIMING_ROOTS,
+                        help='Folders searched for frame time stores and legacy frame time files')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Process one route at a time with approximate percentiles, for studies larger than memory')
+    parser.add_argument('--ingest', action='store_true',
+                        help='Convert legacy <route>_frame_times_*.json files into frame time stores and exit')
+    args = parser.parse_args()
+    if args.ingest:
+        ingest(args.roots)
+        return
+
+    if args.streaming:
+        sketches, present = stream_sketches(args.roots)
+        stats = {key: sketch_stats(sketch, key) for key, sketch in sketches.items()}
+    else:
+        df = load_timings(args.roots)
+        present = df
+        stats = {key: box_stats(times, key) for key, times in serial_and_parallel(df).items()}
+    missing = find_missing(present)
+    for route, phi, run in missing:
+        print('missing', route, 'phi', phi, 'run', run)
+    if len(missing) > 0:
         quit()
+    print_reduction(stats)
     key_order = [val['name'] for key, val in PROPERTIES_MAPPING.items()]
-    key_order.append(serial_label + ego_str)
-    key_order.append(parallel_label + ego_str)
-    key_order = [k for k in key_order if k in by_phi.keys()]
-    plot_data(by_phi, key_order)
+    key_order.append(SERIAL_LABEL + EGO_STR)
+    key_order.append(PARALLEL_LABEL + EGO_STR)
+    key_order = [k for k in key_order if k in stats]
+    plot_data(stats, key_order)
     key_order = [val['name'] for key, val in PROPERTIES_MAPPING.items()]
-    key_order.append(serial_label + all_str)
-    key_order.append(serial_label + ego_str)
-    key_order.append(parallel_label + all_str)
-    key_order.append(parallel_label + ego_str)
-    key_order = [k for k in key_order if k in by_phi.keys()]
-    plot_data(by_phi, key_order)
+    key_order.append(SERIAL_LABEL + ALL_STR)
+    key_order.append(SERIAL_LABEL + EGO_STR)
+    key_order.append(PARALLEL_LABEL + ALL_STR)
+    key_order.append(PARALLEL_LABEL + EGO_STR)
+    key_order = [k for k in key_order if k in stats]
+    plot_data(stats, key_order)
 
 
 if __name__ == '__main__':